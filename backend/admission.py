@@ -0,0 +1,244 @@
+"""
+Admission control: how many requests a worker serves at once, and what
+happens to the rest.
+
+Requests are sorted into classes by :func:`request_class` (reads, writes,
+the authenticated profile routes, and catalogue exports) and each class has a
+:class:`ConcurrencyLimit`: up to ``limit`` requests run, up to ``queue``
+more wait their turn in arrival order for at most ``ADMISSION_QUEUE_TIMEOUT``
+seconds, and the rest are turned away at once with a 503 and Retry-After.
+Past the limit, extra requests would only slow down the ones already
+running, all waiting on the same upstream; shedding them keeps latency for
+the admitted ones close to what it is under normal load, and tells clients
+to come back instead of letting them time out.
+
+Optionally (``RATE_LIMIT_PER_SECOND``), each bearer token also has a
+:class:`TokenBucket`, and a client sending more than its share gets a 429.
+
+Event streams, health checks and metrics are not limited: streams stay open
+for minutes, and the others must answer even when the worker is saturated.
+"""
+import asyncio
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers
+
+import metrics
+
+READS = "read"
+WRITES = "write"
+AUTH = "auth"
+EXPORTS = "export"
+
+# class -> (running limit, waiting limit); a running limit of 0 admits everything
+LIMITS = {
+    READS: (int(os.getenv("ADMISSION_READ_LIMIT", "64")), int(os.getenv("ADMISSION_READ_QUEUE", "128"))),
+    WRITES: (int(os.getenv("ADMISSION_WRITE_LIMIT", "16")), int(os.getenv("ADMISSION_WRITE_QUEUE", "32"))),
+    AUTH: (int(os.getenv("ADMISSION_AUTH_LIMIT", "32")), int(os.getenv("ADMISSION_AUTH_QUEUE", "64"))),
+    # Exports each hold a slot for the whole transfer, so they get their own few
+    EXPORTS: (int(os.getenv("ADMISSION_EXPORT_LIMIT", "4")), int(os.getenv("ADMISSION_EXPORT_QUEUE", "8"))),
+}
+
+# Seconds a request may wait for a slot before it is turned away
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+# Requests per second per bearer token, with bursts of up to RATE_LIMIT_BURST; 0 turns it off
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+# Buckets kept, least recently used dropped first
+RATE_LIMIT_MAX_TOKENS = 10000
+
+UNLIMITED_PREFIXES = ("/health", "/metrics", "/api/stream/")
+# Exact paths: /api/profiles/{user_id}/role is an admin write, limited with the writes
+AUTH_PATHS = {"/api/profile", "/api/debug-auth"}
+EXPORT_PREFIXES = ("/api/export/",)
+# POST routes that only read
+READ_POSTS = {"/api/programs/batch"}
+
+SHED = metrics.Counter(
+    "admission_shed_total", "Requests turned away, by class and reason (queue_full or queue_timeout).",
+    ("class", "reason"),
+)
+RATE_LIMITED = metrics.Counter("rate_limited_total", "Requests refused by the per-token rate limit.")
+WAIT = metrics.Histogram(
+    "admission_wait_seconds", "Time admitted requests spent waiting for a slot, by class.", ("class",),
+)
+
+
+class Shed(Exception):
+    """No slot could be had; ``reason`` is queue_full or queue_timeout."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class ConcurrencyLimit:
+    """At most ``limit`` holders at once, with up to ``queue`` waiting in FIFO order."""
+
+    def __init__(self, limit: int, queue: int, timeout: float = QUEUE_TIMEOUT):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        """Take a slot, waiting if need be; raises :class:`Shed` if none is free in time."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue:
+            raise Shed("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            self._give_up(waiter)
+            raise
+        if not waiter.done():
+            self._give_up(waiter)
+            raise Shed("queue_timeout")
+
+    def _give_up(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as we stopped waiting; pass it on
+            self.release()
+            return
+        waiter.cancel()
+        self._waiters.remove(waiter)
+
+    def release(self):
+        # Hand the slot straight to the longest waiter, so newcomers can't overtake it
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class TokenBucket:
+    """``rate`` tokens a second, holding at most ``burst``."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 if a token was taken, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def request_class(method: str, path: str):
+    """The class a request is limited under, or None if it isn't limited."""
+    if path.startswith(UNLIMITED_PREFIXES) or path == "/":
+        return None
+    if path in AUTH_PATHS:
+        return AUTH
+    if path.startswith(EXPORT_PREFIXES):
+        return EXPORTS
+    if method in ("GET", "HEAD", "OPTIONS") or path in READ_POSTS:
+        return READS
+    return WRITES
+
+
+def _bearer(scope) -> str:
+    authorization = Headers(scope=scope).get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else ""
+
+
+def _refuse(status: int, detail: str, retry_after: float) -> ORJSONResponse:
+    return ORJSONResponse(
+        {"detail": detail}, status_code=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+# class -> ConcurrencyLimit, for the classes that are limited
+limits = {
+    name: ConcurrencyLimit(limit, queue)
+    for name, (limit, queue) in LIMITS.items() if limit > 0
+}
+
+# sha256 of a bearer token -> its TokenBucket
+buckets = OrderedDict()
+
+metrics.CallbackMetric(
+    "admission_in_flight", "Requests running, by class.",
+    lambda: {(name,): limit.active for name, limit in limits.items()}, ("class",),
+)
+metrics.CallbackMetric(
+    "admission_queue_depth", "Requests waiting for a slot, by class.",
+    lambda: {(name,): limit.waiting for name, limit in limits.items()}, ("class",),
+)
+
+
+def rate_limited(scope) -> float:
+    """0 if the request's token may make another request now, else seconds until it may."""
+    token = _bearer(scope)
+    if not RATE_LIMIT_PER_SECOND or not token:
+        return 0.0
+    key = hashlib.sha256(token.encode()).digest()
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+        if len(buckets) > RATE_LIMIT_MAX_TOKENS:
+            buckets.popitem(last=False)
+    else:
+        buckets.move_to_end(key)
+    return bucket.take()
+
+
+class AdmissionMiddleware:
+    """Applies the per-token rate limit and the per-class concurrency limits."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        name = request_class(scope["method"], scope["path"])
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        wait = rate_limited(scope)
+        if wait:
+            RATE_LIMITED.inc()
+            return await _refuse(429, "Too many requests", wait)(scope, receive, send)
+
+        limit = limits.get(name)
+        if limit is None:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await limit.acquire()
+        except Shed as shed:
+            SHED.inc(name, shed.reason)
+            return await _refuse(503, "Server busy, try again shortly", limit.timeout)(scope, receive, send)
+        WAIT.observe(time.perf_counter() - started, name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
@@ -1,28 +1,193 @@
+"""
+Bearer-token authentication for the protected routes.
+
+Supabase access tokens are JWTs, so they are verified in-process rather than
+by asking GoTrue about every request: HS256 tokens against the project's
+``SUPABASE_JWT_SECRET``, asymmetric ones against the project's JWKS, which is
+cached and refetched in the background. Verified users are cached by token
+hash until the token expires. Tokens that cannot be verified locally (no
+secret configured, unknown key) fall back to ``supabase.auth.get_user``.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+import jwt
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from config import supabase # Import the initialized Supabase client
+
+from cache import TTLCache
+from config import public_client, supabase_url
+import repository
+import tracing
+
+JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    f"{supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json" if supabase_url else None
+)
+JWKS_REFRESH_INTERVAL = float(os.getenv("SUPABASE_JWKS_REFRESH_INTERVAL", "600"))
+# A token signed with an unknown key id triggers a refetch, at most this often
+JWKS_MIN_REFETCH_INTERVAL = 30.0
+# Tolerated clock skew between us and GoTrue when checking exp/iat
+CLOCK_SKEW = 10
+
+logger = logging.getLogger(__name__)
 
 # Simple auth dependency using HTTP Bearer tokens
 security = HTTPBearer()
 
+_user_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", "300")),
+)
+
+
+@dataclass(frozen=True)
+class AuthUser:
+    """The authenticated user, built from verified token claims."""
+    id: str
+    email: Optional[str] = None
+    role: Optional[str] = None
+    user_metadata: dict = field(default_factory=dict)
+    app_metadata: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_claims(cls, claims: dict) -> "AuthUser":
+        return cls(
+            id=claims["sub"],
+            email=claims.get("email"),
+            role=claims.get("role"),
+            user_metadata=claims.get("user_metadata") or {},
+            app_metadata=claims.get("app_metadata") or {},
+        )
+
+
+class KeySet:
+    """The project's JSON Web Key Set, indexed by key id."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._keys = {}
+        self._fetched_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Fetch the key set. Blocking; run it off the event loop."""
+        response = httpx.get(self.url, timeout=5.0)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk)
+            except jwt.PyJWTError:
+                # Unsupported algorithm, or the crypto extra is not installed
+                continue
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def get(self, kid: Optional[str]):
+        return self._keys.get(kid)
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > JWKS_MIN_REFETCH_INTERVAL
+
+
+_key_set = KeySet(JWKS_URL) if JWKS_URL else None
+
+
+async def _signing_key(token: str):
+    """Return the key to verify ``token`` with, or None if it can't be verified locally."""
+    header = jwt.get_unverified_header(token)
+    if header.get("alg", "").startswith("HS"):
+        return JWT_SECRET
+    if _key_set is None:
+        return None
+    key = _key_set.get(header.get("kid"))
+    if key is None and _key_set.is_stale():
+        with tracing.span("auth", "jwks"):
+            await repository.run(_key_set.refresh)
+        key = _key_set.get(header.get("kid"))
+    return key
+
+
+def _decode(token: str, key) -> dict:
+    algorithm = key.algorithm_name if isinstance(key, jwt.PyJWK) else "HS256"
+    return jwt.decode(
+        token,
+        key.key if isinstance(key, jwt.PyJWK) else key,
+        algorithms=[algorithm],
+        audience=JWT_AUDIENCE,
+        leeway=CLOCK_SKEW,
+        options={"require": ["exp", "sub"]},
+    )
+
+
+async def _verify_remotely(token: str) -> AuthUser:
+    with tracing.span("auth", "get_user"):
+        user_response = await repository.run(public_client().auth.get_user, token)
+
+    if user_response.user is None:
+        logger.info("Token rejected by Supabase auth: no user")
+        raise HTTPException(status_code=401, detail="Invalid token: User not found.")
+
+    user = user_response.user
+    return AuthUser(
+        id=str(user.id),
+        email=user.email,
+        role=user.role,
+        user_metadata=user.user_metadata or {},
+        app_metadata=user.app_metadata or {},
+    )
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
-    Validates the JWT from the Authorization header and returns the Supabase user.
+    Validates the JWT from the Authorization header and returns the user.
     This function is used as a dependency in protected routes.
     """
+    token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    user = _user_cache.get(cache_key)
+    if user is not None:
+        return user
+
     try:
-        print(f"Validating token: {credentials.credentials[:20]}...")
-        # Use the imported supabase client to validate the token
-        user_response = supabase.auth.get_user(credentials.credentials)
-        print(f"Auth response: {user_response}")
-        
-        if user_response.user is None:
-            print("No user found in auth response")
-            raise HTTPException(status_code=401, detail="Invalid token: User not found.")
-        
-        print(f"User authenticated: {user_response.user.id}")
-        return user_response.user
+        key = await _signing_key(token)
+        if key is not None:
+            claims = _decode(token, key)
+            user = AuthUser.from_claims(claims)
+        else:
+            user = await _verify_remotely(token)
+            claims = jwt.decode(token, options={"verify_signature": False})
+    except HTTPException:
+        raise
     except Exception as e:
         # Catch any exception during token validation
-        print(f"Auth error: {str(e)}")
+        logger.info("Token rejected", extra={"reason": str(e)})
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
+
+    # Never keep a user cached past the token's own expiry
+    ttl = min(_user_cache.ttl, claims.get("exp", 0) - time.time())
+    _user_cache.set(cache_key, user, ttl=ttl)
+    return user
+
+
+async def rotate_keys():
+    """Refetch the JWKS periodically so rotated signing keys are picked up."""
+    if _key_set is None:
+        return
+    while True:
+        try:
+            with tracing.span("auth", "jwks"):
+                await repository.run(_key_set.refresh)
+        except Exception as e:
+            logger.warning("JWKS refresh failed", extra={"error": str(e)})
+        await asyncio.sleep(JWKS_REFRESH_INTERVAL)
@@ -0,0 +1,102 @@
+"""
+Throughput and memory of POST /api/programs/bulk against a stub PostgREST.
+
+Streams a generated NDJSON upload through the app and compares it with one
+POST /api/programs per row. The stub runs in a child process, so the peak
+traced allocation reported here is the app's alone.
+
+    python benchmarks/bench_bulk_import.py --rows 50000 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_postgrest import StubPostgREST, seed  # noqa: E402
+
+
+def _serve(data, latency: float, urls, stop):
+    with StubPostgREST(data, latency=latency) as stub:
+        urls.put(stub.url)
+        stop.wait()
+
+
+async def _body(rows: int, provider_id: str, chunk_rows: int = 200):
+    """Yield the upload in chunks, as a client streaming a file would."""
+    for start in range(0, rows, chunk_rows):
+        yield "".join(
+            json.dumps({
+                "name": f"Imported program {i}",
+                "description": "Bulk imported community program",
+                "category": "Community",
+                "start_date": "2025-06-01",
+                "provider_id": provider_id,
+            }) + "\n"
+            for i in range(start, min(start + chunk_rows, rows))
+        ).encode()
+
+
+async def _run(app, args, provider_id: str):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        started = time.perf_counter()
+        for i in range(args.single_rows):
+            response = await client.post("/api/programs", json={"name": f"Single {i}", "provider_id": provider_id})
+            response.raise_for_status()
+        per_row = (time.perf_counter() - started) / args.single_rows
+
+        for rows in (args.rows // 5, args.rows):
+            tracemalloc.start()
+            started = time.perf_counter()
+            response = await client.post(
+                "/api/programs/bulk",
+                params={"batch_size": args.batch_size, "concurrency": args.concurrency},
+                content=_body(rows, provider_id),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result = response.json()
+            print(f"bulk {rows:>7} rows: {elapsed:6.2f} s ({rows / elapsed:8.0f} rows/s), "
+                  f"inserted {result['inserted']}, peak {peak / 1e6:6.1f} MB")
+
+        print(f"one POST per row: {per_row * 1000:.1f} ms/row, "
+              f"{args.rows} rows would take {per_row * args.rows / 60:.1f} min")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--single-rows", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub round trip in seconds")
+    args = parser.parse_args()
+
+    data = seed(programs=100, providers=5)
+    urls, stop = multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target=_serve, args=(data, args.latency, urls, stop), daemon=True)
+    server.start()
+    try:
+        os.environ["SUPABASE_URL"] = urls.get(timeout=10)
+        os.environ["SUPABASE_ANON_KEY"] = "stub.anon.key"
+        os.environ["SUPABASE_SERVICE_KEY"] = "stub.service.key"
+        from main import app
+
+        asyncio.run(_run(app, args, data["providers"][0]["provider_id"]))
+    finally:
+        stop.set()
+        server.join(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Throughput of GET /api/programs/{id} in a single worker against a stub PostgREST.
+
+Compares the repository layer (queries offloaded to the upstream thread pool)
+with the old behaviour of calling ``query.execute()`` on the event loop.
+
+    python benchmarks/bench_event_loop.py --requests 1000 --concurrency 200 --latency 0.02
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_postgrest import StubPostgREST, seed  # noqa: E402
+
+
+def _point_at(url: str):
+    os.environ["SUPABASE_URL"] = url
+    os.environ["SUPABASE_ANON_KEY"] = "stub.anon.key"
+    os.environ["SUPABASE_SERVICE_KEY"] = "stub.service.key"
+
+
+async def _blocking_execute(query):
+    return query.execute()
+
+
+async def _drive(app, program_ids, total: int, concurrency: int) -> float:
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i: int):
+            async with semaphore:
+                response = await client.get(f"/api/programs/{program_ids[i % len(program_ids)]}")
+                response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub round trip in seconds")
+    args = parser.parse_args()
+
+    data = seed(programs=1000, providers=50)
+    program_ids = [p["program_id"] for p in data["programs"]]
+
+    with StubPostgREST(data, latency=args.latency) as stub:
+        _point_at(stub.url)
+        import repository
+        from main import app
+
+        offloaded = repository.execute
+        for label, execute in (("blocking", _blocking_execute), ("offloaded", offloaded)):
+            repository.execute = execute
+            # The routes still print debug output; keep it out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed = asyncio.run(_drive(app, program_ids, args.requests, args.concurrency))
+            print(
+                f"{label:>10}: {args.requests} requests in {elapsed:6.2f}s "
+                f"-> {args.requests / elapsed:8.1f} req/s"
+            )
+        repository.execute = offloaded
+        repository.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Memory use of GET /api/export/programs.{ndjson,csv,ics} as the catalogue grows.
+
+For each catalogue size, starts a stub PostgREST in its own process (so its
+rows don't count towards this one's memory), streams the export through the
+app in-process, twice: once from upstream (saving the snapshot) and once from
+the snapshot. A thread samples this process's resident set size while the
+body streams; the peak above the baseline should not grow with the catalogue.
+
+    python benchmarks/bench_export.py --sizes 10000 100000 1000000 --format ndjson
+"""
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_ANON_KEY", "stub.anon.key")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "stub.service.key")
+
+from supabase import create_client  # noqa: E402
+
+import export  # noqa: E402
+import repository  # noqa: E402
+from main import app  # noqa: E402
+
+PAGE = resource.getpagesize()
+
+
+def _rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE
+
+
+class _PeakRSS:
+    """Samples resident set size every ``interval`` seconds while in use."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, _rss())
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+async def _get(path: str):
+    """Send a GET straight to the ASGI app; the body is counted, not kept."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1),
+        "server": ("bench", 80),
+    }
+    status, size, requested, disconnected = None, 0, False, asyncio.Event()
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    disconnected.set()
+    return status, size
+
+
+def _start_stub(programs: int, port: int) -> subprocess.Popen:
+    stub = subprocess.Popen(
+        [sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_postgrest.py"),
+         "--programs", str(programs), "--latency", "0", "--port", str(port)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    # Seeding takes a while at a million rows; it prints once it's listening
+    if not stub.stdout.readline().startswith("Serving"):
+        stub.kill()
+        raise RuntimeError("stub PostgREST didn't start")
+    return stub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--format", choices=sorted(export.FORMATS), default="ndjson")
+    parser.add_argument("--port", type=int, default=54329)
+    args = parser.parse_args()
+
+    path = f"/api/export/programs.{args.format}"
+    directory = tempfile.mkdtemp(prefix="bench-export-")
+    export.snapshots = export.SnapshotStore(directory)
+    print(f"{'programs':>9}  {'source':<8} {'MB':>8} {'seconds':>8} {'rows/s':>9} {'RSS MB':>7} {'peak +MB':>8}")
+    try:
+        for programs in args.sizes:
+            stub = _start_stub(programs, args.port)
+            try:
+                repository.supabase_admin = create_client(f"http://127.0.0.1:{args.port}", "stub.service.key")
+                for source in ("upstream", "snapshot"):
+                    with _PeakRSS() as rss:
+                        baseline = rss.peak
+                        started = time.perf_counter()
+                        status, size = asyncio.run(_get(path))
+                        elapsed = time.perf_counter() - started
+                    assert status == 200, status
+                    print(
+                        f"{programs:>9}  {source:<8} {size / 1e6:>8.1f} {elapsed:>8.2f} {programs / elapsed:>9.0f} "
+                        f"{baseline / 1e6:>7.1f} {(rss.peak - baseline) / 1e6:>8.1f}"
+                    )
+            finally:
+                stub.terminate()
+                stub.wait()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Latency of /api/search lookups against the in-process inverted index.
+
+Builds an index over synthetic programs with a realistic vocabulary, then
+times type-ahead queries (every prefix of a word, then two-word queries) and
+incremental updates.
+
+    python benchmarks/bench_search.py --documents 30000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_ANON_KEY", "stub.anon.key")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "stub.service.key")
+
+import search  # noqa: E402
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "te", "vi", "wo", "yo", "ar", "en", "is", "ol", "um"]
+SUBURBS = ["Sydney", "Newtown", "Glebe", "Redfern", "Surry Hills", "Marrickville", "Bondi", "Manly"]
+
+
+def _vocabulary(rng: random.Random, size: int) -> list:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def _documents(rng: random.Random, count: int, words: list) -> list:
+    # Zipf-like word choice: a few common words, a long tail of rare ones
+    cumulative, total = [], 0.0
+    for rank in range(len(words)):
+        total += 1 / (rank + 1)
+        cumulative.append(total)
+
+    def sentence(n):
+        return " ".join(rng.choices(words, cum_weights=cumulative, k=n))
+
+    return [
+        {
+            "program_id": f"p{i}",
+            "name": sentence(rng.randint(2, 4)).title(),
+            "description": sentence(rng.randint(10, 40)),
+            "category": rng.choice(["Health", "Education", "Arts", "Sport", "Community"]),
+            "address": f"{rng.randint(1, 400)} {rng.choice(words).title()} St, {rng.choice(SUBURBS)}",
+        }
+        for i in range(count)
+    ]
+
+
+def _percentiles(samples: list) -> str:
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000  # noqa: E731
+    return f"p50 {p(0.50):6.3f} ms  p99 {p(0.99):6.3f} ms  max {samples[-1] * 1000:6.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=30000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    words = _vocabulary(rng, args.vocabulary)
+    documents = _documents(rng, args.documents, words)
+
+    store = search.SearchStore()
+    started = time.perf_counter()
+    store.reset()
+    for row in documents:
+        store.add(row)
+    print(f"build {len(store.index)} documents: {time.perf_counter() - started:.2f} s")
+
+    typeahead, two_words = [], []
+    for _ in range(args.queries):
+        name = rng.choice(documents)["name"].lower().split()
+        for end in range(1, len(name[0]) + 1):
+            started = time.perf_counter()
+            store.index.search(name[0][:end])
+            typeahead.append(time.perf_counter() - started)
+        if len(name) > 1:
+            query = f"{name[0]} {name[1][:3]}"
+            started = time.perf_counter()
+            store.index.search(query)
+            two_words.append(time.perf_counter() - started)
+    print(f"type-ahead ({len(typeahead)} queries): {_percentiles(typeahead)}")
+    print(f"two words  ({len(two_words)} queries): {_percentiles(two_words)}")
+
+    updates = []
+    for row in rng.sample(documents, min(args.queries, len(documents))):
+        started = time.perf_counter()
+        store.discard(row["program_id"])
+        store.add({**row, "name": row["name"] + " Extra"})
+        updates.append(time.perf_counter() - started)
+    print(f"update     ({len(updates)} writes):  {_percentiles(updates)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Cost of turning program rows into a response body, per 10k rows.
+
+Compares the previous paths (building ``Program`` models that FastAPI then
+validates against ``response_model``, or passing dicts through
+``jsonable_encoder``, then the standard json module) with the current one
+(:func:`serialization.program_out` and orjson), and reports what gzip adds
+and saves for a list response.
+
+    python benchmarks/bench_serialization.py --rows 10000
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_ANON_KEY", "stub.anon.key")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "stub.service.key")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import compression  # noqa: E402
+import serialization  # noqa: E402
+from benchmarks.stub_postgrest import seed  # noqa: E402
+from routes.program_routes import Program  # noqa: E402
+
+
+def _rows(count: int) -> list:
+    data = seed(programs=count, providers=50)
+    providers = {p["provider_id"]: p for p in data["providers"]}
+    # Shaped like PostgREST's answer to PROGRAM_WITH_PROVIDER
+    return [
+        {**row, "providers": {"provider_id": row["provider_id"], "name": providers[row["provider_id"]]["name"]}}
+        for row in data["programs"]
+    ]
+
+
+def _flatten_and_build(rows: list) -> list:
+    programs = []
+    for row in rows:
+        program_dict = dict(row)
+        if program_dict.get("providers"):
+            program_dict["provider_name"] = program_dict["providers"]["name"]
+            del program_dict["providers"]
+        else:
+            program_dict["provider_name"] = None
+        programs.append(Program(**program_dict))
+    return programs
+
+
+PROGRAMS = TypeAdapter(List[Program])
+
+
+def before_model(rows: list) -> bytes:
+    """Detail/write routes: Program(**...), then response_model validation and json."""
+    # What FastAPI's serialize_response does with a response_model
+    content = PROGRAMS.dump_python(PROGRAMS.validate_python(_flatten_and_build(rows)), mode="json")
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def before_list(rows: list) -> bytes:
+    """GET /api/programs: flattened dicts through jsonable_encoder and json."""
+    content = [
+        {**{k: v for k, v in row.items() if k != "providers"}, "provider_name": row["providers"]["name"]}
+        for row in rows
+    ]
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def after(rows: list) -> bytes:
+    return serialization.json_response([serialization.program_out(row) for row in rows]).body
+
+
+def _best_of(fn, rows: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = _rows(args.rows)
+    scale = 10000 / args.rows
+
+    new = _best_of(after, rows, args.repeat)
+    for label, fn in [("Program + response_model + json", before_model), ("jsonable_encoder + json", before_list)]:
+        old = _best_of(fn, rows, args.repeat)
+        print(f"{label:34s} {old * scale * 1000:8.1f} ms per 10k rows  ({old / new:.1f}x the new path)")
+    print(f"{'program_out + orjson':34s} {new * scale * 1000:8.1f} ms per 10k rows")
+
+    body = after(rows)
+    started = time.perf_counter()
+    compressed = gzip.compress(body, compresslevel=compression.GZIP_LEVEL)
+    elapsed = time.perf_counter() - started
+    print(
+        f"gzip level {compression.GZIP_LEVEL}: {len(body) / 1024:.0f} KiB -> {len(compressed) / 1024:.0f} KiB "
+        f"in {elapsed * scale * 1000:.1f} ms per 10k rows"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Latency of program create/update against a stub PostgREST with network delay.
+
+Compares the old request sequences (existence checks, the write, then a
+re-select) with the single-round-trip writes in ``repository``.
+
+    python benchmarks/bench_writes.py --iterations 50 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_postgrest import StubPostgREST, seed  # noqa: E402
+
+
+async def legacy_create(client, data: dict):
+    import repository
+
+    await repository.execute(
+        client.table("providers").select("provider_id, name").eq("provider_id", data["provider_id"])
+    )
+    inserted = await repository.execute(client.table("programs").insert(data))
+    return await repository.execute(
+        client.table("programs").select(repository.PROGRAM_WITH_PROVIDER)
+        .eq("program_id", inserted.data[0]["program_id"])
+    )
+
+
+async def legacy_update(client, program_id: str, data: dict):
+    import repository
+
+    await repository.execute(client.table("programs").select("*").eq("program_id", program_id))
+    await repository.execute(
+        client.table("providers").select("provider_id, name").eq("provider_id", data["provider_id"])
+    )
+    await repository.execute(client.table("programs").update(data).eq("program_id", program_id))
+    return await repository.execute(
+        client.table("programs").select(repository.PROGRAM_WITH_PROVIDER).eq("program_id", program_id)
+    )
+
+
+async def _measure(label: str, stub, iterations: int, fn):
+    stub.requests.clear()
+    started = time.perf_counter()
+    for i in range(iterations):
+        await fn(i)
+    elapsed = (time.perf_counter() - started) / iterations
+    trips = sum(stub.requests.values()) / iterations
+    print(f"{label:>16}: {elapsed * 1000:7.2f} ms/write, {trips:.0f} upstream round trips")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub round trip in seconds")
+    args = parser.parse_args()
+
+    data = seed(programs=200, providers=10)
+    provider_id = data["providers"][0]["provider_id"]
+    program_ids = [p["program_id"] for p in data["programs"]]
+
+    with StubPostgREST(data, latency=args.latency) as stub:
+        os.environ["SUPABASE_URL"] = stub.url
+        os.environ["SUPABASE_ANON_KEY"] = "stub.anon.key"
+        os.environ["SUPABASE_SERVICE_KEY"] = "stub.service.key"
+        import repository
+        client = repository.admin_client()
+
+        def payload(i):
+            return {"name": f"Bench {i}", "provider_id": provider_id}
+
+        async def run():
+            await _measure("legacy create", stub, args.iterations,
+                           lambda i: legacy_create(client, payload(i)))
+            await _measure("single create", stub, args.iterations,
+                           lambda i: repository.insert_program(payload(i)))
+            await _measure("legacy update", stub, args.iterations,
+                           lambda i: legacy_update(client, program_ids[i], payload(i)))
+            await _measure("single update", stub, args.iterations,
+                           lambda i: repository.update_program(program_ids[i], payload(i)))
+
+        asyncio.run(run())
+        repository.close()
+
+
+if __name__ == "__main__":
+    main()
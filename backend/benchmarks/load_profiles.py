@@ -0,0 +1,217 @@
+"""
+Scripted requests for every route in program_routes, provider_routes and
+user_routes, plus search, used by ``benchmarks/loadtest.py``.
+
+Each route profile builds one request from a :class:`LoadContext` (the ids
+and tokens of the seeded dataset) and a seeded ``random.Random``. A mix
+names route profiles with relative weights; running a single route is a
+mix of one. GET /api/stream/programs is left out: an SSE connection is
+long-lived, so its latency isn't comparable with request/response routes.
+"""
+import json
+import random
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.stub_postgrest import CATEGORIES, place_location
+
+SEARCH_TERMS = ["program", "community", "sydney", "health", "arts", "provider 1", "weekly", "sport"]
+
+
+@dataclass
+class LoadContext:
+    """What the profiles draw requests from."""
+    program_ids: List[str]
+    provider_ids: List[str]
+    tokens: List[str]
+    latest_version: int
+
+    @classmethod
+    def from_seed(cls, data: dict, tokens: List[str]) -> "LoadContext":
+        programs = data["programs"]
+        return cls(
+            program_ids=[p["program_id"] for p in programs],
+            provider_ids=[p["provider_id"] for p in data["providers"]],
+            tokens=tokens,
+            latest_version=max((p["version"] for p in programs), default=0),
+        )
+
+    def popular_program(self, rng: random.Random) -> str:
+        """Mostly one of the first 1% of programs, as when a few get shared widely."""
+        hot = max(1, len(self.program_ids) // 100)
+        if rng.random() < 0.8:
+            return self.program_ids[rng.randrange(hot)]
+        return rng.choice(self.program_ids)
+
+
+@dataclass
+class LoadRequest:
+    method: str
+    path: str
+    params: Optional[dict] = None
+    json: Optional[object] = None
+    content: Optional[bytes] = None
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+def _new_program(ctx: LoadContext, rng: random.Random) -> dict:
+    start = date(2025, 1, 1) + timedelta(days=rng.randrange(365))
+    return {
+        "name": f"Load test program {rng.getrandbits(32):08x}",
+        "category": rng.choice(CATEGORIES),
+        "description": "Created by the load test",
+        "start_date": start.isoformat(),
+        "date_interval": "Weekly",
+        "repeat_interval": 1,
+        "place_id": f"place-{rng.randrange(501)}",
+        "provider_id": rng.choice(ctx.provider_ids),
+    }
+
+
+def _bearer(ctx: LoadContext, rng: random.Random) -> dict:
+    return {"Authorization": f"Bearer {rng.choice(ctx.tokens)}"}
+
+
+# ---------------------------------------------------------------------------
+# program_routes
+# ---------------------------------------------------------------------------
+
+def create_program(ctx, rng):
+    return LoadRequest("POST", "/api/programs", json=_new_program(ctx, rng))
+
+
+def bulk_import(ctx, rng):
+    body = "\n".join(json.dumps(_new_program(ctx, rng)) for _ in range(100)).encode()
+    return LoadRequest("POST", "/api/programs/bulk", content=body,
+                       headers={"Content-Type": "application/x-ndjson"})
+
+
+def review_programs(ctx, rng):
+    decisions = [
+        {"program_id": program_id, "decision": "approve" if rng.random() < 0.9 else "reject"}
+        for program_id in rng.sample(ctx.program_ids, min(20, len(ctx.program_ids)))
+    ]
+    return LoadRequest("POST", "/api/programs/approvals", json={"decisions": decisions})
+
+
+def list_programs(ctx, rng):
+    params = {"limit": 100}
+    if rng.random() < 0.7:
+        # Somewhere into the catalogue, as a client paging through it would be
+        params["cursor"] = rng.choice(ctx.program_ids)
+    if rng.random() < 0.3:
+        params["category"] = rng.choice(CATEGORIES)
+    return LoadRequest("GET", "/api/programs", params=params)
+
+
+def list_program_changes(ctx, rng):
+    since = max(0, ctx.latest_version - rng.randrange(200))
+    return LoadRequest("GET", "/api/programs/changes", params={"since": since})
+
+
+def list_occurrences(ctx, rng):
+    start = date(2025, 1, 1) + timedelta(days=rng.randrange(330))
+    return LoadRequest("GET", "/api/programs/occurrences",
+                       params={"from": start.isoformat(), "to": (start + timedelta(days=30)).isoformat()})
+
+
+def programs_near(ctx, rng):
+    lat, lng = place_location(f"place-{rng.randrange(501)}")
+    if rng.random() < 0.5:
+        return LoadRequest("GET", "/api/programs/near", params={"lat": lat, "lng": lng, "radius": 2000})
+    bbox = f"{lat - 0.02},{lng - 0.02},{lat + 0.02},{lng + 0.02}"
+    return LoadRequest("GET", "/api/programs/near", params={"bbox": bbox, "zoom": 14})
+
+
+def get_program(ctx, rng):
+    return LoadRequest("GET", f"/api/programs/{ctx.popular_program(rng)}")
+
+
+def update_program(ctx, rng):
+    return LoadRequest("PUT", f"/api/programs/{rng.choice(ctx.program_ids)}",
+                       json={"description": f"Updated by the load test {rng.getrandbits(32):08x}"})
+
+
+# ---------------------------------------------------------------------------
+# provider_routes
+# ---------------------------------------------------------------------------
+
+def list_providers(ctx, rng):
+    return LoadRequest("GET", "/api/providers")
+
+
+def get_provider(ctx, rng):
+    return LoadRequest("GET", f"/api/providers/{rng.choice(ctx.provider_ids)}")
+
+
+# ---------------------------------------------------------------------------
+# user_routes
+# ---------------------------------------------------------------------------
+
+def get_profile(ctx, rng):
+    return LoadRequest("GET", "/api/profile", headers=_bearer(ctx, rng))
+
+
+def debug_auth(ctx, rng):
+    return LoadRequest("GET", "/api/debug-auth", headers=_bearer(ctx, rng))
+
+
+# ---------------------------------------------------------------------------
+# search_routes
+# ---------------------------------------------------------------------------
+
+def search_catalogue(ctx, rng):
+    return LoadRequest("GET", "/api/search", params={"q": rng.choice(SEARCH_TERMS), "limit": 20})
+
+
+ROUTES: Dict[str, Callable[[LoadContext, random.Random], LoadRequest]] = {
+    "programs.create": create_program,
+    "programs.bulk": bulk_import,
+    "programs.approvals": review_programs,
+    "programs.list": list_programs,
+    "programs.changes": list_program_changes,
+    "programs.occurrences": list_occurrences,
+    "programs.near": programs_near,
+    "programs.get": get_program,
+    "programs.update": update_program,
+    "providers.list": list_providers,
+    "providers.get": get_provider,
+    "users.profile": get_profile,
+    "users.debug_auth": debug_auth,
+    "search": search_catalogue,
+}
+
+MIXES: Dict[str, Dict[str, int]] = {
+    # Public site traffic: mostly reads of popular programs and pages
+    "browse": {
+        "programs.get": 35,
+        "programs.list": 20,
+        "programs.occurrences": 10,
+        "programs.near": 10,
+        "search": 10,
+        "providers.get": 8,
+        "providers.list": 2,
+        "programs.changes": 3,
+        "users.profile": 2,
+    },
+    # Providers and moderators editing the catalogue
+    "moderation": {
+        "programs.create": 20,
+        "programs.update": 30,
+        "programs.approvals": 10,
+        "programs.bulk": 2,
+        "programs.get": 28,
+        "programs.list": 10,
+    },
+    "all": {name: 1 for name in ROUTES},
+}
+
+
+def resolve(name: str) -> Dict[str, int]:
+    """The weighted routes a profile name stands for: a mix, or one route."""
+    if name in MIXES:
+        return MIXES[name]
+    if name in ROUTES:
+        return {name: 1}
+    raise KeyError(f"unknown profile {name!r}; choose from {', '.join([*MIXES, *ROUTES])}")
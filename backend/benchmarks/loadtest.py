@@ -0,0 +1,301 @@
+"""
+Load test the API against the stub PostgREST/GoTrue, and compare runs.
+
+    python benchmarks/loadtest.py run --programs 10000 --profile browse --profile moderation
+    python benchmarks/loadtest.py run --programs 1000000 --profile programs.get --duration 30
+    python benchmarks/loadtest.py compare benchmarks/results/before.json benchmarks/results/after.json
+
+``run`` seeds a stub with ``--programs`` programs, points the app at it and
+drives each profile (a mix from :mod:`benchmarks.load_profiles`, or a single
+route) closed-loop: ``--concurrency`` clients send requests back to back for
+``--duration`` seconds, after ``--warmup`` seconds that are not measured and
+that also let the in-memory indexes load. The report has requests per second,
+error counts and p50/p95/p99 latency per profile and per route, and is written
+as JSON to ``--output`` (by default ``benchmarks/results/<commit>.json``).
+
+By default the app runs in this process, behind httpx's ASGI transport, with
+the stub on a local thread. Client, app and stub then share a CPU, so use the
+numbers to compare commits on one machine, not to size servers. With ``--url``
+it drives a server started separately instead, for example against
+``python benchmarks/stub_postgrest.py --programs N``; pass the same
+``--programs``, ``--providers`` and ``--jwt-secret`` so the ids and tokens match.
+
+``compare`` prints the change in each percentile and in throughput, and
+exits with status 1 if any route's p95 grew by more than ``--threshold``.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+from benchmarks import load_profiles  # noqa: E402
+from benchmarks.stub_postgrest import StubPostgREST, access_token, seed  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+PERCENTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99}
+
+
+def percentile(ordered: list, q: float) -> float:
+    """Linearly interpolated percentile of an already sorted list."""
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarise(latencies: list, statuses: Counter, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    errors = sum(count for status, count in statuses.items() if status is None or status >= 500)
+    latency_ms = {name: round(percentile(ordered, q) * 1000, 3) if ordered else None
+                  for name, q in PERCENTILES.items()}
+    latency_ms["mean"] = round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None
+    latency_ms["max"] = round(ordered[-1] * 1000, 3) if ordered else None
+    return {
+        "requests": len(ordered),
+        "rps": round(len(ordered) / elapsed, 1) if elapsed else None,
+        "errors": errors,
+        "status": {("error" if status is None else str(status)): count for status, count in sorted(
+            statuses.items(), key=lambda item: -1 if item[0] is None else item[0])},
+        "latency_ms": latency_ms,
+    }
+
+
+async def drive(client: httpx.AsyncClient, ctx, mix: dict, concurrency: int, duration: float,
+                warmup: float, rng_seed: int) -> dict:
+    """Run ``mix`` closed-loop and summarise what was measured after the warmup."""
+    routes, weights = list(mix), list(mix.values())
+    latencies = {route: [] for route in routes}
+    statuses = {route: Counter() for route in routes}
+    measure_from = time.perf_counter() + warmup
+    deadline = measure_from + duration
+
+    async def client_loop(n: int):
+        rng = random.Random(rng_seed + n)
+        while True:
+            started = time.perf_counter()
+            if started >= deadline:
+                return
+            route = rng.choices(routes, weights)[0]
+            request = load_profiles.ROUTES[route](ctx, rng)
+            try:
+                response = await client.request(
+                    request.method, request.path, params=request.params, json=request.json,
+                    content=request.content, headers=request.headers,
+                )
+                await response.aread()
+                status = response.status_code
+            except httpx.HTTPError:
+                status = None
+            if started >= measure_from:
+                latencies[route].append(time.perf_counter() - started)
+                statuses[route][status] += 1
+
+    await asyncio.gather(*(client_loop(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - measure_from
+    report = summarise(
+        [latency for route in routes for latency in latencies[route]],
+        sum(statuses.values(), Counter()),
+        elapsed,
+    )
+    report["duration_s"] = round(elapsed, 3)
+    report["routes"] = {route: summarise(latencies[route], statuses[route], elapsed) for route in routes}
+    return report
+
+
+def _revision() -> dict:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD") or None, "dirty": bool(git("status", "--porcelain"))}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+
+def _point_at(stub: StubPostgREST, auth_mode: str):
+    # Set before the app is imported; load_dotenv() leaves existing variables alone
+    os.environ["SUPABASE_URL"] = stub.url
+    os.environ["SUPABASE_ANON_KEY"] = "stub.anon.key"
+    os.environ["SUPABASE_SERVICE_KEY"] = "stub.service.key"
+    os.environ["SUPABASE_JWKS_URL"] = f"{stub.url}/auth/v1/.well-known/jwks.json"
+    os.environ["SUPABASE_JWT_SECRET"] = stub.jwt_secret if auth_mode == "local" else ""
+    # Geo queries use the seeded place_locations, never a real geocoder
+    os.environ["GOOGLE_MAPS_API_KEY"] = ""
+    os.environ["GEOCODER_FIXTURE"] = ""
+
+
+async def _run_profiles(client, ctx, args) -> dict:
+    results = {}
+    for n, name in enumerate(args.profile):
+        mix = load_profiles.resolve(name)
+        results[name] = await drive(client, ctx, mix, args.concurrency, args.duration, args.warmup, args.seed + n * 1000)
+        overall = results[name]
+        print(
+            f"{name:22s} {overall['rps']:9.1f} req/s  p50 {overall['latency_ms']['p50']:8.2f} ms  "
+            f"p95 {overall['latency_ms']['p95']:8.2f} ms  p99 {overall['latency_ms']['p99']:8.2f} ms  "
+            f"errors {overall['errors']}",
+            file=sys.__stdout__,
+        )
+    return results
+
+
+async def _in_process(args, data, tokens, ctx) -> dict:
+    stub = StubPostgREST(data, latency=args.latency, jwt_secret=args.jwt_secret)
+    stub.start()
+    try:
+        _point_at(stub, args.auth)
+        import auth
+        from main import app
+
+        if args.auth == "gotrue":
+            # Every new token is checked with GoTrue's /user, as without a JWT secret
+            auth.JWT_SECRET = None
+        transport = httpx.ASGITransport(app=app)
+        # The routes still print per request; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            async with app.router.lifespan_context(app):
+                async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+                    return await _run_profiles(client, ctx, args)
+    finally:
+        stub.stop()
+
+
+async def _remote(args, ctx) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        return await _run_profiles(client, ctx, args)
+
+
+def run(args):
+    for name in args.profile:
+        load_profiles.resolve(name)
+    started = time.perf_counter()
+    data = seed(programs=args.programs, providers=args.providers, located=True)
+    print(f"seeded {args.programs} programs in {time.perf_counter() - started:.1f}s")
+    tokens = [access_token(args.jwt_secret, email=f"user{i}@example.com") for i in range(args.users)]
+    ctx = load_profiles.LoadContext.from_seed(data, tokens)
+
+    if args.url:
+        del data
+        profiles = asyncio.run(_remote(args, ctx))
+    else:
+        profiles = asyncio.run(_in_process(args, data, tokens, ctx))
+
+    report = {
+        "meta": {
+            **_revision(),
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "target": args.url or "in-process",
+            "settings": {key: getattr(args, key) for key in (
+                "programs", "providers", "latency", "concurrency", "duration", "warmup", "users", "auth", "seed")},
+        },
+        "profiles": profiles,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        revision = report["meta"]["commit"] or "unknown"
+        output = os.path.join(RESULTS_DIR, f"{revision}{'-dirty' if report['meta']['dirty'] else ''}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {output}")
+
+
+def _change(before, after) -> str:
+    if before is None or after is None:
+        return "    n/a"
+    if not before:
+        return "    new"
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{baseline['meta'].get('commit')} -> {candidate['meta'].get('commit')}")
+    if baseline["meta"].get("settings") != candidate["meta"].get("settings"):
+        print("warning: the runs used different settings")
+
+    regressions = []
+    for name, profile in candidate["profiles"].items():
+        before_profile = baseline["profiles"].get(name)
+        if before_profile is None:
+            continue
+        print(f"\n{name}")
+        rows = [("(all)", before_profile, profile)]
+        rows += [(route, before_profile["routes"].get(route), stats) for route, stats in profile["routes"].items()]
+        for route, before, after in rows:
+            if before is None or not before["requests"] or not after["requests"]:
+                continue
+            columns = "  ".join(
+                f"{key} {after['latency_ms'][key]:8.2f} ms {_change(before['latency_ms'][key], after['latency_ms'][key])}"
+                for key in PERCENTILES
+            )
+            print(f"  {route:22s} {columns}  rps {after['rps']:8.1f} {_change(before['rps'], after['rps'])}")
+            p95_before, p95_after = before["latency_ms"]["p95"], after["latency_ms"]["p95"]
+            if p95_before and p95_after > p95_before * (1 + args.threshold):
+                regressions.append(f"{name} {route}")
+
+    if regressions:
+        print(f"\np95 regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run load profiles and write a JSON report")
+    run_parser.add_argument("--profile", action="append",
+                            help=f"mix or route, repeatable: {', '.join([*load_profiles.MIXES, *load_profiles.ROUTES])}")
+    run_parser.add_argument("--programs", type=int, default=10000, help="seeded programs, 1k to 1M")
+    run_parser.add_argument("--providers", type=int, default=50)
+    run_parser.add_argument("--latency", type=float, default=0.005, help="stub round trip in seconds")
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per profile")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per profile")
+    run_parser.add_argument("--users", type=int, default=200, help="distinct bearer tokens")
+    run_parser.add_argument("--auth", choices=["local", "gotrue"], default="local",
+                            help="verify tokens with the JWT secret, or with the stub's GoTrue")
+    run_parser.add_argument("--jwt-secret", default="stub-jwt-secret")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--url", help="drive a running server instead of the app in-process")
+    run_parser.add_argument("--output", help="report path; default benchmarks/results/<commit>.json")
+
+    compare_parser = commands.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.15,
+                                help="p95 growth that counts as a regression (0.15 = 15%%)")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        sys.exit(compare(args))
+    args.profile = args.profile or ["browse"]
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
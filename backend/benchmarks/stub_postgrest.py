@@ -0,0 +1,586 @@
+"""
+In-memory stand-in for Supabase's PostgREST and GoTrue APIs, used by the
+tests and benchmarks.
+
+Implements the subset of PostgREST the backend relies on: column selection
+with one level of embedded resources, the common horizontal filters, ordering,
+limits, inserts/upserts and updates with ``return=representation``, and the
+programs -> providers foreign key. Scans ordered by a primary key or by
+``programs.version`` walk a sorted index and stop at the limit, so keyset
+pages stay cheap on seeded catalogues of up to a million programs.
+
+Under ``/auth/v1`` it answers the GoTrue calls the backend makes: ``user``
+(HS256 tokens signed with ``jwt_secret``, see :meth:`StubPostgREST.issue_token`),
+``token?grant_type=password`` and an empty JWKS. Every request sleeps for
+``latency`` seconds first so the benchmarks see a realistic network round trip.
+"""
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import jwt
+
+CATEGORIES = ["Health", "Education", "Arts", "Sport", "Community", "Employment"]
+INTERVALS = [None, "Daily", "Weekly", "Fortnightly", "Monthly"]
+
+# table -> (primary key, {embedded table: (local column, remote column, many)})
+SCHEMA = {
+    "providers": ("provider_id", {"programs": ("provider_id", "provider_id", True)}),
+    "programs": ("program_id", {"providers": ("provider_id", "provider_id", False)}),
+    "profiles": ("user_id", {}),
+    "place_locations": ("place_id", {}),
+}
+
+
+def place_location(place_id: str) -> tuple:
+    """Coordinates for a seeded place_id, spread over a grid around the Sydney CBD."""
+    n = int(place_id.split("-")[1])
+    return -33.90 + (n % 20) * 0.005, 151.15 + (n // 20) * 0.005
+
+
+def seed(programs: int = 1000, providers: int = 50, rng_seed: int = 42, located: bool = False) -> dict:
+    """
+    Build a deterministic dataset of providers and programs.
+
+    With ``located``, ``place_locations`` already holds coordinates for every
+    place, so geo queries need no geocoder.
+    """
+    rng = random.Random(rng_seed)
+    provider_rows = [
+        {
+            "provider_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "name": f"Provider {i}",
+            "description": f"Community services provider number {i}",
+        }
+        for i in range(providers)
+    ]
+    program_rows = []
+    for i in range(programs):
+        start = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        interval = rng.choice(INTERVALS)
+        program_rows.append({
+            "program_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "name": f"Program {i}",
+            "category": rng.choice(CATEGORIES),
+            "description": f"Weekly community program number {i} in inner Sydney",
+            "start_date": start,
+            "end_date": None,
+            "date_interval": interval,
+            "repeat_interval": rng.randint(1, 12) if interval else None,
+            "place_id": f"place-{rng.randint(0, 500)}" if rng.random() < 0.7 else None,
+            "address": f"{rng.randint(1, 400)} George St, Sydney NSW 2000",
+            "phone": "0400000000",
+            "email": f"program{i}@example.com",
+            "website_url": None,
+            "provider_id": rng.choice(provider_rows)["provider_id"] if provider_rows else None,
+            "is_approved": rng.random() < 0.9,
+            "version": i + 1,
+            "updated_at": "2025-01-01T00:00:00+00:00",
+        })
+    locations = []
+    if located:
+        for n in range(501):
+            lat, lng = place_location(f"place-{n}")
+            locations.append({"place_id": f"place-{n}", "lat": lat, "lng": lng})
+    return {"providers": provider_rows, "programs": program_rows, "profiles": [],
+            "place_locations": locations}
+
+
+def _split_top_level(text: str):
+    depth, current = 0, ""
+    for ch in text:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            yield current.strip()
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        yield current.strip()
+
+
+def _parse_select(select: str):
+    """Return (columns, {embedded table: columns}) for a PostgREST select string."""
+    columns, embeds = [], {}
+    for item in _split_top_level(select or "*"):
+        match = re.fullmatch(r"(\w+)\((.*)\)", item)
+        if match:
+            embeds[match.group(1)] = [c.strip() for c in match.group(2).split(",")]
+        else:
+            columns.append(item)
+    return columns, embeds
+
+
+def _as_text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return None if value is None else str(value)
+
+
+def _sort_key(value):
+    # Numbers compare as numbers, everything else as PostgREST's text form
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return _as_text(value) or ""
+
+
+def _matches(row: dict, column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    op, _, operand = expression.partition(".")
+    value = _as_text(row.get(column))
+    if op in ("gt", "gte", "lt", "lte") and value is not None:
+        value = _sort_key(row.get(column))
+        if not isinstance(value, str):
+            operand = float(operand)
+    if op == "is":
+        result = value is None if operand == "null" else value == operand
+    elif value is None:
+        result = False
+    elif op == "eq":
+        result = value == operand
+    elif op == "neq":
+        result = value != operand
+    elif op == "gt":
+        result = value > operand
+    elif op == "gte":
+        result = value >= operand
+    elif op == "lt":
+        result = value < operand
+    elif op == "lte":
+        result = value <= operand
+    elif op == "in":
+        result = value in [v.strip().strip('"') for v in operand.strip("()").split(",")]
+    elif op == "ilike":
+        pattern = re.escape(operand.replace("*", "%")).replace("%", ".*")
+        result = re.fullmatch(pattern, value, re.IGNORECASE) is not None
+    else:
+        raise ValueError(f"unsupported operator {op}")
+    return not result if negate else result
+
+
+def _filter(row: dict, column: str, expression: str) -> bool:
+    if column == "or":
+        alternatives = _split_top_level(expression.strip("()"))
+        return any(_matches(row, *alt.split(".", 1)) for alt in alternatives)
+    return _matches(row, column, expression)
+
+
+class _Store:
+    def __init__(self, data: dict):
+        self.lock = threading.Lock()
+        self.tables = {name: list(rows) for name, rows in data.items()}
+        self.index = {
+            name: {row[SCHEMA[name][0]]: row for row in rows}
+            for name, rows in self.tables.items()
+        }
+        # Primary keys in order, standing in for each table's btree
+        self.keys = {name: sorted(index) for name, index in self.index.items()}
+        # (version, program_id) in version order, standing in for programs_version_idx;
+        # a program's older entries stay behind and are skipped on read
+        programs = self.tables.get("programs", ())
+        self.versions = sorted(
+            (row["version"], row["program_id"]) for row in programs if row.get("version") is not None
+        )
+        # Stands in for programs_version_seq
+        self.version = self.versions[-1][0] if self.versions else 0
+        # (table, column) -> {value: {primary key: row}} for the foreign keys
+        # one-to-many embeds follow, e.g. a provider's programs
+        self.referencing = {}
+        for _, embeds in SCHEMA.values():
+            for embedded, (_, remote, many) in embeds.items():
+                if many:
+                    self.referencing[(embedded, remote)] = {}
+                    for row in self.tables.get(embedded, ()):
+                        self._reference(embedded, row)
+
+    def _reference(self, table: str, row: dict, add: bool = True):
+        pk = SCHEMA[table][0]
+        for (referencing, column), index in self.referencing.items():
+            if referencing != table:
+                continue
+            if add:
+                index.setdefault(row.get(column), {})[row[pk]] = row
+            else:
+                index.get(row.get(column), {}).pop(row[pk], None)
+
+    def update(self, table: str, row: dict, patch: dict):
+        """Apply ``patch`` to a stored row, keeping the indexes current."""
+        self._reference(table, row, add=False)
+        row.update(patch)
+        self._reference(table, row)
+        self.touch(table, row)
+
+    def touch(self, table: str, row: dict):
+        """Stamp a written program with the next change version, as the trigger does."""
+        if table == "programs":
+            self.version += 1
+            row["version"] = self.version
+            row["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
+            self.versions.append((self.version, row["program_id"]))
+
+    def _sorted_index(self, table: str, column: str):
+        """(sorted entries, entry -> row or None) for an indexed ``column``, else None."""
+        if column == SCHEMA[table][0]:
+            return self.keys[table], self.index[table].get
+        if table == "programs" and column == "version":
+            def live(entry):
+                row = self.index["programs"].get(entry[1])
+                return row if row is not None and row.get("version") == entry[0] else None
+            return self.versions, live
+        return None
+
+    def _ordered(self, table: str, order: str, filters: list):
+        """
+        Rows in ``order`` from an index, starting at any ``gt``/``gte`` bound
+        on the ordering column; None if the order isn't a single indexed column.
+        """
+        if "," in order:
+            return None
+        column, _, direction = order.partition(".")
+        index = self._sorted_index(table, column)
+        if index is None:
+            return None
+        entries, to_row = index
+        if direction.startswith("desc"):
+            positions = range(len(entries) - 1, -1, -1)
+        else:
+            start = 0
+            for col, expression in filters:
+                op, _, operand = expression.partition(".")
+                if col != column or op not in ("gt", "gte"):
+                    continue
+                if entries is self.versions:
+                    # Entries are (version, program_id) pairs
+                    operand = (int(operand), "\uffff" if op == "gt" else "")
+                search = bisect.bisect_right if op == "gt" else bisect.bisect_left
+                start = max(start, search(entries, operand))
+            positions = range(start, len(entries))
+        return (row for row in map(to_row, (entries[i] for i in positions)) if row is not None)
+
+    def project(self, table: str, row: dict, select: str) -> dict:
+        columns, embeds = _parse_select(select)
+        out = dict(row) if "*" in columns else {c: row.get(c) for c in columns}
+        for embedded, embedded_columns in embeds.items():
+            local, remote, many = SCHEMA[table][1][embedded]
+            pick = lambda r: {c: r.get(c) for c in embedded_columns}  # noqa: E731
+            if many:
+                referencing = self.referencing[(embedded, remote)].get(row.get(local), {})
+                out[embedded] = [pick(r) for r in referencing.values()]
+            else:
+                target = self.index[embedded].get(row.get(local))
+                out[embedded] = pick(target) if target else None
+        return out
+
+    def query(self, table: str, params: list):
+        rows = self.tables[table]
+        filters = [(k, v) for k, v in params if k not in {"select", "order", "limit", "offset", "columns", "on_conflict"}]
+        opts = dict(params)
+        pk = SCHEMA[table][0]
+        # Primary key equality is the hot path; serve it from the index
+        for column, expression in filters:
+            if column == pk and expression.startswith("eq."):
+                row = self.index[table].get(expression[3:])
+                rows = [row] if row else []
+            elif column == pk and expression.startswith("in."):
+                wanted = [v.strip().strip('"') for v in expression[3:].strip("()").split(",")]
+                rows = [self.index[table][v] for v in dict.fromkeys(wanted) if v in self.index[table]]
+        offset = int(opts.get("offset", 0))
+        limit = int(opts["limit"]) if "limit" in opts else None
+        ordered = self._ordered(table, opts["order"], filters) if "order" in opts and rows is self.tables[table] else None
+        if ordered is not None:
+            # Walk the index and stop once the page is full
+            page = []
+            for row in ordered:
+                if all(_filter(row, c, e) for c, e in filters):
+                    page.append(row)
+                    if limit is not None and len(page) >= offset + limit:
+                        break
+            return page[offset:]
+        rows = [r for r in rows if all(_filter(r, c, e) for c, e in filters)]
+        if "order" in opts:
+            for clause in reversed(opts["order"].split(",")):
+                column, _, direction = clause.partition(".")
+                rows = sorted(
+                    rows,
+                    key=lambda r: (r.get(column) is None, _sort_key(r.get(column))),
+                    reverse=direction.startswith("desc"),
+                )
+        return rows[offset: offset + limit if limit is not None else None]
+
+    def _check_fk(self, table: str, row: dict):
+        if table == "programs" and row.get("provider_id") is not None:
+            if row["provider_id"] not in self.index["providers"]:
+                return {
+                    "code": "23503",
+                    "message": 'insert or update on table "programs" violates foreign key constraint "programs_provider_id_fkey"',
+                    "details": f'Key (provider_id)=({row["provider_id"]}) is not present in table "providers".',
+                    "hint": None,
+                }
+        return None
+
+    def write(self, table: str, rows: list, upsert: bool, ignore_duplicates: bool):
+        pk = SCHEMA[table][0]
+        # A statement is atomic, so check every row before writing any
+        for incoming in rows:
+            error = self._check_fk(table, incoming)
+            if error:
+                return None, error
+            if not upsert and incoming.get(pk) in self.index[table]:
+                return None, {"code": "23505", "message": "duplicate key value violates unique constraint", "details": None, "hint": None}
+        written = []
+        for incoming in rows:
+            existing = self.index[table].get(incoming.get(pk))
+            if existing is not None:
+                if ignore_duplicates:
+                    continue
+                self.update(table, existing, incoming)
+                written.append(existing)
+                continue
+            row = dict(incoming)
+            row.setdefault(pk, str(uuid.uuid4()))
+            if table == "programs":
+                row.setdefault("is_approved", True)
+            self.touch(table, row)
+            self.tables[table].append(row)
+            self.index[table][row[pk]] = row
+            bisect.insort(self.keys[table], row[pk])
+            self._reference(table, row)
+            written.append(row)
+        return written, None
+
+
+def access_token(secret: str, user_id: str = None, email: str = None, ttl: int = 3600) -> str:
+    """An HS256 access token shaped like GoTrue's, for ``email``'s user unless ``user_id`` is given."""
+    user_id = user_id or str(uuid.uuid5(uuid.NAMESPACE_URL, email or "stub-user"))
+    claims = {
+        "sub": user_id,
+        "email": email or f"{user_id}@example.com",
+        "aud": "authenticated",
+        "role": "authenticated",
+        "exp": int(time.time()) + ttl,
+        "user_metadata": {},
+        "app_metadata": {"provider": "email"},
+    }
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+class StubPostgREST:
+    """Threaded HTTP server answering PostgREST requests under ``/rest/v1``."""
+
+    def __init__(self, data: dict = None, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0,
+                 jwt_secret: str = "stub-jwt-secret"):
+        self.store = _Store(data if data is not None else seed())
+        self.latency = latency
+        self.jwt_secret = jwt_secret
+        self.requests = Counter()
+        # table -> how many of its next requests fail with a 503 from the
+        # gateway, as during an outage (float("inf") for all of them)
+        self.failures = Counter()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def issue_token(self, user_id: str = None, email: str = None, ttl: int = 3600) -> str:
+        """An access token for ``user_id`` as GoTrue would sign it with ``jwt_secret``."""
+        return access_token(self.jwt_secret, user_id, email, ttl)
+
+    def user_for(self, token: str):
+        """The GoTrue user a token belongs to, or None if the token is invalid."""
+        try:
+            claims = jwt.decode(token, self.jwt_secret, algorithms=["HS256"], audience="authenticated")
+        except jwt.PyJWTError:
+            return None
+        return {
+            "id": claims["sub"],
+            "aud": claims["aud"],
+            "role": claims.get("role"),
+            "email": claims.get("email"),
+            "app_metadata": claims.get("app_metadata") or {},
+            "user_metadata": claims.get("user_metadata") or {},
+            "created_at": "2025-01-01T00:00:00+00:00",
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_text(self, status: int, text: str):
+                payload = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _route(self):
+                parts = urlsplit(self.path)
+                table = parts.path.rsplit("/", 1)[-1]
+                params = parse_qsl(parts.query, keep_blank_values=True)
+                return table, params
+
+            def _body(self):
+                return json.loads(self._raw_body or b"null")
+
+            def _handle(self, method: str):
+                # Always drain the body, or the next request on this keep-alive
+                # connection would start mid-payload (postgrest-py sends {} on GET)
+                self._raw_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if self.path.startswith("/auth/v1/"):
+                    return self._auth(method)
+                table, params = self._route()
+                stub.requests[(method, table)] += 1
+                if stub.failures[table] > 0:
+                    stub.failures[table] -= 1
+                    return self._send_text(503, "upstream connect error or disconnect/reset before headers")
+                if table not in SCHEMA:
+                    return self._send(404, {"code": "42P01", "message": f"relation {table} does not exist"})
+                select = dict(params).get("select", "*")
+                prefer = self.headers.get("Prefer", "")
+                with stub.store.lock:
+                    if method == "GET":
+                        rows = stub.store.query(table, params)
+                    elif method == "POST":
+                        body = self._body()
+                        rows, error = stub.store.write(
+                            table,
+                            body if isinstance(body, list) else [body],
+                            upsert="resolution=" in prefer,
+                            ignore_duplicates="ignore-duplicates" in prefer,
+                        )
+                        if error:
+                            return self._send(409, error)
+                    elif method == "PATCH":
+                        patch = self._body()
+                        rows = stub.store.query(table, params)
+                        for row in rows:
+                            error = stub.store._check_fk(table, {**row, **patch})
+                            if error:
+                                return self._send(409, error)
+                        for row in rows:
+                            stub.store.update(table, row, patch)
+                    if method != "GET" and "return=minimal" in prefer:
+                        return self._empty()
+                    body = [stub.store.project(table, row, select) for row in rows]
+                self._send(201 if method == "POST" else 200, body)
+
+            def _auth(self, method: str):
+                parts = urlsplit(self.path)
+                endpoint = parts.path[len("/auth/v1/"):]
+                stub.requests[(method, f"auth/{endpoint}")] += 1
+                if method == "GET" and endpoint == ".well-known/jwks.json":
+                    return self._send(200, {"keys": []})
+                if method == "GET" and endpoint == "user":
+                    token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+                    user = stub.user_for(token)
+                    if user is None:
+                        return self._send(401, {"code": 401, "error_code": "bad_jwt", "msg": "invalid JWT"})
+                    return self._send(200, user)
+                if method == "POST" and endpoint == "token" and dict(parse_qsl(parts.query)).get("grant_type") == "password":
+                    email = self._body().get("email")
+                    token = stub.issue_token(email=email)
+                    return self._send(200, {
+                        "access_token": token,
+                        "token_type": "bearer",
+                        "expires_in": 3600,
+                        "refresh_token": uuid.uuid4().hex,
+                        "user": stub.user_for(token),
+                    })
+                self._send(404, {"code": 404, "msg": f"{endpoint} is not implemented by the stub"})
+
+            def _empty(self):
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+        return Handler
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a seeded stub PostgREST/GoTrue until interrupted.")
+    parser.add_argument("--programs", type=int, default=10000)
+    parser.add_argument("--providers", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.005, help="round trip in seconds")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--jwt-secret", default="stub-jwt-secret")
+    args = parser.parse_args()
+
+    stub = StubPostgREST(
+        seed(programs=args.programs, providers=args.providers, located=True),
+        latency=args.latency, host=args.host, port=args.port, jwt_secret=args.jwt_secret,
+    )
+    print(f"Serving {args.programs} programs on {stub.url}")
+    print(f"  SUPABASE_URL={stub.url} SUPABASE_ANON_KEY=stub SUPABASE_SERVICE_KEY=stub "
+          f"SUPABASE_JWT_SECRET={args.jwt_secret}")
+    try:
+        stub._server.serve_forever(poll_interval=0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
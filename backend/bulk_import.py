@@ -0,0 +1,265 @@
+"""
+Streaming bulk import of programs from CSV or NDJSON.
+
+The request body is decoded and parsed as it arrives, one record at a time.
+Valid rows are grouped into batches and each batch is inserted with a single
+statement, with at most ``concurrency`` batches in flight; parsing waits when
+that limit is reached, so memory stays bounded by ``batch_size *
+concurrency`` rows however large the upload is.
+"""
+import asyncio
+import codecs
+import csv
+import json
+import logging
+from typing import AsyncIterator, Optional
+from uuid import UUID
+
+from postgrest.exceptions import APIError
+from pydantic import ValidationError
+
+import repository
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# A single line longer than this is rejected rather than buffered
+MAX_LINE_CHARS = 1024 * 1024
+
+# Row errors listed in the response; the counts cover every row
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportFormatError(ValueError):
+    """The body can't be read as the declared format; nothing after it is imported."""
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode UTF-8 (with or without a BOM) and split into lines."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    try:
+        async for chunk in chunks:
+            buffer += decoder.decode(chunk)
+            if "\n" not in buffer:
+                if len(buffer) > MAX_LINE_CHARS:
+                    raise ImportFormatError(f"Line longer than {MAX_LINE_CHARS} characters")
+                continue
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                yield line.rstrip("\r")
+        buffer += decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise ImportFormatError("Body is not valid UTF-8")
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple]:
+    """Yield ``(row number, object or error message)`` per non-blank line."""
+    number = 0
+    async for line in _lines(chunks):
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield number, f"Invalid JSON: {e.msg}"
+            continue
+        if not isinstance(record, dict):
+            yield number, "Each line must be a JSON object"
+            continue
+        yield number, record
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple]:
+    """
+    Yield ``(row number, dict or error message)`` per CSV record after the header.
+
+    Quoted fields may span lines. Empty cells are treated as missing, since
+    CSV has no way to write null.
+    """
+    header = None
+    number = 0
+    pending = None
+    async for line in _lines(chunks):
+        pending = line if pending is None else pending + "\n" + line
+        # An odd number of quotes means a quoted field continues on the next line
+        if pending.count('"') % 2:
+            if len(pending) > MAX_LINE_CHARS:
+                raise ImportFormatError("Unterminated quoted field")
+            continue
+        text, pending = pending, None
+        if not text.strip():
+            continue
+        cells = next(csv.reader([text]))
+        if header is None:
+            header = [cell.strip() for cell in cells]
+            if "name" not in header:
+                raise ImportFormatError("CSV header must include a 'name' column")
+            continue
+        number += 1
+        if len(cells) != len(header):
+            yield number, f"Expected {len(header)} columns, found {len(cells)}"
+            continue
+        yield number, {column: cell for column, cell in zip(header, cells) if cell != ""}
+    if pending is not None:
+        raise ImportFormatError("Unterminated quoted field")
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'row'}: {e['msg']}" for e in error.errors()
+    )
+
+
+class ProgramImport:
+    """
+    Validates, batches and inserts one upload's rows, collecting per-row errors.
+
+    ``model`` validates each record (the route passes ``ProgramCreate``).
+    Rows without a provider_id get ``default_provider_id``.
+    """
+
+    def __init__(self, model, batch_size: int = 500, concurrency: int = 4,
+                 default_provider_id: Optional[str] = None):
+        self.model = model
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.default_provider_id = default_provider_id
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        # The first UpstreamUnavailable from a batch; once set, no more rows are read
+        self.unavailable = None
+        # provider_id -> task resolving to the set of ids from its lookup that exist
+        self._provider_lookups = {}
+        self._in_flight = set()
+
+    def _fail(self, number: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": number, "error": message})
+
+    def _validate(self, number: int, record):
+        if isinstance(record, str):
+            self._fail(number, record)
+            return None
+        if self.default_provider_id and not record.get("provider_id"):
+            record["provider_id"] = self.default_provider_id
+        try:
+            program = self.model.model_validate(record)
+        except ValidationError as e:
+            self._fail(number, _describe(e))
+            return None
+        if program.provider_id is not None:
+            try:
+                UUID(program.provider_id)
+            except ValueError:
+                self._fail(number, f"provider_id {program.provider_id} is not a valid UUID")
+                return None
+        return program.model_dump(mode="json", exclude_none=True)
+
+    async def run(self, records: AsyncIterator[tuple]) -> dict:
+        """
+        Import ``records`` and return :meth:`summary`. Raises
+        :class:`resilience.UpstreamUnavailable` if upstream went away: rows
+        read by then were inserted or reported, and the rest were not read.
+        """
+        batch = []
+        try:
+            async for number, record in records:
+                if self.unavailable is not None:
+                    break
+                data = self._validate(number, record)
+                if data is None:
+                    continue
+                batch.append((number, data))
+                if len(batch) >= self.batch_size:
+                    await self._submit(batch)
+                    batch = []
+            if batch and self.unavailable is None:
+                await self._submit(batch)
+        finally:
+            # Let batches already sent finish, even if the body turned out malformed
+            if self._in_flight:
+                await asyncio.wait(self._in_flight)
+        if self.unavailable is not None:
+            raise self.unavailable
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "failed": self.failed,
+            # Validation errors are found while reading, insert errors later
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+    async def _submit(self, batch: list):
+        # Backpressure: stop reading the body while the pipeline is full
+        while len(self._in_flight) >= self.concurrency:
+            await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.create_task(self._write(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _write(self, batch: list):
+        try:
+            batch = await self._check_providers(batch)
+            if batch:
+                await self._insert(batch)
+        except resilience.UpstreamUnavailable as e:
+            # The rows can be sent again once upstream is back
+            self.unavailable = self.unavailable or e
+            for number, _ in batch:
+                self._fail(number, "Upstream unavailable, retry this row")
+        except Exception:
+            logger.exception("Error importing rows", extra={"first_row": batch[0][0], "last_row": batch[-1][0]})
+            for number, _ in batch:
+                self._fail(number, "Internal server error while inserting")
+
+    async def _check_providers(self, batch: list) -> list:
+        """Drop rows whose provider doesn't exist; each provider_id is looked up once."""
+        ids = {data["provider_id"] for _, data in batch if "provider_id" in data}
+        unseen = ids - self._provider_lookups.keys()
+        if unseen:
+            # Batches in flight at the same time share the lookup
+            lookup = asyncio.ensure_future(repository.existing_provider_ids(unseen))
+            for provider_id in unseen:
+                self._provider_lookups[provider_id] = lookup
+        missing = set()
+        for lookup in {self._provider_lookups[provider_id] for provider_id in ids}:
+            covered = {provider_id for provider_id in ids if self._provider_lookups[provider_id] is lookup}
+            try:
+                found = await lookup
+            except Exception:
+                # Let a later batch try these ids again
+                for provider_id in covered:
+                    if self._provider_lookups.get(provider_id) is lookup:
+                        del self._provider_lookups[provider_id]
+                raise
+            missing |= covered - found
+        valid = []
+        for number, data in batch:
+            if data.get("provider_id") in missing:
+                self._fail(number, f"Provider with ID {data['provider_id']} not found")
+            else:
+                valid.append((number, data))
+        return valid
+
+    async def _insert(self, batch: list):
+        """Insert a batch; if the database rejects it, split it to find the bad rows."""
+        try:
+            inserted = await repository.insert_programs([data for _, data in batch])
+        except APIError as e:
+            if len(batch) == 1:
+                self._fail(batch[0][0], e.message or "Rejected by the database")
+                return
+            middle = len(batch) // 2
+            await self._insert(batch[:middle])
+            await self._insert(batch[middle:])
+            return
+        self.inserted += len(inserted)
@@ -0,0 +1,308 @@
+"""
+Small in-process caches shared by the backend modules.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a time-to-live.
+
+    ``maxsize`` bounds the number of entries; the least recently used entry is
+    evicted first. A per-entry ``ttl`` passed to :meth:`set` overrides the
+    default.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _encode(value) -> bytes:
+    return orjson.dumps(value, default=str)
+
+
+def etag_of(encoded: bytes) -> str:
+    """Strong ETag for a serialised value."""
+    return '"' + hashlib.blake2b(encoded, digest_size=16).hexdigest() + '"'
+
+
+class _Entry:
+    __slots__ = ("value", "size", "etag", "fresh_until", "stale_until", "tags")
+
+    def __init__(self, value, size, etag, fresh_until, stale_until, tags):
+        self.value = value
+        self.size = size
+        self.etag = etag
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.tags = tags
+
+
+class ReadThroughCache:
+    """
+    Async read-through cache with TTL, LRU eviction and a byte budget.
+
+    Entries are fresh for ``ttl`` seconds. After that they are served stale for
+    up to ``stale_ttl`` more seconds while one background task reloads them
+    (stale-while-revalidate). Each entry carries tags naming the rows it was
+    built from, so a write can drop exactly the entries it affects with
+    :meth:`invalidate`.
+
+    Each entry also keeps an ETag, a hash of the value computed once when it
+    is stored, so conditional requests can be answered without serialising
+    the value again.
+
+    Concurrent misses on the same key share one load (single flight): the
+    first starts it, the rest await its result and are counted in
+    ``coalesced``. A load started before an invalidation is not joined by
+    requests that arrive after it, so a client reading its own write never
+    gets the row from before it.
+
+    When a load fails with one of ``serve_stale_on`` (upstream unavailable),
+    a request that found an expired entry gets that entry instead of the
+    error, and ``on_serve_stale(key)`` is called; entries are kept past
+    ``stale_ttl`` until evicted or invalidated, so the last known good copy
+    is there for this.
+
+    Cached values are shared between requests and must not be mutated.
+    Invalidation is per process: other workers keep serving their copy until
+    its TTL runs out.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 30.0, stale_ttl: float = 300.0,
+                 serve_stale_on: tuple = (), on_serve_stale=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.serve_stale_on = serve_stale_on
+        self.on_serve_stale = on_serve_stale
+        self.stale_fallbacks = 0
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        # peek() lookups, apart: a batch's misses share one load, so they
+        # would skew the hit ratio of get_or_load
+        self.batch_hits = 0
+        self.batch_misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.coalesced = 0
+        self.coalesced_by_kind = {}
+        self._entries = OrderedDict()
+        self._tags = {}
+        # (key, epoch) -> the task loading it
+        self._flights = {}
+        # Bumped on every invalidation; a load that started before one is
+        # not stored, since it may have read the rows being invalidated
+        self._epoch = 0
+
+    async def get_or_load(self, key, loader, tags=(), with_etag: bool = False):
+        """
+        Return the cached value for ``key``, calling ``await loader()`` on a miss.
+
+        ``tags`` is an iterable of tag strings, or a callable that derives them
+        from the loaded value. With ``with_etag``, return ``(value, etag)``.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.fresh_until:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return (entry.value, entry.etag) if with_etag else entry.value
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._refresh_in_background(key, loader, tags)
+                return (entry.value, entry.etag) if with_etag else entry.value
+
+        self.misses += 1
+        flight = (key, self._epoch)
+        task = self._flights.get(flight)
+        if task is None:
+            task = self._start_flight(flight, key, loader, tags)
+        else:
+            self.coalesced += 1
+            kind = key[0] if isinstance(key, tuple) else key
+            self.coalesced_by_kind[kind] = self.coalesced_by_kind.get(kind, 0) + 1
+        try:
+            # Shielded so one caller going away doesn't cancel the load for the others
+            value, etag = await asyncio.shield(task)
+        except self.serve_stale_on:
+            if entry is None or self._entries.get(key) is not entry:
+                raise
+            self.stale_fallbacks += 1
+            if self.on_serve_stale is not None:
+                self.on_serve_stale(key)
+            value, etag = entry.value, entry.etag
+        return (value, etag) if with_etag else value
+
+    @property
+    def epoch(self) -> int:
+        """Changes on every invalidation; pass it to :meth:`put` for values read after it."""
+        return self._epoch
+
+    def peek(self, key):
+        """The fresh value cached for ``key``, or None; never loads. Counted as a batch lookup."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry.fresh_until:
+            self.batch_misses += 1
+            return None
+        self.batch_hits += 1
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key, value, tags=(), epoch: int = None):
+        """
+        Store a value loaded outside :meth:`get_or_load`, e.g. one row of a
+        batch read. With ``epoch``, it is dropped if anything was invalidated
+        since, as a load would be.
+        """
+        if epoch is not None and epoch != self._epoch:
+            return
+        encoded = _encode(value)
+        self._store(key, value, tags, len(encoded), etag_of(encoded))
+
+    def _start_flight(self, flight, key, loader, tags):
+        task = asyncio.create_task(self._load(key, loader, tags))
+        self._flights[flight] = task
+
+        def done(task):
+            self._flights.pop(flight, None)
+            if not task.cancelled():
+                # Retrieved here so a load nobody is waiting for anymore doesn't log
+                task.exception()
+
+        task.add_done_callback(done)
+        return task
+
+    async def _load(self, key, loader, tags):
+        epoch = self._epoch
+        value = await loader()
+        if value is None:
+            return None, None
+        encoded = _encode(value)
+        etag = etag_of(encoded)
+        if epoch == self._epoch:
+            self._store(key, value, tags(value) if callable(tags) else tags, len(encoded), etag)
+        return value, etag
+
+    def _refresh_in_background(self, key, loader, tags):
+        flight = (key, self._epoch)
+        if flight in self._flights:
+            return
+
+        def failed(task):
+            if not task.cancelled() and task.exception() is not None:
+                # Keep serving the stale copy; the next miss will retry
+                logger.warning("Cache refresh failed", extra={"key": key, "error": str(task.exception())})
+
+        self._start_flight(flight, key, loader, tags).add_done_callback(failed)
+
+    def _store(self, key, value, tags, size, etag):
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        now = time.monotonic()
+        tags = frozenset(tags)
+        self._entries[key] = _Entry(value, size, etag, now + self.ttl, now + self.ttl + self.stale_ttl, tags)
+        self.bytes += size
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of ``tags``."""
+        self._epoch += 1
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self._epoch += 1
+        self._entries.clear()
+        self._tags.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "stale_fallbacks": self.stale_fallbacks,
+            "misses": self.misses,
+            "batch_hits": self.batch_hits,
+            "batch_misses": self.batch_misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "coalesced": self.coalesced,
+            "coalesced_by_kind": dict(self.coalesced_by_kind),
+            "in_flight": len(self._flights),
+        }
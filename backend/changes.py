@@ -0,0 +1,184 @@
+"""
+A compact in-memory log of recent program changes, for delta sync.
+
+Every program row carries a ``version`` drawn from a database sequence on
+each insert and update (see database.sql). A client remembers the cursor it
+was last given and asks for the programs written after it, so a poll
+transfers only what changed instead of the whole catalogue.
+
+:class:`ChangeLog` keeps the latest version of each recently changed program.
+Writes made by this worker are recorded as they happen; writes made by other
+workers are picked up by a range scan on ``version``, run at most once per
+``REFRESH_INTERVAL`` however many clients poll. Cursors older than the log
+are answered with a range scan of their own.
+
+Versions are drawn before a transaction commits, so a lower version can
+become visible after a higher one. The cursor handed out therefore trails
+the newest change by ``SETTLE_SECONDS``: rows written within that window may
+be sent twice, but none are skipped.
+"""
+import asyncio
+import os
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Optional
+
+import repository
+
+# Scan upstream for other workers' writes at most this often
+REFRESH_INTERVAL = float(os.getenv("CHANGE_LOG_REFRESH_INTERVAL", "1"))
+
+# Longest a write may take to commit after drawing its version
+SETTLE_SECONDS = float(os.getenv("CHANGE_LOG_SETTLE_SECONDS", "5"))
+
+# Programs kept in the log; older changes are served by a range scan
+MAX_ENTRIES = int(os.getenv("CHANGE_LOG_MAX_ENTRIES", "10000"))
+
+# Changes in one response; a client further behind than this reloads everything
+MAX_CHANGES = 5000
+
+# Most recent changes read into a new log
+INITIAL_ENTRIES = 1000
+
+SCAN_PAGE_SIZE = 1000
+
+
+class ChangeLog:
+    """
+    The latest version of each recently written program, in version order.
+
+    Invariant: every version at or below ``settled`` and above ``floor`` is
+    in the log, unless the same program has since been written again.
+    """
+
+    def __init__(self):
+        # program_id -> (version, monotonic time it was seen, row)
+        self._entries = {}
+        # (version, program_id), ascending
+        self._versions = []
+        self._floor = None
+        self._settled = None
+        self._refreshed_at = float("-inf")
+        self._lock = asyncio.Lock()
+        repository.on_program_write(self.record)
+
+    @property
+    def loaded(self) -> bool:
+        return self._settled is not None
+
+    def record(self, rows):
+        """Add written rows; before the first load they are left to its scan."""
+        if not self.loaded:
+            return
+        now = time.monotonic()
+        for row in rows:
+            self._put(row, now)
+
+    def _put(self, row: dict, seen_at: float):
+        version = row.get("version")
+        if version is None:
+            return
+        program_id = row["program_id"]
+        current = self._entries.get(program_id)
+        if current is not None:
+            if current[0] >= version:
+                return
+            del self._versions[bisect_left(self._versions, (current[0], program_id))]
+        self._entries[program_id] = (version, seen_at, row)
+        insort(self._versions, (version, program_id))
+
+    async def _ensure_fresh(self):
+        if time.monotonic() - self._refreshed_at > REFRESH_INTERVAL:
+            async with self._lock:
+                if time.monotonic() - self._refreshed_at > REFRESH_INTERVAL:
+                    await (self._refresh() if self.loaded else self._load())
+
+    async def _load(self):
+        started = time.monotonic()
+        rows = await repository.latest_program_changes(INITIAL_ENTRIES)
+        # Only once loaded: a failed load must be retried by the next poll,
+        # not leave the log without a floor for REFRESH_INTERVAL
+        self._refreshed_at = started
+        # Everything at or below the floor is older than the log
+        self._floor = rows[-1]["version"] - 1 if len(rows) == INITIAL_ENTRIES else 0
+        self._settled = self._floor
+        # updated_at is set in the transaction that draws the version, so it
+        # stands in for when rows from before this worker started were seen;
+        # without it the first cursor would be the floor, and the first poll
+        # after a reload would send the whole log again
+        now, seen_at = time.time(), time.monotonic()
+        for row in rows:
+            self._put(row, seen_at - max(0.0, now - _timestamp(row)))
+        self._settle(started)
+
+    async def _refresh(self):
+        started = self._refreshed_at = time.monotonic()
+        # Scan from the settled version, not the newest, to catch late commits
+        after = self._settled
+        while True:
+            rows = await repository.list_program_changes(after, SCAN_PAGE_SIZE)
+            seen_at = time.monotonic()
+            for row in rows:
+                self._put(row, seen_at)
+            if len(rows) < SCAN_PAGE_SIZE:
+                break
+            after = rows[-1]["version"]
+        self._settle(started)
+        self._trim()
+
+    def _settle(self, started: float):
+        # A version seen SETTLE_SECONDS before a scan began was drawn before
+        # then, so anything below it had committed by the time the scan ran
+        # and was read by it
+        cutoff = started - SETTLE_SECONDS
+        for version, program_id in reversed(self._versions):
+            if version <= self._settled:
+                break
+            if self._entries[program_id][1] <= cutoff:
+                self._settled = version
+                break
+
+    def _trim(self):
+        # Only settled changes may go; the floor must stay below the cursor we hand out
+        excess = len(self._versions) - MAX_ENTRIES
+        drop = min(excess, bisect_left(self._versions, (self._settled + 1,)))
+        if drop <= 0:
+            return
+        for _, program_id in self._versions[:drop]:
+            del self._entries[program_id]
+        self._floor = max(self._floor, self._versions[drop - 1][0])
+        del self._versions[:drop]
+
+    async def since(self, cursor: Optional[int]) -> dict:
+        """
+        Programs written after ``cursor``, oldest first, and the cursor to use next.
+
+        ``reset`` means the client must reload the full catalogue, then ask
+        for changes after the returned cursor: on first sync, or when it is
+        more than ``MAX_CHANGES`` behind.
+        """
+        await self._ensure_fresh()
+        reset = {"changes": [], "cursor": self._settled, "reset": True}
+        if cursor is None:
+            return reset
+        if cursor >= self._floor:
+            keys = self._versions[bisect_left(self._versions, (cursor + 1,)):]
+            if len(keys) > MAX_CHANGES:
+                return reset
+            rows = [self._entries[program_id][2] for _, program_id in keys]
+        else:
+            rows = await repository.list_program_changes(cursor, MAX_CHANGES + 1)
+            if len(rows) > MAX_CHANGES:
+                return reset
+        # A cursor from a worker further ahead is kept, so clients never go back
+        return {"changes": rows, "cursor": max(cursor, self._settled), "reset": False}
+
+
+def _timestamp(row: dict) -> float:
+    """``row``'s updated_at as a Unix time; now if it has none."""
+    updated_at = row.get("updated_at")
+    return datetime.fromisoformat(updated_at).timestamp() if updated_at else time.time()
+
+
+log = ChangeLog()
@@ -0,0 +1,120 @@
+"""
+Response compression negotiated from Accept-Encoding.
+
+Brotli is used when the client accepts it and the ``brotli`` package is
+installed, gzip otherwise. Only complete bodies are compressed: streamed
+responses (the SSE feed, exports) pass through untouched, since
+compressing them would hold events back in the compressor's buffer.
+
+A compressed body is a different representation, so its strong ETag gets
+the encoding as a suffix (``"abc-gzip"``). :func:`conditional.etag_matches`
+ignores the suffix, and 304s echo back the tag the client sent.
+"""
+import gzip
+import os
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+# Bodies smaller than this are sent as they are
+MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def _compress(encoding: str, body: bytes) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """The best encoding the client accepts: br, then gzip; None for identity."""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip()] = quality
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    wildcard = accepted.get("*", 0.0)
+    best = max(candidates, key=lambda c: accepted.get(c, wildcard))
+    return best if accepted.get(best, wildcard) > 0 else None
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return etag
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing complete response bodies of ``minimum_size`` bytes or more."""
+
+    def __init__(self, app, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = negotiate(request_headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Hold the headers until the first body chunk shows whether it streams
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            response_start, start = start, None
+            headers = MutableHeaders(raw=response_start["headers"])
+            body = message.get("body", b"")
+            if response_start["status"] == 304:
+                self._echo_etag(headers, request_headers, encoding)
+            elif (
+                not message.get("more_body", False)
+                and len(body) >= self.minimum_size
+                and "content-encoding" not in headers
+                and not headers.get("content-type", "").startswith("text/event-stream")
+            ):
+                body = _compress(encoding, body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                if "etag" in headers:
+                    headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                message = {**message, "body": body}
+            if not headers.get("content-type", "").startswith("text/event-stream"):
+                headers.add_vary_header("Accept-Encoding")
+            await send(response_start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def _echo_etag(headers: MutableHeaders, request_headers: Headers, encoding: str):
+        # The client revalidated the compressed copy; confirm that tag
+        etag = headers.get("etag")
+        if etag and encoded_etag(etag, encoding) in request_headers.get("if-none-match", ""):
+            headers["ETag"] = encoded_etag(etag, encoding)
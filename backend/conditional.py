@@ -0,0 +1,50 @@
+"""
+Conditional GET support for the catalogue read routes.
+
+Routes get an ETag for the data they serve from the read cache (see
+:meth:`cache.ReadThroughCache.get_or_load`) and call :func:`not_modified`
+before building the response body, so a client whose copy is current gets a
+304 without the body being serialised.
+"""
+from typing import Optional
+
+from fastapi import Request, Response
+
+
+# Suffixes compression.py adds to the ETags of compressed bodies
+_ENCODING_SUFFIXES = ('-gzip"', '-br"')
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip().removeprefix("W/")
+    for suffix in _ENCODING_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    ``If-None-Match`` comparison; weak, as RFC 9110 requires for this header.
+
+    A compressed copy's ETag matches the ETag of the body it was made from.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = _opaque(etag)
+    return any(_opaque(tag) == opaque for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, response: Response, etag: str, cache_control: str) -> Optional[Response]:
+    """
+    Put the validators on ``response``, and return a 304 if the client's copy is current.
+
+    The 304 repeats ETag and Cache-Control so caches can refresh their copy's lifetime.
+    """
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -1,16 +1,28 @@
 import os
+from functools import lru_cache
+
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Supabase
-# Public client, for operations that need user-level permissions
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_anon_key = os.getenv("SUPABASE_ANON_KEY")
-supabase: Client = create_client(supabase_url, supabase_anon_key)
-
-# Admin client, for operations requiring service-level permissions
 supabase_service_key = os.getenv("SUPABASE_SERVICE_KEY")
-supabase_admin: Client = create_client(supabase_url, supabase_service_key)
\ No newline at end of file
+
+
+# Clients are created on first use, in the process that uses them. The
+# production server imports the app once and forks its workers from that
+# process, and connection pools must not be shared between processes.
+
+@lru_cache(maxsize=None)
+def public_client() -> Client:
+    """Public client, for operations that need user-level permissions."""
+    return create_client(supabase_url, supabase_anon_key)
+
+
+@lru_cache(maxsize=None)
+def admin_client() -> Client:
+    """Admin client, for operations requiring service-level permissions."""
+    return create_client(supabase_url, supabase_service_key)
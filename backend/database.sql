@@ -6,6 +6,10 @@ CREATE TABLE providers (
     description TEXT
 );
 
+-- Every insert or update of a program takes the next value, so clients can
+-- ask for the rows changed after the last version they saw
+CREATE SEQUENCE programs_version_seq;
+
 CREATE TABLE programs (
     program_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     name TEXT NOT NULL,
@@ -22,6 +26,8 @@ CREATE TABLE programs (
     address TEXT,
     category TEXT,
     is_approved BOOLEAN DEFAULT TRUE,
+    version BIGINT NOT NULL DEFAULT nextval('programs_version_seq'),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
     FOREIGN KEY (provider_id) REFERENCES providers(provider_id) ON DELETE CASCADE
 );
 
@@ -30,4 +36,32 @@ CREATE TABLE profiles (
     email TEXT,
     created_at TIMESTAMPTZ,
     role TEXT DEFAULT 'user'
-);
\ No newline at end of file
+);
+-- Filter and pagination columns used by GET /api/programs
+CREATE INDEX programs_provider_id_idx ON programs (provider_id);
+CREATE INDEX programs_category_idx ON programs (category);
+CREATE INDEX programs_is_approved_idx ON programs (is_approved);
+CREATE INDEX programs_start_date_idx ON programs (start_date);
+
+-- Change feed for GET /api/programs/changes: a range scan on version
+CREATE INDEX programs_version_idx ON programs (version);
+
+CREATE FUNCTION programs_touch() RETURNS trigger AS $$
+BEGIN
+    NEW.version := nextval('programs_version_seq');
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER programs_touch BEFORE UPDATE ON programs
+    FOR EACH ROW EXECUTE FUNCTION programs_touch();
+
+-- Coordinates resolved once per Google place_id by the backend geocoder;
+-- lat/lng are NULL for place_ids the geocoder could not resolve
+CREATE TABLE place_locations (
+    place_id TEXT PRIMARY KEY,
+    lat DOUBLE PRECISION,
+    lng DOUBLE PRECISION,
+    resolved_at TIMESTAMPTZ DEFAULT now()
+);
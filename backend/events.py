@@ -0,0 +1,203 @@
+"""
+Live program change feed for Server-Sent Events.
+
+:class:`ProgramFeed` is a per-worker pub/sub bus. Program writes made by this
+worker are published as they happen, through
+:func:`repository.on_program_write`; writes made by other workers are found
+by a single pump task polling the change log (:mod:`changes`), which runs
+only while someone is subscribed.
+
+Each subscriber has a bounded queue. One that falls behind loses its queue
+instead of holding events for ever, and catches up from the change log, the
+same way a reconnecting client does with ``Last-Event-ID``. Event ids are
+change-log cursors, so resuming from any id may resend programs but never
+skips one.
+"""
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import changes
+import health
+import metrics
+import repository
+import serialization
+
+logger = logging.getLogger(__name__)
+
+# Events queued per subscriber before it is switched to catching up from the log
+QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+
+# Comment line sent on idle connections so proxies don't time them out
+HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# How often the pump looks for other workers' writes
+POLL_SECONDS = float(os.getenv("STREAM_POLL_SECONDS", "1"))
+
+# Reconnect delay suggested to EventSource clients
+RETRY_MS = 3000
+
+
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append(f"data: {serialization.dumps(data).decode()}")
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription:
+    """One client's connection: a bounded queue, or a cursor to catch up from."""
+
+    def __init__(self, feed: "ProgramFeed", cursor: Optional[int]):
+        self.feed = feed
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        # Resume point; the stream replays the change log after it while lagging
+        self.cursor = cursor
+        self.lagging = cursor is not None
+        self.closed = False
+
+    def offer(self, event_id: int, program: dict):
+        if self.lagging:
+            return
+        try:
+            self.queue.put_nowait((event_id, program))
+        except asyncio.QueueFull:
+            # Too slow to keep up; replay from the log instead of buffering more
+            self.fall_behind()
+
+    def close(self):
+        """End the stream after the event it is sending, if any."""
+        self.closed = True
+        try:
+            # Wake the stream if it is waiting for an event
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            # Then it isn't waiting
+            pass
+
+    def fall_behind(self):
+        """Drop queued events and catch up from the change log after ``cursor``."""
+        self.lagging = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        # Wake the stream if it is waiting for an event
+        self.queue.put_nowait(None)
+
+    async def _catch_up(self):
+        # Live events queue up again from here; the replay may repeat some
+        self.lagging = False
+        result = await changes.log.since(self.cursor)
+        if result["reset"]:
+            yield format_event("reset", {"cursor": result["cursor"]}, result["cursor"])
+        else:
+            for row in result["changes"]:
+                # Rows come oldest first, so everything up to this version has been sent
+                yield format_event("program", serialization.program_out(row), min(row["version"], result["cursor"]))
+        self.cursor = result["cursor"]
+
+    async def stream(self):
+        """Yield SSE messages until the client disconnects or the worker shuts down."""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while not self.closed:
+                if self.lagging:
+                    async for message in self._catch_up():
+                        yield message
+                    continue
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event is None:
+                    continue
+                event_id, program = event
+                self.cursor = event_id
+                yield format_event("program", program, event_id)
+        finally:
+            self.feed.unsubscribe(self)
+
+
+class ProgramFeed:
+    """Fans program changes out to every subscriber on this worker."""
+
+    def __init__(self):
+        self._subscribers = set()
+        # program_id -> version last published, so the pump skips what was pushed already
+        self._published = {}
+        self._cursor = None
+        self._pump = None
+        repository.on_program_write(self.publish)
+        health.on_drain(self.close)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    async def subscribe(self, last_event_id: Optional[int] = None) -> Subscription:
+        """
+        Subscribe from now on, or from ``last_event_id`` when resuming.
+
+        A fresh subscriber's events are ids from the current cursor, so it can
+        resume later even if nothing has changed yet.
+        """
+        if self._cursor is None:
+            cursor = (await changes.log.since(None))["cursor"]
+            # Changes from before the first subscriber are history, not news
+            for row in (await changes.log.since(cursor))["changes"]:
+                self._published[row["program_id"]] = row["version"]
+            self._cursor = cursor
+        subscription = Subscription(self, last_event_id)
+        if last_event_id is None:
+            subscription.cursor = self._cursor
+        self._subscribers.add(subscription)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def close(self):
+        """
+        End every stream, as the worker shuts down. EventSource clients
+        reconnect, to another worker, and resume from their Last-Event-ID.
+        """
+        for subscription in self._subscribers:
+            subscription.close()
+
+    def publish(self, rows):
+        """Send written rows to every subscriber; older versions than already sent are skipped."""
+        if not self._subscribers:
+            return
+        for row in rows:
+            version = row.get("version")
+            if version is not None:
+                if version <= self._published.get(row["program_id"], 0):
+                    continue
+                self._published[row["program_id"]] = version
+            program = serialization.program_out(row)
+            for subscription in self._subscribers:
+                subscription.offer(self._cursor, program)
+
+    async def _run(self):
+        # Pick up other workers' writes while anyone is listening
+        while self._subscribers:
+            try:
+                result = await changes.log.since(self._cursor)
+                if result["reset"]:
+                    # Too much changed to publish; each subscriber catches up on its own
+                    for subscription in self._subscribers:
+                        subscription.fall_behind()
+                else:
+                    self.publish(result["changes"])
+                self._cursor = result["cursor"]
+            except Exception:
+                logger.exception("Program feed poll failed")
+            await asyncio.sleep(POLL_SECONDS)
+
+
+feed = ProgramFeed()
+
+metrics.CallbackMetric("program_stream_subscribers", "Open GET /api/stream/programs connections.",
+                       lambda: len(feed._subscribers))
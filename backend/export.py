@@ -0,0 +1,283 @@
+"""
+Whole-catalogue exports, for partners who mirror it.
+
+    GET /api/export/programs.ndjson   one program per line, as GET /api/programs/{id} returns it
+    GET /api/export/programs.csv      a header row, then one row per program
+    GET /api/export/programs.ics      an iCalendar feed with a VEVENT per occurrence
+
+A body is produced by a pipeline of async generators: keyset pages from
+:func:`repository.scan_program_pages`, each encoded into one chunk, sent as
+it is ready. Only about one page is in memory at a time, however large the
+catalogue.
+
+While a body streams, it is also written to a snapshot file under
+``EXPORT_DIR``. The file is named after the catalogue version it was read
+at (the highest program ``version``) and the hash of its bytes, which is its
+ETag. A later request for the same format, while the version hasn't changed
+and the snapshot is younger than ``EXPORT_SNAPSHOT_MAX_AGE``, is answered
+from the file (or with a 304) after one indexed query. The age limit covers
+changes that don't move the version: deleted programs and renamed providers.
+Workers on one host share the directory.
+"""
+import contextlib
+import csv
+import glob
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import recurrence
+import repository
+import serialization
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(tempfile.gettempdir(), "catalogue-export")
+SNAPSHOT_MAX_AGE = float(os.getenv("EXPORT_SNAPSHOT_MAX_AGE", "3600"))
+PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+# Bytes per read when sending a snapshot file
+READ_CHUNK = 256 * 1024
+
+# Program's fields, in order
+CSV_COLUMNS = (
+    "program_id", "name", "category", "description", "start_date", "end_date", "date_interval",
+    "repeat_interval", "place_id", "address", "phone", "email", "website_url", "provider_id",
+    "provider_name", "is_approved", "version", "updated_at",
+)
+
+ICS_PRODUCT = "-//Programs Catalogue//Export//EN"
+# VEVENT text properties, from program fields
+ICS_PROPERTIES = (("DESCRIPTION", "description"), ("LOCATION", "address"), ("CATEGORIES", "category"))
+# Longest iCalendar content line, in octets, before it is folded
+ICS_LINE_LIMIT = 75
+
+
+def _ndjson_page(rows: list) -> bytes:
+    return b"".join(serialization.dumps(serialization.program_out(row)) + b"\n" for row in rows)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+def _csv_lines(rows) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\r\n")
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _csv_page(rows: list) -> bytes:
+    return _csv_lines(
+        [_csv_value(program.get(column)) for column in CSV_COLUMNS]
+        for program in map(serialization.program_out, rows)
+    )
+
+
+def _ics_text(value) -> str:
+    """Escape a TEXT value (RFC 5545 3.3.11)."""
+    return (
+        str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+        .replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n")
+    )
+
+
+def _ics_line(line: str) -> str:
+    """``line`` with CRLF, folded so no line is longer than 75 octets (RFC 5545 3.1)."""
+    encoded = line.encode()
+    if len(encoded) <= ICS_LINE_LIMIT:
+        return line + "\r\n"
+    parts, start, limit = [], 0, ICS_LINE_LIMIT
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Don't split a UTF-8 sequence: back up off continuation bytes
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start = end
+        # Continuation lines start with a space, which counts towards the limit
+        limit = ICS_LINE_LIMIT - 1
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _ics_stamp(program: dict) -> str:
+    updated_at = program.get("updated_at")
+    if updated_at:
+        stamp = datetime.fromisoformat(updated_at).astimezone(timezone.utc)
+    else:
+        stamp = datetime.fromisoformat(program["start_date"]).replace(tzinfo=timezone.utc)
+    return stamp.strftime("%Y%m%dT%H%M%SZ")
+
+
+def _ics_events(row: dict) -> str:
+    program = serialization.program_out(row)
+    lines = []
+    stamp = None
+    for i, start, end in recurrence.expand(program):
+        stamp = stamp or _ics_stamp(program)
+        lines.append("BEGIN:VEVENT")
+        lines.append(f"UID:{program['program_id']}-{i}@programs")
+        lines.append(f"DTSTAMP:{stamp}")
+        lines.append(f"DTSTART;VALUE=DATE:{start:%Y%m%d}")
+        # All-day events end on the day after (exclusive)
+        lines.append(f"DTEND;VALUE=DATE:{end + timedelta(days=1):%Y%m%d}")
+        lines.append(f"SUMMARY:{_ics_text(program['name'])}")
+        for name, column in ICS_PROPERTIES:
+            if program.get(column):
+                lines.append(f"{name}:{_ics_text(program[column])}")
+        if program.get("website_url"):
+            lines.append(f"URL:{program['website_url']}")
+        lines.append("END:VEVENT")
+    return "".join(map(_ics_line, lines))
+
+
+def _ics_page(rows: list) -> bytes:
+    return "".join(map(_ics_events, rows)).encode()
+
+
+class Format:
+    """How one export format is laid out: what comes before, per page and after the programs."""
+
+    def __init__(self, media_type: str, encode_page, head: bytes = b"", tail: bytes = b""):
+        self.media_type = media_type
+        self.encode_page = encode_page
+        self.head = head
+        self.tail = tail
+
+
+FORMATS = {
+    "ndjson": Format("application/x-ndjson", _ndjson_page),
+    "csv": Format("text/csv; charset=utf-8", _csv_page, head=_csv_lines([CSV_COLUMNS])),
+    "ics": Format(
+        "text/calendar; charset=utf-8",
+        _ics_page,
+        head="".join(map(_ics_line, [
+            "BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{ICS_PRODUCT}", "CALSCALE:GREGORIAN",
+        ])).encode(),
+        tail=_ics_line("END:VCALENDAR").encode(),
+    ),
+}
+
+
+async def encode(fmt: str, page_size: Optional[int] = None):
+    """Yield the export in ``fmt`` as byte chunks, one per page of programs."""
+    layout = FORMATS[fmt]
+    page_size = page_size or PAGE_SIZE
+    if layout.head:
+        yield layout.head
+    async for rows in repository.scan_program_pages(page_size=page_size):
+        yield layout.encode_page(rows)
+    if layout.tail:
+        yield layout.tail
+
+
+class Snapshot:
+    """An open snapshot file; :meth:`chunks` sends it and closes it."""
+
+    def __init__(self, file, etag: str, size: int):
+        self.file = file
+        self.etag = etag
+        self.size = size
+
+    async def chunks(self):
+        try:
+            while True:
+                chunk = await repository.run(self.file.read, READ_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            self.file.close()
+
+    def close(self):
+        self.file.close()
+
+
+class SnapshotStore:
+    """Snapshot files ``programs-<version>-<hash>.<format>`` in one directory."""
+
+    def __init__(self, directory: str = EXPORT_DIR, max_age: float = SNAPSHOT_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        # (format, version) being written by this worker
+        self._writing = set()
+
+    def _paths(self, fmt: str, version: Optional[int] = None) -> list:
+        prefix = "programs-*" if version is None else f"programs-{version}-*"
+        return glob.glob(os.path.join(glob.escape(self.directory), f"{prefix}.{fmt}"))
+
+    def open(self, fmt: str, version: Optional[int], max_age: Optional[float] = None) -> Optional[Snapshot]:
+        """
+        The snapshot of ``fmt`` at ``version`` (the newest of any version if
+        None), if there is one younger than ``max_age``; opened, so it can
+        be read to the end even if a newer one replaces it meanwhile.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        newest = None
+        for path in self._paths(fmt, version):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if time.time() - stat.st_mtime <= max_age and (newest is None or stat.st_mtime > newest[1]):
+                newest = path, stat.st_mtime
+        if newest is None:
+            return None
+        path = newest[0]
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        digest = os.path.basename(path).rsplit(".", 1)[0].rsplit("-", 1)[1]
+        return Snapshot(file, f'"{digest}"', os.fstat(file.fileno()).st_size)
+
+    async def stream(self, fmt: str, version: int):
+        """
+        Yield the export from upstream, saving it as the snapshot for
+        ``version`` once it has all been sent. Only one request per worker
+        saves a given snapshot; others just stream.
+        """
+        key = (fmt, version)
+        if key in self._writing:
+            async for chunk in encode(fmt):
+                yield chunk
+            return
+
+        self._writing.add(key)
+        os.makedirs(self.directory, exist_ok=True)
+        partial = os.path.join(self.directory, f".programs-{version}-{uuid.uuid4().hex}.{fmt}.partial")
+        file = open(partial, "wb")
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            async for chunk in encode(fmt):
+                digest.update(chunk)
+                await repository.run(file.write, chunk)
+                yield chunk
+            file.close()
+            final = os.path.join(self.directory, f"programs-{version}-{digest.hexdigest()}.{fmt}")
+            os.replace(partial, final)
+            logger.info("Export snapshot saved", extra={"format": fmt, "version": version})
+            for old in self._paths(fmt):
+                if old != final:
+                    # Readers that have it open keep reading it; another worker may have removed it
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(old)
+        finally:
+            self._writing.discard(key)
+            file.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+
+
+snapshots = SnapshotStore()
@@ -0,0 +1,165 @@
+"""
+Facet counts for the programs page: how many programs match the active
+filters, by category, provider, approval status and month of start_date.
+
+:class:`FacetIndex` keeps the counts themselves, not the programs. Programs
+with the same category, provider, approval status, place presence and start
+month share a cell holding how many start on each day, so a request sums a
+few hundred cells instead of scanning the catalogue, and a write moves one
+program between two cells.
+
+Each facet is counted under every active filter except its own, so picking a
+category still shows how many programs the other categories have.
+"""
+import os
+from collections import Counter
+from datetime import date
+from typing import Optional
+
+from program_index import ProgramIndex
+
+# Rebuild the counts from upstream this often, to pick up writes made by other workers
+INDEX_MAX_AGE = float(os.getenv("FACET_INDEX_MAX_AGE", "300"))
+
+FACET_COLUMNS = "program_id, category, provider_id, is_approved, place_id, start_date, providers(name)"
+
+
+class _Cell:
+    """Programs sharing every facet value, counted by start_date."""
+
+    __slots__ = ("total", "days")
+
+    def __init__(self):
+        self.total = 0
+        self.days = Counter()
+
+    def between(self, month: Optional[str], low: Optional[str], high: Optional[str]) -> int:
+        """How many start between ``low`` and ``high`` (ISO dates, inclusive, None for open)."""
+        if low is None and high is None:
+            return self.total
+        if month is None:
+            # No start_date never matches a date filter
+            return 0
+        first, last = f"{month}-01", f"{month}-31"
+        if (low is None or low <= first) and (high is None or last <= high):
+            return self.total
+        if (low is not None and last < low) or (high is not None and first > high):
+            return 0
+        return sum(
+            count for day, count in self.days.items()
+            if (low is None or day >= low) and (high is None or day <= high)
+        )
+
+
+def _ranked(counts: Counter) -> list:
+    return sorted(
+        ({"value": value, "count": count} for value, count in counts.items() if count),
+        key=lambda entry: (-entry["count"], entry["value"] is None, str(entry["value"])),
+    )
+
+
+class FacetIndex(ProgramIndex):
+    """Keeps the facet counts in step with program writes."""
+
+    columns = FACET_COLUMNS
+
+    def __init__(self):
+        # (category, provider_id, is_approved, has_place, start month) -> _Cell
+        self._cells = {}
+        # program_id -> (cell key, start_date), to take it out again
+        self._programs = {}
+        self._provider_names = {}
+        super().__init__(max_age=INDEX_MAX_AGE)
+
+    def reset(self):
+        self._cells = {}
+        self._programs = {}
+        self._provider_names = {}
+
+    def add(self, row: dict):
+        start = row.get("start_date")
+        key = (
+            row.get("category"),
+            row.get("provider_id"),
+            row.get("is_approved"),
+            bool(row.get("place_id")),
+            start[:7] if start else None,
+        )
+        cell = self._cells.get(key)
+        if cell is None:
+            cell = self._cells[key] = _Cell()
+        cell.total += 1
+        cell.days[start] += 1
+        self._programs[row["program_id"]] = (key, start)
+        provider = row.get("providers")
+        if provider and row.get("provider_id"):
+            self._provider_names[row["provider_id"]] = provider.get("name")
+
+    def discard(self, program_id: str):
+        entry = self._programs.pop(program_id, None)
+        if entry is None:
+            return
+        key, start = entry
+        cell = self._cells[key]
+        cell.total -= 1
+        cell.days[start] -= 1
+        if not cell.days[start]:
+            del cell.days[start]
+        if not cell.total:
+            del self._cells[key]
+
+    async def counts(
+        self,
+        *,
+        category: str = None,
+        provider_id: str = None,
+        is_approved: bool = None,
+        has_place: bool = None,
+        start_date_from: date = None,
+        start_date_to: date = None,
+    ) -> dict:
+        """Facet counts under the same filters as ``GET /api/programs``."""
+        await self.ensure_loaded()
+        low = start_date_from.isoformat() if start_date_from else None
+        high = start_date_to.isoformat() if start_date_to else None
+
+        total = 0
+        by_category, by_provider, by_approval, by_month = Counter(), Counter(), Counter(), Counter()
+        for (cell_category, cell_provider, cell_approved, cell_placed, month), cell in self._cells.items():
+            if has_place is not None and cell_placed != has_place:
+                continue
+            category_ok = category is None or cell_category == category
+            provider_ok = provider_id is None or cell_provider == provider_id
+            approval_ok = is_approved is None or cell_approved == is_approved
+            if category_ok and provider_ok and approval_ok:
+                by_month[month] += cell.total
+            if category_ok + provider_ok + approval_ok < 2:
+                # Counts toward no facet: every one has another filter it fails
+                continue
+            in_range = cell.between(month, low, high)
+            if provider_ok and approval_ok:
+                by_category[cell_category] += in_range
+            if category_ok and approval_ok:
+                by_provider[cell_provider] += in_range
+            if category_ok and provider_ok:
+                by_approval[cell_approved] += in_range
+                if approval_ok:
+                    total += in_range
+
+        return {
+            "total": total,
+            "category": _ranked(by_category),
+            "provider": [
+                {"provider_id": entry["value"], "name": self._provider_names.get(entry["value"]),
+                 "count": entry["count"]}
+                for entry in _ranked(by_provider)
+            ],
+            "is_approved": _ranked(by_approval),
+            "start_month": sorted(
+                ({"value": month, "count": count} for month, count in by_month.items() if count),
+                key=lambda entry: (entry["value"] is None, entry["value"] or ""),
+            ),
+        }
+
+
+aggregates = FacetIndex()
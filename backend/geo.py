@@ -0,0 +1,356 @@
+"""
+Program locations: a geocode cache and an in-memory spatial index.
+
+Programs reference a Google ``place_id``. Each place_id is resolved to
+coordinates once, through a pluggable :class:`Geocoder`, and persisted in the
+``place_locations`` table so later loads (and other workers) never call the
+geocoder for it again. Located programs are kept in a uniform lat/lng grid, so
+bounding-box and radius queries only look at the cells they cover.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+from collections import defaultdict
+from typing import Optional, Protocol
+
+import httpx
+
+import repository
+from program_index import ProgramIndex
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6_371_000.0
+METRES_PER_DEGREE_LAT = 111_320.0
+
+# Grid cell edge in degrees; 0.01 is about 1.1 km north-south
+CELL_DEGREES = float(os.getenv("GEO_CELL_DEGREES", "0.01"))
+
+# Rebuild the index from upstream this often, to pick up writes made by other workers
+INDEX_MAX_AGE = float(os.getenv("GEO_INDEX_MAX_AGE", "300"))
+
+# Geocoder calls in flight at once while resolving new place_ids
+GEOCODE_CONCURRENCY = int(os.getenv("GEOCODE_CONCURRENCY", "8"))
+
+# Clusters per 256px map tile edge, i.e. one cluster cell is about 64px wide
+CLUSTER_CELLS_PER_TILE = 4
+
+GEO_COLUMNS = "program_id, name, category, address, place_id, providers(name)"
+
+
+class Geocoder(Protocol):
+    def resolve(self, place_id: str) -> Optional[tuple]:
+        """Return ``(lat, lng)`` for ``place_id``, or None if it doesn't exist."""
+
+
+class GooglePlacesGeocoder:
+    """Resolves place_ids with a Place Details (New) request for ``location`` only."""
+
+    URL = "https://places.googleapis.com/v1/places/{place_id}"
+
+    def __init__(self, api_key: str, timeout: float = 5.0):
+        self._client = httpx.Client(
+            timeout=timeout,
+            headers={"X-Goog-Api-Key": api_key, "X-Goog-FieldMask": "location"},
+        )
+
+    def resolve(self, place_id: str) -> Optional[tuple]:
+        response = self._client.get(self.URL.format(place_id=place_id))
+        if response.status_code in (400, 404):
+            # Malformed or unknown place_id; remember it as unresolvable
+            return None
+        response.raise_for_status()
+        location = response.json().get("location")
+        if not location:
+            return None
+        return location["latitude"], location["longitude"]
+
+
+class FixtureGeocoder:
+    """Resolves place_ids from a fixed mapping; stands in for Google in tests."""
+
+    def __init__(self, locations: dict):
+        self.locations = {place_id: tuple(latlng) for place_id, latlng in locations.items()}
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> "FixtureGeocoder":
+        """Load ``{"place_id": [lat, lng], ...}`` from a JSON file."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def resolve(self, place_id: str) -> Optional[tuple]:
+        self.calls += 1
+        return self.locations.get(place_id)
+
+
+def geocoder_from_env() -> Optional[Geocoder]:
+    """GEOCODER_FIXTURE names a fixture file; otherwise Google if a key is set."""
+    fixture = os.getenv("GEOCODER_FIXTURE")
+    if fixture:
+        return FixtureGeocoder.from_file(fixture)
+    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+    if api_key:
+        return GooglePlacesGeocoder(api_key)
+    return None
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance in metres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """
+    Uniform grid of points keyed by ``(floor(lat / cell), floor(lng / cell))``.
+
+    A query visits only the cells overlapping its box, or every occupied cell
+    when that is fewer (very large boxes).
+    """
+
+    def __init__(self, cell: float = CELL_DEGREES):
+        self.cell = cell
+        self._cells = defaultdict(set)
+        self._points = {}
+
+    def _cell_of(self, lat: float, lng: float) -> tuple:
+        return math.floor(lat / self.cell), math.floor(lng / self.cell)
+
+    def put(self, key, lat: float, lng: float):
+        self.remove(key)
+        self._points[key] = (lat, lng)
+        self._cells[self._cell_of(lat, lng)].add(key)
+
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        cell = self._cell_of(*point)
+        keys = self._cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cells[cell]
+
+    def get(self, key) -> Optional[tuple]:
+        return self._points.get(key)
+
+    def within_bbox(self, south: float, west: float, north: float, east: float):
+        """Yield ``(key, lat, lng)`` inside the box; ``west > east`` crosses the antimeridian."""
+        if west > east:
+            yield from self.within_bbox(south, west, north, 180.0)
+            yield from self.within_bbox(south, -180.0, north, east)
+            return
+        row_lo, col_lo = self._cell_of(south, west)
+        row_hi, col_hi = self._cell_of(north, east)
+        if (row_hi - row_lo + 1) * (col_hi - col_lo + 1) > len(self._cells):
+            cells = [c for c in self._cells if row_lo <= c[0] <= row_hi and col_lo <= c[1] <= col_hi]
+        else:
+            cells = [(r, c) for r in range(row_lo, row_hi + 1) for c in range(col_lo, col_hi + 1)]
+        for cell in cells:
+            for key in self._cells.get(cell, ()):
+                lat, lng = self._points[key]
+                if south <= lat <= north and west <= lng <= east:
+                    yield key, lat, lng
+
+    def within_radius(self, lat: float, lng: float, radius_m: float):
+        """Yield ``(key, lat, lng, distance_m)`` within ``radius_m`` of the centre."""
+        dlat = radius_m / METRES_PER_DEGREE_LAT
+        cos_lat = math.cos(math.radians(lat))
+        dlng = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+        south, north = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+        west, east = lng - dlng, lng + dlng
+        if dlng >= 180.0:
+            west, east = -180.0, 180.0
+        else:
+            west = west + 360.0 if west < -180.0 else west
+            east = east - 360.0 if east > 180.0 else east
+        for key, plat, plng in self.within_bbox(south, west, north, east):
+            distance = haversine_m(lat, lng, plat, plng)
+            if distance <= radius_m:
+                yield key, plat, plng, distance
+
+    def __len__(self):
+        return len(self._points)
+
+
+def cluster(points: list, zoom: int) -> list:
+    """
+    Group located programs into grid clusters sized for a map ``zoom`` level.
+
+    Each cluster reports its centroid, member count and program_ids.
+    """
+    size = 360.0 / (2 ** zoom) / CLUSTER_CELLS_PER_TILE
+    groups = defaultdict(list)
+    for point in points:
+        groups[(math.floor(point["lat"] / size), math.floor(point["lng"] / size))].append(point)
+    clusters = []
+    for members in groups.values():
+        clusters.append({
+            "lat": sum(m["lat"] for m in members) / len(members),
+            "lng": sum(m["lng"] for m in members) / len(members),
+            "count": len(members),
+            "program_ids": sorted(m["program_id"] for m in members),
+        })
+    clusters.sort(key=lambda c: (-c["count"], c["lat"], c["lng"]))
+    return clusters
+
+
+class GeoStore(ProgramIndex):
+    """Locates programs by place_id and answers spatial queries over them."""
+
+    columns = GEO_COLUMNS
+
+    def __init__(self, geocoder: Optional[Geocoder] = None):
+        self.geocoder = geocoder
+        self.index = GridIndex()
+        self._programs = {}
+        self._by_place = defaultdict(set)
+        # place_id -> (lat, lng), or None when known to be unresolvable
+        self._places = {}
+        self._unresolved = set()
+        # The resolve in progress, which callers share so no place_id is geocoded twice at once
+        self._resolving: Optional[asyncio.Task] = None
+        self._tasks = set()
+        super().__init__(max_age=INDEX_MAX_AGE)
+
+    def reset(self):
+        self.index = GridIndex(self.index.cell)
+        self._programs = {}
+        self._by_place = defaultdict(set)
+
+    def add(self, row: dict):
+        place_id = row.get("place_id")
+        if not place_id:
+            return
+        provider = row.get("providers")
+        self._programs[row["program_id"]] = {
+            "program_id": row["program_id"],
+            "name": row["name"],
+            "category": row.get("category"),
+            "address": row.get("address"),
+            "place_id": place_id,
+            "provider_name": provider["name"] if provider else None,
+        }
+        self._by_place[place_id].add(row["program_id"])
+        if place_id in self._places:
+            location = self._places[place_id]
+            if location is not None:
+                self.index.put(row["program_id"], *location)
+        else:
+            self._unresolved.add(place_id)
+
+    def discard(self, program_id: str):
+        program = self._programs.pop(program_id, None)
+        if program is None:
+            return
+        self.index.remove(program_id)
+        program_ids = self._by_place[program["place_id"]]
+        program_ids.discard(program_id)
+        if not program_ids:
+            del self._by_place[program["place_id"]]
+
+    async def after_load(self):
+        await self.resolve_pending()
+
+    def after_writes(self):
+        # Geocode new place_ids without holding up the write's response
+        if self._unresolved:
+            task = asyncio.get_running_loop().create_task(self._resolve_in_background())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve_in_background(self):
+        try:
+            await self.resolve_pending()
+        except Exception:
+            logger.exception("Geocoding new places failed")
+
+    async def resolve_pending(self):
+        """
+        Resolve unresolved place_ids: stored coordinates first, then the geocoder.
+
+        A resolve already running is awaited rather than repeated; place_ids
+        that became unresolved while it ran get a resolve of their own.
+        """
+        while True:
+            running = self._resolving
+            if running is None or running.done():
+                if not self._unresolved:
+                    return
+                running = self._resolving = asyncio.get_running_loop().create_task(
+                    self._resolve(set(self._unresolved))
+                )
+            # Shielded: a caller that gives up mustn't cancel the others' resolve
+            await asyncio.shield(running)
+
+    async def _resolve(self, place_ids: set):
+        for row in await repository.get_place_locations(place_ids):
+            self._learn(row["place_id"], row["lat"], row["lng"])
+        missing = [p for p in place_ids if p not in self._places]
+        if missing and self.geocoder is not None:
+            resolved = await self._geocode(missing)
+            await repository.save_place_locations(resolved)
+            for row in resolved:
+                self._learn(row["place_id"], row["lat"], row["lng"])
+        # Only now, so a failed resolve leaves them for the next one. Any
+        # the geocoder failed on are retried at the next full load.
+        self._unresolved -= place_ids
+
+    async def _geocode(self, place_ids: list) -> list:
+        semaphore = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+
+        async def resolve(place_id):
+            async with semaphore:
+                try:
+                    location = await repository.run(self.geocoder.resolve, place_id)
+                except Exception as e:
+                    # Not stored, so the next load tries again
+                    logger.warning("Geocoding failed", extra={"place_id": place_id, "error": str(e)})
+                    return None
+            lat, lng = location if location else (None, None)
+            return {"place_id": place_id, "lat": lat, "lng": lng}
+
+        results = await asyncio.gather(*(resolve(p) for p in place_ids))
+        return [row for row in results if row is not None]
+
+    def _learn(self, place_id: str, lat, lng):
+        location = (lat, lng) if lat is not None and lng is not None else None
+        self._places[place_id] = location
+        if location is None:
+            return
+        for program_id in self._by_place.get(place_id, ()):
+            self.index.put(program_id, *location)
+
+    async def _ready(self):
+        await self.ensure_loaded()
+        # Pick up place_ids whose background geocoding hasn't run or failed
+        if self._unresolved:
+            await self.resolve_pending()
+
+    def _located(self, program_id: str, lat: float, lng: float) -> dict:
+        return {**self._programs[program_id], "lat": lat, "lng": lng}
+
+    async def within_bbox(self, south: float, west: float, north: float, east: float) -> list:
+        await self._ready()
+        points = [self._located(key, lat, lng) for key, lat, lng in self.index.within_bbox(south, west, north, east)]
+        points.sort(key=lambda p: p["program_id"])
+        return points
+
+    async def within_radius(self, lat: float, lng: float, radius_m: float) -> list:
+        await self._ready()
+        points = []
+        for key, plat, plng, distance in self.index.within_radius(lat, lng, radius_m):
+            point = self._located(key, plat, plng)
+            point["distance_m"] = round(distance, 1)
+            points.append(point)
+        points.sort(key=lambda p: (p["distance_m"], p["program_id"]))
+        return points
+
+
+locations = GeoStore(geocoder_from_env())
@@ -0,0 +1,92 @@
+"""
+Liveness, readiness and draining, for the production server (see serve.py).
+
+A worker is live while its event loop answers ``GET /health``. It is ready,
+``GET /health/ready``, once :func:`warm` has run: upstream connections are
+open and the catalogue cache and in-memory indexes are loaded, so its first
+requests aren't the slow ones. Warm-up runs in the app's lifespan, before
+the worker accepts connections, and is cut short after
+``WARMUP_TIMEOUT_SECONDS``; whatever is still loading then carries on in the
+background. A warm-up step that fails doesn't keep the worker out of
+service, since it would fail the same way on every worker.
+
+When the server shuts down, :func:`drain` makes the worker report not ready
+and calls the listeners registered with :func:`on_drain`, which end
+long-lived streams. Other requests in flight are left to finish.
+"""
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "30"))
+
+STARTING = "starting"
+READY = "ready"
+DRAINING = "draining"
+
+state = STARTING
+
+# Warm-up step name -> "ok", "failed" or "loading"
+warmup = {}
+
+_drain_listeners = []
+_background = set()
+
+
+def ready() -> bool:
+    return state == READY
+
+
+def status() -> dict:
+    return {"status": state, "warmup": dict(warmup)}
+
+
+async def _warm_one(name: str, load):
+    warmup[name] = "loading"
+    try:
+        await load()
+        warmup[name] = "ok"
+    except Exception:
+        warmup[name] = "failed"
+        logger.exception("Warm-up step failed", extra={"step": name})
+
+
+async def warm(steps: dict):
+    """Run ``steps`` (name -> async callable) concurrently, then report ready."""
+    global state
+    state = STARTING
+    warmup.clear()
+    started = time.monotonic()
+    tasks = [asyncio.create_task(_warm_one(name, load)) for name, load in steps.items()]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=WARMUP_TIMEOUT)
+        for task in pending:
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+    if state == STARTING:
+        state = READY
+    logger.info("Warmed up", extra={"seconds": round(time.monotonic() - started, 3), **warmup})
+
+
+def on_drain(listener):
+    """Register ``listener()`` to be called when the worker starts shutting down."""
+    _drain_listeners.append(listener)
+    return listener
+
+
+def drain():
+    """Stop reporting ready and end long-lived work; safe to call more than once."""
+    global state
+    if state == DRAINING:
+        return
+    state = DRAINING
+    for task in _background:
+        task.cancel()
+    for listener in _drain_listeners:
+        try:
+            listener()
+        except Exception:
+            logger.exception("Drain listener failed", extra={"listener": listener.__name__})
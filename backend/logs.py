@@ -0,0 +1,141 @@
+"""
+Leveled, structured logging that never blocks the event loop.
+
+:func:`configure` routes the root logger through a bounded in-memory queue.
+Handlers only enqueue the record; a background thread formats it and writes
+it to stderr, so a slow terminal or log shipper can't stall a request. If
+the queue is full the record is dropped and counted in
+``log_records_dropped_total`` instead of waiting.
+
+Each record is written as one JSON object with the time, level, logger,
+message, the request id (see :mod:`tracing`) and any ``extra`` fields;
+``LOG_FORMAT=text`` writes readable lines instead, for local development.
+
+    logger = logging.getLogger(__name__)
+    logger.info("Imported programs", extra={"inserted": 120, "skipped": 3})
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+import orjson
+
+import metrics
+import tracing
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Libraries that log every HTTP call at INFO; upstream calls are timed by tracing.span instead
+QUIET_LOGGERS = ("httpx", "httpcore", "hpack")
+
+DROPPED = metrics.Counter("log_records_dropped_total", "Log records dropped because the log queue was full.")
+
+# Attributes every LogRecord has; anything else came from ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener = None
+_settings = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if getattr(record, "request_id", None):
+            fields = {"request_id": record.request_id, **fields}
+        if fields:
+            first, newline, rest = line.partition("\n")
+            line = first + " " + " ".join(f"{key}={value}" for key, value in fields.items()) + newline + rest
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueues without blocking; only what can't wait is done on the caller's thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Other handlers may still need the original
+        record = copy.copy(record)
+        # The request id lives in a context variable, so it must be read here
+        record.request_id = tracing.request_id.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # The traceback can't be rendered later, once the frames are gone
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+def configure(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Send the root logger's records through the queue; safe to call again."""
+    global _listener, _settings
+    shutdown()
+    _settings = (level, fmt, stream)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(TextFormatter() if fmt == "text" else JSONFormatter())
+    records = queue.Queue(maxsize=QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if isinstance(h, _QueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+
+
+def _after_fork():
+    # The writer thread isn't copied into a forked worker; start the worker its own
+    global _listener
+    if _listener is not None:
+        _listener = None
+        configure(*_settings)
+
+
+# Flush queued records when the process exits
+atexit.register(lambda: shutdown())
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def shutdown():
+    """Write out whatever is still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,16 +1,63 @@
-import uvicorn
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from fastapi import FastAPI
-from dotenv import load_dotenv
 
-from routes.program_routes import router as program_router
+from routes.export_routes import router as export_router
+from routes.program_routes import DEFAULT_PAGE_SIZE, router as program_router
 from routes.provider_routes import router as provider_router
+from routes.search_routes import router as search_router
+from routes.stream_routes import router as stream_router
 from routes.user_routes import router as user_router
+import auth
+import facets
+import health
+import logs
+import metrics
+import recurrence
+import replica
+import repository
+import search
+from admission import AdmissionMiddleware
+from compression import CompressionMiddleware
+from resilience import StaleWarningMiddleware
+from tracing import RequestMetricsMiddleware
+
+logs.configure()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep the JWT signing keys fresh in the background
+    key_rotation = asyncio.create_task(auth.rotate_keys())
+    # Serve catalogue reads from a local copy, if REPLICA_PATH is set
+    replica.start()
+    # Open upstream connections and load what the first requests would, before taking traffic
+    await health.warm({
+        "programs": lambda: repository.list_programs(limit=DEFAULT_PAGE_SIZE + 1),
+        "providers": repository.list_providers,
+        "search": search.catalogue.ensure_loaded,
+        "occurrences": recurrence.occurrences.index,
+        "facets": facets.aggregates.ensure_loaded,
+    })
+    yield
+    health.drain()
+    key_rotation.cancel()
+    await replica.stop()
+    # Release the upstream thread pool
+    repository.close()
 
-load_dotenv()
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Innermost, so requests it turns away still get CORS headers and are counted
+app.add_middleware(AdmissionMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,17 +65,52 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Conversation-Id"],
+    expose_headers=["X-Conversation-Id", "X-Next-Cursor", "Warning", "Retry-After"],
 )
 
+# Large lists compress well; streamed responses are left alone
+app.add_middleware(CompressionMiddleware)
+
+# Marks responses built from data upstream couldn't refresh
+app.add_middleware(StaleWarningMiddleware)
+
+# Outermost, so latency covers everything the app does for a request
+app.add_middleware(RequestMetricsMiddleware)
+
+app.include_router(export_router)
 app.include_router(program_router)
 app.include_router(provider_router)
+app.include_router(search_router)
+app.include_router(stream_router)
 app.include_router(user_router)
 
 @app.get("/")
 async def read_root():
     return {"message": "Hello World"}
 
+@app.get("/health", include_in_schema=False)
+async def liveness():
+    """The worker is up and its event loop is responding."""
+    return {"status": "ok"}
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness(response: Response):
+    """200 once the worker has warmed up, 503 while it is starting or shutting down."""
+    if not health.ready():
+        response.status_code = 503
+    return health.status()
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit, miss and eviction counters for the catalogue read cache."""
+    return repository.cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Request, upstream and cache metrics for this worker, for Prometheus to scrape."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
-    print("Starting Uvicorn server on http://0.0.0.0:8000")
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # The production server; for development, `uvicorn main:app --reload`
+    import serve
+    serve.main()
\ No newline at end of file
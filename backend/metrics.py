@@ -0,0 +1,166 @@
+"""
+Counters, gauges and histograms, exposed in the Prometheus text format.
+
+Metrics register themselves on creation and :func:`render` writes every
+registered metric for ``GET /metrics``. Values are per worker process, so a
+multi-worker server is scraped once per worker (or behind a load balancer,
+sampled). Label values are passed positionally, in ``labelnames`` order.
+
+:class:`CallbackMetric` reads its values when scraped, for counters that
+other modules already keep, such as the read cache's hit counts.
+"""
+import bisect
+import math
+import threading
+from typing import Callable, Sequence
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers cache hits (sub-millisecond) to slow upstream calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), register: bool = True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if register:
+            _registry.append(self)
+
+    def _key(self, labels: tuple) -> tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {labels}")
+        return tuple(str(value) for value in labels)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self._samples():
+            lines.append(f"{name}{_labels(self._sample_labelnames(name), key)} {_number(value)}")
+        return lines
+
+    def _sample_labelnames(self, name: str) -> tuple:
+        return self.labelnames
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, register: bool = True):
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket (not cumulative), then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, *labels) -> int:
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self):
+        with self._lock:
+            snapshot = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key + (_number(bound),), cumulative))
+            samples.append((f"{self.name}_sum", key, counts[-1]))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+    def _sample_labelnames(self, name: str) -> tuple:
+        return self.labelnames + ("le",) if name.endswith("_bucket") else self.labelnames
+
+
+class CallbackMetric(_Metric):
+    """
+    A counter or gauge whose values come from ``read()`` at scrape time.
+
+    ``read`` returns a number, or a dict of label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable, labelnames: Sequence[str] = (),
+                 kind: str = "gauge", register: bool = True):
+        super().__init__(name, documentation, labelnames, register)
+        self.kind = kind
+        self._read = read
+
+    def _samples(self):
+        values = self._read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, tuple(str(v) for v in key), value) for key, value in values.items()]
+
+
+def render() -> str:
+    """Every registered metric, in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,122 @@
+"""
+Base class for the in-memory indexes built over the programs table.
+"""
+import asyncio
+import logging
+import time
+
+import repository
+import resilience
+
+logger = logging.getLogger(__name__)
+
+
+class ProgramIndex:
+    """
+    An in-memory structure derived from every program row.
+
+    The index is loaded by scanning upstream on first use, and again once it
+    is older than ``max_age`` seconds so writes made by other workers show
+    up. In between, program writes made by this worker are applied as they
+    happen through :func:`repository.on_program_write`.
+
+    If upstream is unavailable when a reload is due, the index keeps
+    serving what it has (marking responses stale) and tries again after
+    ``resilience.BREAKER_RESET_SECONDS``.
+
+    Subclasses implement :meth:`reset`, :meth:`add` and :meth:`discard`, and
+    may narrow :attr:`columns` to what they need.
+    """
+
+    columns = repository.PROGRAM_WITH_PROVIDER
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._loaded_at = float("-inf")
+        self._lock = asyncio.Lock()
+        # Writes seen while a reload is scanning upstream; replayed on top of
+        # the scan, which may have read those rows before they changed
+        self._writes_during_load = None
+        # The last reload failed and the contents are older than max_age
+        self.stale = False
+        repository.on_program_write(self.apply_writes)
+
+    def reset(self):
+        """Drop all indexed programs."""
+        raise NotImplementedError
+
+    def add(self, row: dict):
+        """Index one program row."""
+        raise NotImplementedError
+
+    def discard(self, program_id: str):
+        """Remove a program from the index, if present."""
+        raise NotImplementedError
+
+    async def after_load(self):
+        """Hook for work that needs to await once a scan has been indexed."""
+
+    def after_writes(self):
+        """Hook called after written rows have been applied."""
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at != float("-inf")
+
+    async def ensure_loaded(self):
+        if time.monotonic() - self._loaded_at > self.max_age:
+            async with self._lock:
+                if time.monotonic() - self._loaded_at > self.max_age:
+                    await self._reload()
+        if self.stale:
+            resilience.served_stale(type(self).__name__)
+
+    async def _reload(self):
+        try:
+            await self._load()
+            self.stale = False
+        except resilience.UpstreamUnavailable:
+            if not self.loaded:
+                raise
+            logger.warning("Index reload failed; serving the previous copy", extra={"index": type(self).__name__})
+            self.stale = True
+            # Requests waiting on the lock serve the old copy instead of each retrying
+            self._loaded_at = time.monotonic() - self.max_age + resilience.BREAKER_RESET_SECONDS
+
+    def invalidate(self):
+        """Force a full reload from upstream on next use."""
+        self._loaded_at = float("-inf")
+
+    async def _load(self):
+        self._writes_during_load = []
+        try:
+            rows = [row async for row in repository.scan_programs(self.columns)]
+            pending, self._writes_during_load = self._writes_during_load, None
+            # Swap in the new contents without yielding to the event loop
+            self.reset()
+            for row in rows:
+                self.add(row)
+            for written in pending:
+                self.apply_writes(written)
+        finally:
+            self._writes_during_load = None
+        # Loaded before after_load, so writes made meanwhile are applied
+        self._loaded_at = time.monotonic()
+        try:
+            await self.after_load()
+        except BaseException:
+            # Half loaded (search without its providers, say): not a copy to
+            # serve until max_age, so the next use loads it all again
+            self._loaded_at = float("-inf")
+            raise
+
+    def apply_writes(self, rows):
+        if self._writes_during_load is not None:
+            self._writes_during_load.append(rows)
+        if not self.loaded:
+            # The first load will read these rows anyway
+            return
+        for row in rows:
+            self.discard(row["program_id"])
+            self.add(row)
+        self.after_writes()
@@ -0,0 +1,217 @@
+"""
+Expansion of recurring programs into calendar occurrences.
+
+A program with ``date_interval`` (Daily, Weekly, Fortnightly, Monthly) and
+``repeat_interval`` runs ``repeat_interval`` times, each occurrence shifted by
+one interval from the previous one; its ``end_date`` (if any) shifts with it.
+Other programs occur once, from ``start_date`` to ``end_date``.
+
+:class:`OccurrenceIndex` keeps every program's overall span in an interval
+tree so a calendar window only expands the programs that overlap it.
+"""
+import calendar
+import logging
+import os
+from datetime import date, timedelta
+from typing import Optional
+
+from program_index import ProgramIndex
+
+logger = logging.getLogger(__name__)
+
+FIXED_STEPS = {
+    "daily": timedelta(days=1),
+    "weekly": timedelta(days=7),
+    "fortnightly": timedelta(days=14),
+}
+
+# Most occurrences a program may have: writes above it are rejected, and
+# rows already stored with more are expanded only this far
+MAX_REPEATS = 1000
+
+# Rebuild the index from upstream this often, to pick up writes made by other workers
+INDEX_MAX_AGE = float(os.getenv("OCCURRENCE_INDEX_MAX_AGE", "300"))
+
+OCCURRENCE_COLUMNS = (
+    "program_id, name, description, address, category, start_date, end_date, "
+    "date_interval, repeat_interval, providers(name)"
+)
+
+
+def _parse(value) -> Optional[date]:
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+
+def add_months(day: date, months: int) -> date:
+    """Shift ``day`` by whole months, clamping to the end of shorter months."""
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def _shift(day: date, interval: str, n: int) -> date:
+    if interval == "monthly":
+        return add_months(day, n)
+    return day + FIXED_STEPS[interval] * n
+
+
+class _Schedule:
+    """One program's recurrence, reduced to what expansion needs."""
+
+    __slots__ = ("program", "start", "duration", "interval", "count", "first", "last")
+
+    def __init__(self, program: dict):
+        self.program = program
+        self.start = _parse(program["start_date"])
+        end = _parse(program.get("end_date"))
+        self.duration = max(end - self.start, timedelta(0)) if end else timedelta(0)
+        interval = (program.get("date_interval") or "").lower()
+        count = program.get("repeat_interval") or 0
+        if interval in FIXED_STEPS or interval == "monthly":
+            self.interval, self.count = interval, min(max(count, 1), MAX_REPEATS)
+        else:
+            self.interval, self.count = None, 1
+        self.first = self.start
+        self.last = self.occurrence(self.count - 1)[1]
+
+    def occurrence(self, i: int):
+        start = _shift(self.start, self.interval, i) if self.interval else self.start
+        return start, start + self.duration
+
+    def between(self, window_start: date, window_end: date):
+        """Yield (index, start, end) for occurrences overlapping the window."""
+        first = 0
+        if self.interval in FIXED_STEPS:
+            # Jump straight to the first occurrence that can overlap the window
+            step = FIXED_STEPS[self.interval].days
+            behind = (window_start - self.duration - self.start).days
+            first = max(0, behind // step)
+        for i in range(first, self.count):
+            start, end = self.occurrence(i)
+            if start > window_end:
+                return
+            if end >= window_start:
+                yield i, start, end
+
+
+def schedule_for(program: dict) -> Optional[_Schedule]:
+    """``program``'s schedule; None without a start_date, or if its dates are invalid or out of range."""
+    if not program.get("start_date"):
+        return None
+    try:
+        return _Schedule(program)
+    except (OverflowError, ValueError) as e:
+        # One bad row must not take the whole index down with it
+        logger.warning("Skipping program with an invalid schedule",
+                       extra={"program_id": program.get("program_id"), "error": str(e)})
+        return None
+
+
+def expand(program: dict):
+    """Yield (index, start, end) for every occurrence of ``program``; none without a valid schedule."""
+    schedule = schedule_for(program)
+    if schedule is None:
+        return
+    for i in range(schedule.count):
+        yield (i, *schedule.occurrence(i))
+
+
+class OccurrenceIndex:
+    """
+    Static augmented interval tree over program spans.
+
+    Spans are sorted by start; the implicit tree rooted at the middle of each
+    slice stores the largest end in its subtree, so a query skips every
+    subtree that ends before the window.
+    """
+
+    def __init__(self, schedules):
+        self._schedules = sorted(schedules, key=lambda s: s.first)
+        self._max_last = [None] * len(self._schedules)
+        self._build(0, len(self._schedules))
+
+    def _build(self, lo: int, hi: int):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        ends = [self._schedules[mid].last, self._build(lo, mid), self._build(mid + 1, hi)]
+        self._max_last[mid] = max(e for e in ends if e is not None)
+        return self._max_last[mid]
+
+    def overlapping(self, window_start: date, window_end: date):
+        """Yield schedules whose span overlaps [window_start, window_end]."""
+        stack = [(0, len(self._schedules))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self._max_last[mid] < window_start:
+                continue
+            schedule = self._schedules[mid]
+            stack.append((lo, mid))
+            if schedule.first <= window_end:
+                if schedule.last >= window_start:
+                    yield schedule
+                stack.append((mid + 1, hi))
+
+    def __len__(self):
+        return len(self._schedules)
+
+
+class OccurrenceStore(ProgramIndex):
+    """Keeps the interval tree in step with program writes and expands windows."""
+
+    columns = OCCURRENCE_COLUMNS
+
+    def __init__(self):
+        self._programs = {}
+        self._index = None
+        super().__init__(max_age=INDEX_MAX_AGE)
+
+    def reset(self):
+        self._programs = {}
+        self._index = None
+
+    def add(self, row: dict):
+        schedule = schedule_for(row)
+        if schedule is not None:
+            self._programs[row["program_id"]] = schedule
+            # The tree is static; rebuild it on next use
+            self._index = None
+
+    def discard(self, program_id: str):
+        if self._programs.pop(program_id, None) is not None:
+            self._index = None
+
+    async def index(self) -> OccurrenceIndex:
+        await self.ensure_loaded()
+        if self._index is None:
+            self._index = OccurrenceIndex(self._programs.values())
+        return self._index
+
+    async def expand(self, window_start: date, window_end: date) -> list:
+        index = await self.index()
+        occurrences = []
+        for schedule in index.overlapping(window_start, window_end):
+            program = schedule.program
+            provider = program.get("providers")
+            for i, start, end in schedule.between(window_start, window_end):
+                occurrences.append({
+                    "program_id": program["program_id"],
+                    "occurrence": i,
+                    "name": program["name"],
+                    "start": start.isoformat(),
+                    "end": end.isoformat(),
+                    "category": program.get("category"),
+                    "description": program.get("description"),
+                    "address": program.get("address"),
+                    "provider_name": provider["name"] if provider else None,
+                })
+        occurrences.sort(key=lambda o: (o["start"], o["name"]))
+        return occurrences
+
+
+occurrences = OccurrenceStore()
@@ -0,0 +1,422 @@
+"""
+An optional local SQLite copy of the catalogue tables, for serving reads.
+
+Set ``REPLICA_PATH`` to a file on local disk to turn it on. The programs and
+providers tables are copied into it (WAL mode, so reads never wait for the
+sync) and the catalogue reads in :mod:`repository` are answered from it,
+joining programs to their providers locally. Writes still go upstream.
+
+One worker per host keeps the file in sync: whichever holds the lock file
+``<REPLICA_PATH>.lock``. It takes a snapshot by paging through programs in
+``version`` order, then polls for changes with the cursor from the change
+log (:mod:`changes`), so a poll reads only what was written since. Providers
+have no versions and are re-read every ``PROVIDER_REFRESH_SECONDS``. Every
+worker also applies its own program writes as they happen, so a client reads
+back what it just wrote.
+
+The replica's lag is the time since its last successful sync. Past
+``MAX_LAG_SECONDS`` (or before the first snapshot completes), reads go
+upstream as if there were no replica. Rows deleted directly in the database
+are only dropped when their provider goes; the API itself never deletes a
+program.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import orjson
+
+import changes
+import metrics
+import repository
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PATH = os.getenv("REPLICA_PATH", "")
+
+# Older than this, reads go upstream instead
+MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "15"))
+
+# How often the syncing worker polls for program changes
+POLL_SECONDS = float(os.getenv("REPLICA_POLL_SECONDS", "1"))
+
+PROVIDER_REFRESH_SECONDS = float(os.getenv("REPLICA_PROVIDER_REFRESH_SECONDS", "60"))
+
+SNAPSHOT_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS providers (
+    provider_id TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+
+-- The filter columns are copied out of the row, so they can be indexed
+CREATE TABLE IF NOT EXISTS programs (
+    program_id TEXT PRIMARY KEY,
+    provider_id TEXT,
+    category TEXT,
+    is_approved INTEGER,
+    place_id TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS programs_provider_id_idx ON programs (provider_id);
+CREATE INDEX IF NOT EXISTS programs_category_idx ON programs (category);
+CREATE INDEX IF NOT EXISTS programs_is_approved_idx ON programs (is_approved);
+CREATE INDEX IF NOT EXISTS programs_start_date_idx ON programs (start_date);
+CREATE INDEX IF NOT EXISTS programs_end_date_idx ON programs (end_date);
+
+-- cursor: change-log cursor the programs are synced to
+-- synced_at: unix time of the last successful sync
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def _split(columns: str) -> list:
+    """Top-level items of a PostgREST select string."""
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(columns):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(columns[start:i].strip())
+            start = i + 1
+    items.append(columns[start:].strip())
+    return [item for item in items if item]
+
+
+def projection(columns: str):
+    """
+    ``project(program, provider)`` building the row PostgREST would return for
+    ``columns`` from a stored program and its provider.
+
+    Understands ``*``, plain columns and a ``providers(...)`` embed, which is
+    what the repository selects.
+    """
+    star = False
+    plain = []
+    embed = None
+    for item in _split(columns):
+        if item == "*":
+            star = True
+        elif "(" in item:
+            name, _, inner = item.partition("(")
+            if name.strip() != "providers":
+                raise ValueError(f"The replica can't embed {name.strip()!r}")
+            embed = [column.strip() for column in inner.rstrip(")").split(",") if column.strip()]
+        else:
+            plain.append(item)
+
+    def project(program: dict, provider: Optional[dict]) -> dict:
+        row = dict(program) if star else {column: program.get(column) for column in plain}
+        if embed is not None:
+            row["providers"] = None if provider is None else {column: provider.get(column) for column in embed}
+        return row
+
+    return project
+
+
+class Replica:
+    """The SQLite file, with one connection per thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock_file = None
+        self._providers_synced_at = float("-inf")
+        # The file's sync state as last read, for the metrics, which are read on the event loop
+        self.synced_cursor = None
+        self.synced_at = None
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        self.read_sync_state()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            # WAL makes this durable across crashes of the process, which is all a copy needs
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # -- sync state -------------------------------------------------------
+
+    def _meta(self, key: str):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    @property
+    def cursor(self) -> Optional[int]:
+        return self._meta("cursor")
+
+    def lag(self) -> float:
+        """Seconds since the last successful sync; infinite before the first snapshot."""
+        synced_at = self._meta("synced_at")
+        return float("inf") if synced_at is None else max(0.0, time.time() - synced_at)
+
+    def mark_synced(self, cursor: int):
+        synced_at = time.time()
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                [("cursor", cursor), ("synced_at", synced_at)],
+            )
+        self.synced_cursor, self.synced_at = cursor, synced_at
+
+    def read_sync_state(self):
+        """Refresh :attr:`synced_cursor` and :attr:`synced_at` from the file, which another worker may sync."""
+        self.synced_cursor, self.synced_at = self.cursor, self._meta("synced_at")
+
+    def synced_lag(self) -> float:
+        """:meth:`lag` as of the last :meth:`read_sync_state` or sync, without touching the file."""
+        return float("inf") if self.synced_at is None else max(0.0, time.time() - self.synced_at)
+
+    def try_lead(self) -> bool:
+        """Take the lock that makes this worker the one that syncs, if it is free."""
+        if self._lock_file is None:
+            lock_file = open(self.path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    # -- writes -----------------------------------------------------------
+
+    def apply_programs(self, rows: list):
+        """Upsert program rows, keeping whichever version is newer."""
+        programs, providers = [], []
+        for row in rows:
+            row = dict(row)
+            provider = row.pop("providers", None)
+            if provider and provider.get("provider_id"):
+                providers.append((provider["provider_id"], orjson.dumps({"description": None, **provider})))
+            is_approved = row.get("is_approved")
+            programs.append((
+                row["program_id"], row.get("provider_id"), row.get("category"),
+                None if is_approved is None else int(is_approved),
+                row.get("place_id"), row.get("start_date"), row.get("end_date"),
+                row["version"], orjson.dumps(row),
+            ))
+        with self._connection() as connection:
+            # Providers are refreshed separately; this only fills in ones not seen yet
+            connection.executemany(
+                "INSERT INTO providers (provider_id, data) VALUES (?, ?) ON CONFLICT DO NOTHING", providers
+            )
+            connection.executemany(
+                "INSERT INTO programs (program_id, provider_id, category, is_approved, place_id, "
+                "start_date, end_date, version, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (program_id) DO UPDATE SET provider_id = excluded.provider_id, "
+                "category = excluded.category, is_approved = excluded.is_approved, "
+                "place_id = excluded.place_id, start_date = excluded.start_date, "
+                "end_date = excluded.end_date, version = excluded.version, data = excluded.data "
+                "WHERE excluded.version > programs.version",
+                programs,
+            )
+
+    def replace_providers(self, rows: list):
+        """Make the providers table exactly ``rows``; programs of removed providers go too."""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM providers")
+            connection.executemany(
+                "INSERT INTO providers (provider_id, data) VALUES (?, ?)",
+                [(row["provider_id"], orjson.dumps(row)) for row in rows],
+            )
+            # As ON DELETE CASCADE does upstream
+            connection.execute(
+                "DELETE FROM programs WHERE provider_id IS NOT NULL "
+                "AND provider_id NOT IN (SELECT provider_id FROM providers)"
+            )
+
+    # -- reads ------------------------------------------------------------
+
+    def serving(self) -> bool:
+        return self.lag() <= MAX_LAG_SECONDS
+
+    def get_program(self, program_id: str, columns: str = repository.PROGRAM_WITH_PROVIDER) -> list:
+        return self.list_programs(columns=columns, program_id=program_id)
+
+    def list_programs(
+        self,
+        *,
+        columns: str = "*",
+        program_id: str = None,
+        program_ids: list = None,
+        after: str = None,
+        limit: int = None,
+        category: str = None,
+        provider_id: str = None,
+        is_approved: bool = None,
+        has_place: bool = None,
+        start_date_from=None,
+        start_date_to=None,
+    ) -> list:
+        """The rows ``repository.list_programs`` would get from PostgREST, in program_id order."""
+        where, params = [], []
+        for column, operator, value in (
+            ("program_id", "=", program_id),
+            ("category", "=", category),
+            ("provider_id", "=", provider_id),
+            ("is_approved", "=", None if is_approved is None else int(is_approved)),
+            ("start_date", ">=", start_date_from and start_date_from.isoformat()),
+            ("start_date", "<=", start_date_to and start_date_to.isoformat()),
+            ("program_id", ">", after),
+        ):
+            if value is not None:
+                where.append(f"p.{column} {operator} ?")
+                params.append(value)
+        if program_ids is not None:
+            where.append(f"p.program_id IN ({', '.join('?' * len(program_ids))})")
+            params.extend(program_ids)
+        if has_place is True:
+            where.append("p.place_id IS NOT NULL AND p.place_id != ''")
+        elif has_place is False:
+            where.append("(p.place_id IS NULL OR p.place_id = '')")
+        sql = "SELECT p.data, pr.data FROM programs p LEFT JOIN providers pr ON pr.provider_id = p.provider_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY p.program_id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        project = projection(columns)
+        return [
+            project(orjson.loads(program), provider and orjson.loads(provider))
+            for program, provider in self._connection().execute(sql, params)
+        ]
+
+    def list_providers(self) -> list:
+        return [orjson.loads(data) for data, in self._connection().execute("SELECT data FROM providers")]
+
+    def get_provider_with_programs(self, provider_id: str) -> list:
+        """The rows of ``providers?select=provider_id,name,description,programs(program_id,name)``."""
+        row = self._connection().execute(
+            "SELECT data FROM providers WHERE provider_id = ?", (provider_id,)
+        ).fetchone()
+        if row is None:
+            return []
+        provider = orjson.loads(row[0])
+        programs = self._connection().execute(
+            "SELECT program_id, data FROM programs WHERE provider_id = ? ORDER BY program_id", (provider_id,)
+        )
+        return [{
+            "provider_id": provider["provider_id"],
+            "name": provider.get("name"),
+            "description": provider.get("description"),
+            "programs": [{"program_id": pid, "name": orjson.loads(data).get("name")} for pid, data in programs],
+        }]
+
+    # -- sync -------------------------------------------------------------
+
+    async def sync(self):
+        """Bring the file up to date with upstream; the caller must hold the lead."""
+        if time.monotonic() - self._providers_synced_at > PROVIDER_REFRESH_SECONDS:
+            providers = await repository.scan_providers()
+            await repository.run(self.replace_providers, providers)
+            self._providers_synced_at = time.monotonic()
+
+        cursor = await repository.run(lambda: self.cursor)
+        result = await changes.log.since(cursor)
+        if result["reset"]:
+            # First snapshot, or too far behind for the change log: a version
+            # range scan, whose rows may be newer than the cursor taken before it
+            after = cursor or 0
+            while True:
+                rows = await repository.list_program_changes(after, SNAPSHOT_PAGE_SIZE)
+                await repository.run(self.apply_programs, rows)
+                if len(rows) < SNAPSHOT_PAGE_SIZE:
+                    break
+                after = rows[-1]["version"]
+        else:
+            await repository.run(self.apply_programs, result["changes"])
+        await repository.run(self.mark_synced, result["cursor"])
+
+    async def run(self):
+        """Sync while this worker holds the lead; otherwise wait to take it over."""
+        while True:
+            try:
+                if await repository.run(self.try_lead):
+                    await self.sync()
+                else:
+                    await repository.run(self.read_sync_state)
+            except Exception:
+                logger.exception("Replica sync failed", extra={"path": self.path})
+            await asyncio.sleep(POLL_SECONDS)
+
+
+replica: Optional[Replica] = None
+_task = None
+
+
+def start(path: str = REPLICA_PATH) -> Optional[Replica]:
+    """Open the replica at ``path`` and start syncing it; does nothing if ``path`` is empty."""
+    global replica, _task
+    if not path:
+        return None
+    replica = Replica(path)
+    repository.read_replica = replica
+    _task = asyncio.create_task(replica.run())
+    return replica
+
+
+async def stop():
+    global replica, _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    if replica is not None:
+        repository.read_replica = None
+        # Connections opened on executor threads are closed with the process
+        replica.close()
+        replica = None
+
+
+async def _record(rows):
+    # Our own writes, so a client reads back what it just wrote. Off the
+    # loop: the write may wait on the sync worker's lock for up to 5 s.
+    current = replica
+    if current is not None:
+        await repository.run(current.apply_programs, rows)
+
+
+repository.on_program_write(_record)
+
+metrics.CallbackMetric(
+    "replica_lag_seconds", "Seconds since the replica last synced with upstream.",
+    lambda: {} if replica is None else replica.synced_lag(),
+)
+metrics.CallbackMetric(
+    "replica_cursor", "Program version the replica is synced to.",
+    lambda: {} if replica is None or replica.synced_cursor is None else replica.synced_cursor,
+)
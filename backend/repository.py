@@ -0,0 +1,606 @@
+"""
+Async data-access layer between the routes and Supabase.
+
+supabase-py's query builders are synchronous, so calling ``.execute()`` inside
+an ``async def`` handler blocks the event loop for the whole PostgREST round
+trip. Every query goes through :func:`execute` instead, which runs it on a
+bounded thread pool. The admin client is created on first use in each worker,
+with its HTTP session rebuilt around a keep-alive pool sized to that thread
+pool so concurrent queries reuse connections instead of opening new ones.
+"""
+import asyncio
+import inspect
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import httpx
+from postgrest.types import ReturnMethod
+from postgrest.utils import SyncClient
+
+from cache import ReadThroughCache, TTLCache
+import config
+import metrics
+import resilience
+import tracing
+
+# Maximum number of upstream queries in flight per worker. Requests beyond this
+# wait for a free thread instead of piling more connections onto PostgREST.
+UPSTREAM_CONCURRENCY = int(os.getenv("SUPABASE_MAX_CONCURRENCY", "64"))
+KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+
+PROGRAM_WITH_PROVIDER = "*, providers(provider_id, name)"
+PROVIDER_WITH_PROGRAMS = "provider_id, name, description, programs(program_id, name)"
+
+# Postgres error code PostgREST reports when a foreign key target is missing
+FOREIGN_KEY_VIOLATION = "23503"
+
+# Values per ``in`` filter, keeping request URLs short
+IN_FILTER_BATCH = 200
+
+# Catalogue reads (programs and providers) go through this cache. Entries are
+# tagged with the rows they were built from:
+#   program:<id>   the program row, and any provider entry listing it
+#   provider:<id>  the provider's ProviderWithPrograms entry
+#   programs       every page of the program list
+#   providers      the provider list
+# so program writes can invalidate precisely what they changed.
+# Reads that pass ``with_etag=True`` also get the entry's ETag, for conditional GETs.
+cache = ReadThroughCache(
+    max_bytes=int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("CACHE_TTL", "30")),
+    stale_ttl=float(os.getenv("CACHE_STALE_TTL", "300")),
+    serve_stale_on=(resilience.UpstreamUnavailable,),
+    on_serve_stale=lambda key: resilience.served_stale("cache"),
+)
+
+# GET /api/profile runs on every page load. Role changes made here drop the
+# user's entry; ones made elsewhere (e.g. the Supabase dashboard) show up
+# within the TTL.
+profile_cache = TTLCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "60")),
+)
+
+metrics.CallbackMetric(
+    "cache_lookups_total", "Catalogue read cache lookups, by result; batch_* for ids looked up by batch reads.",
+    lambda: {
+        ("hit",): cache.hits, ("stale",): cache.stale_hits, ("miss",): cache.misses,
+        ("batch_hit",): cache.batch_hits, ("batch_miss",): cache.batch_misses,
+    },
+    ("result",), kind="counter",
+)
+metrics.CallbackMetric(
+    "cache_coalesced_total", "Cache misses that joined another request's upstream load, by key kind.",
+    lambda: {(kind,): count for kind, count in cache.coalesced_by_kind.items()},
+    ("kind",), kind="counter",
+)
+metrics.CallbackMetric("cache_bytes", "Size of the catalogue read cache.", lambda: cache.bytes)
+metrics.CallbackMetric("cache_evictions_total", "Entries evicted to stay within the byte budget.",
+                       lambda: cache.evictions, kind="counter")
+replica_reads = metrics.Counter(
+    "replica_reads_total",
+    "Catalogue reads while a replica is configured, by where they were served from (replica or upstream).",
+    ("source",),
+)
+
+logger = logging.getLogger(__name__)
+
+# Set by replica.start() when REPLICA_PATH is configured
+read_replica = None
+
+# Created by admin_client() on first use
+supabase_admin = None
+
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=UPSTREAM_CONCURRENCY, thread_name_prefix="supabase"
+        )
+    return _executor
+
+
+def _tune_session(client):
+    """Swap the client's PostgREST session for one with a pool sized to the executor."""
+    postgrest = client.postgrest
+    session = postgrest.session
+    postgrest.session = SyncClient(
+        base_url=session.base_url,
+        headers=session.headers,
+        # Frees the thread of a call resilience.call has already given up on
+        timeout=max(resilience.READ_TIMEOUT, resilience.WRITE_TIMEOUT),
+        follow_redirects=True,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_CONCURRENCY,
+            max_keepalive_connections=UPSTREAM_CONCURRENCY,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+    session.close()
+
+
+def admin_client():
+    """The admin client for this worker, created on first use."""
+    global supabase_admin
+    if supabase_admin is None:
+        client = config.admin_client()
+        _tune_session(client)
+        supabase_admin = client
+    return supabase_admin
+
+
+async def run(fn, *args):
+    """Run a blocking supabase call on the upstream thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), fn, *args)
+
+
+async def execute(query):
+    """
+    Execute a built supabase query without blocking the event loop, timed by
+    table and operation, within its time budget and the table's circuit
+    breaker (see :mod:`resilience`).
+    """
+    table, operation = tracing.describe(query)
+
+    async def attempt():
+        with tracing.span(table, operation):
+            return await run(query.execute)
+
+    return await resilience.call(table, operation, attempt)
+
+
+async def _from_replica(table: str, method: str, *args, **kwargs):
+    """
+    ``read_replica.<method>(...)``, or None when there is no replica or it is
+    lagging, in which case the caller reads upstream. While upstream is
+    unavailable (``table``'s breaker is open) a lagging replica is still
+    read, as the last known good copy.
+    """
+    replica = read_replica
+    if replica is None:
+        return None
+    degraded = resilience.is_open(table)
+
+    def read():
+        if replica.serving():
+            return getattr(replica, method)(*args, **kwargs), False
+        if degraded and replica.cursor is not None:
+            return getattr(replica, method)(*args, **kwargs), True
+        return None, False
+
+    rows, stale = await run(read)
+    replica_reads.inc("upstream" if rows is None else "replica")
+    if stale:
+        resilience.served_stale("replica")
+    return rows
+
+
+def _returning(query, columns: str):
+    """Have a write return ``columns`` (embeds included) in the same round trip."""
+    query.params = query.params.set("select", "".join(columns.split()))
+    return query
+
+
+def close():
+    """Release the upstream thread pool; it is recreated on next use."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# ---------------------------------------------------------------------------
+# programs
+# ---------------------------------------------------------------------------
+
+async def get_program(program_id: str, with_etag: bool = False):
+    async def load():
+        rows = await _from_replica("programs", "get_program", program_id)
+        if rows is not None:
+            return rows
+        response = await execute(
+            admin_client().table("programs")
+            .select(PROGRAM_WITH_PROVIDER)
+            .eq("program_id", program_id)
+        )
+        return response.data
+
+    return await cache.get_or_load(
+        ("program", program_id), load, tags=(f"program:{program_id}",), with_etag=with_etag
+    )
+
+
+async def get_programs(program_ids: list) -> dict:
+    """
+    Programs by id, with providers embedded: program_id -> row, or None if it
+    doesn't exist.
+
+    Ids :func:`get_program` has cached are answered from the cache. The rest
+    are read with one ``in`` query per ``IN_FILTER_BATCH`` ids, sent
+    concurrently, and cached under the same keys, so either read warms the
+    other.
+    """
+    found, missing = {}, []
+    for program_id in program_ids:
+        rows = cache.peek(("program", program_id))
+        if rows is None:
+            missing.append(program_id)
+        else:
+            found[program_id] = rows[0] if rows else None
+    if not missing:
+        return found
+
+    epoch = cache.epoch
+
+    async def load(ids):
+        rows = await _from_replica("programs", "list_programs", columns=PROGRAM_WITH_PROVIDER, program_ids=ids)
+        if rows is not None:
+            return rows
+        response = await execute(
+            admin_client().table("programs")
+            .select(PROGRAM_WITH_PROVIDER)
+            .in_("program_id", ids)
+        )
+        return response.data
+
+    chunks = [missing[i:i + IN_FILTER_BATCH] for i in range(0, len(missing), IN_FILTER_BATCH)]
+    loaded = {row["program_id"]: row for rows in await asyncio.gather(*(load(ids) for ids in chunks)) for row in rows}
+    for program_id in missing:
+        row = found[program_id] = loaded.get(program_id)
+        cache.put(("program", program_id), [row] if row else [], tags=(f"program:{program_id}",), epoch=epoch)
+    return found
+
+
+async def list_programs(
+    *,
+    columns: str = "*",
+    after: str = None,
+    limit: int = None,
+    category: str = None,
+    provider_id: str = None,
+    is_approved: bool = None,
+    has_place: bool = None,
+    start_date_from: date = None,
+    start_date_to: date = None,
+    with_etag: bool = False,
+):
+    """
+    List programs in ``program_id`` order, one keyset page at a time.
+
+    ``after`` is the last ``program_id`` of the previous page. Every filter is
+    pushed down to PostgREST so only the requested page crosses the network.
+    """
+    query = admin_client().table("programs").select(columns)
+    if category is not None:
+        query = query.eq("category", category)
+    if provider_id is not None:
+        query = query.eq("provider_id", provider_id)
+    if is_approved is not None:
+        query = query.eq("is_approved", str(is_approved).lower())
+    if has_place is True:
+        query = query.not_.is_("place_id", "null").neq("place_id", "")
+    elif has_place is False:
+        query = query.or_("place_id.is.null,place_id.eq.")
+    if start_date_from is not None:
+        query = query.gte("start_date", start_date_from.isoformat())
+    if start_date_to is not None:
+        query = query.lte("start_date", start_date_to.isoformat())
+    if after is not None:
+        query = query.gt("program_id", after)
+    query = query.order("program_id")
+    if limit is not None:
+        query = query.limit(limit)
+
+    async def load():
+        rows = await _from_replica(
+            "programs", "list_programs", columns=columns, after=after, limit=limit, category=category,
+            provider_id=provider_id, is_approved=is_approved, has_place=has_place,
+            start_date_from=start_date_from, start_date_to=start_date_to,
+        )
+        if rows is not None:
+            return rows
+        response = await execute(query)
+        return response.data
+
+    key = ("programs", columns, after, limit, category, provider_id, is_approved,
+           has_place, start_date_from, start_date_to)
+    return await cache.get_or_load(key, load, tags=("programs",), with_etag=with_etag)
+
+
+async def scan_program_pages(columns: str = PROGRAM_WITH_PROVIDER, page_size: int = 1000):
+    """
+    Yield every program in ``program_id`` order, as lists of up to
+    ``page_size`` rows (one keyset page each), bypassing the read cache.
+
+    Memory use is bounded by ``page_size``.
+    """
+    after = None
+    while True:
+        rows = await _from_replica("programs", "list_programs", columns=columns, after=after, limit=page_size)
+        if rows is None:
+            query = admin_client().table("programs").select(columns).order("program_id").limit(page_size)
+            if after is not None:
+                query = query.gt("program_id", after)
+            response = await execute(query)
+            rows = response.data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]["program_id"]
+
+
+async def scan_programs(columns: str = PROGRAM_WITH_PROVIDER, page_size: int = 1000):
+    """Yield every program, one at a time; see :func:`scan_program_pages`. Used to build the in-memory indexes."""
+    async for rows in scan_program_pages(columns, page_size):
+        for row in rows:
+            yield row
+
+
+async def latest_program_version() -> int:
+    """The highest program ``version``: it changes whenever any program is written."""
+    response = await execute(
+        admin_client().table("programs").select("version").order("version", desc=True).limit(1)
+    )
+    return response.data[0]["version"] if response.data else 0
+
+
+async def list_program_changes(after_version: int, limit: int):
+    """
+    Programs written after ``after_version``, oldest change first, bypassing the read cache.
+
+    An index range scan on ``version``; each program appears once, at its
+    latest version.
+    """
+    response = await execute(
+        admin_client().table("programs")
+        .select(PROGRAM_WITH_PROVIDER)
+        .gt("version", after_version)
+        .order("version")
+        .limit(limit)
+    )
+    return response.data
+
+
+async def latest_program_changes(limit: int):
+    """The ``limit`` most recently written programs, newest first."""
+    response = await execute(
+        admin_client().table("programs")
+        .select(PROGRAM_WITH_PROVIDER)
+        .order("version", desc=True)
+        .limit(limit)
+    )
+    return response.data
+
+
+async def insert_program(data: dict):
+    """Insert a program and return it with its provider embedded."""
+    response = await execute(
+        _returning(admin_client().table("programs").insert(data), PROGRAM_WITH_PROVIDER)
+    )
+    await _after_program_write(response.data)
+    return response.data
+
+
+async def insert_programs(rows: list):
+    """
+    Insert programs in one statement and return them with providers embedded.
+
+    The statement is atomic: if any row is rejected, none are inserted.
+    Columns a row leaves out take their database defaults.
+    """
+    response = await execute(
+        _returning(
+            admin_client().table("programs").insert(rows, default_to_null=False),
+            PROGRAM_WITH_PROVIDER,
+        )
+    )
+    await _after_program_write(response.data)
+    return response.data
+
+
+async def update_program(program_id: str, data: dict):
+    """Update a program and return it with its provider embedded; [] if it doesn't exist."""
+    response = await execute(
+        _returning(
+            admin_client().table("programs").update(data).eq("program_id", program_id),
+            PROGRAM_WITH_PROVIDER,
+        )
+    )
+    await _after_program_write(response.data)
+    return response.data
+
+
+async def update_programs(program_ids: list, data: dict):
+    """
+    Apply the same patch to many programs and return the updated rows.
+
+    One PATCH per ``IN_FILTER_BATCH`` ids, sent concurrently. Ids that don't
+    exist are simply absent from the result.
+    """
+    async def patch(ids):
+        response = await execute(
+            _returning(
+                admin_client().table("programs").update(data).in_("program_id", ids),
+                PROGRAM_WITH_PROVIDER,
+            )
+        )
+        return response.data
+
+    chunks = [program_ids[i:i + IN_FILTER_BATCH] for i in range(0, len(program_ids), IN_FILTER_BATCH)]
+    rows = [row for updated in await asyncio.gather(*(patch(ids) for ids in chunks)) for row in updated]
+    await _after_program_write(rows)
+    return rows
+
+
+def on_program_write(listener):
+    """
+    Register ``listener(rows)`` to be called after programs are written.
+
+    ``rows`` are the written programs as returned by the write, with the
+    provider embedded. Used by the in-memory indexes to stay current.
+    A listener may be a coroutine function, and the write awaits it: use
+    that for blocking work, through :func:`run`, not to hold up the loop.
+    """
+    _program_write_listeners.append(listener)
+    return listener
+
+
+_program_write_listeners = []
+
+
+async def _after_program_write(rows):
+    """
+    Drop cache entries affected by writes to ``rows`` and notify listeners.
+
+    ``program:<id>`` also reaches the provider entry that listed the program
+    before the write, so moving a program between providers refreshes both.
+    """
+    if not rows:
+        return
+    tags = {"programs"}
+    for row in rows:
+        tags.add(f"program:{row['program_id']}")
+        if row.get("provider_id"):
+            tags.add(f"provider:{row['provider_id']}")
+    cache.invalidate(*tags)
+
+    for listener in _program_write_listeners:
+        try:
+            result = listener(rows)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            # A stale index must not fail a write that already happened
+            logger.exception("Program write listener failed", extra={"listener": listener.__name__})
+
+
+# ---------------------------------------------------------------------------
+# providers
+# ---------------------------------------------------------------------------
+
+async def list_providers(with_etag: bool = False):
+    async def load():
+        rows = await _from_replica("providers", "list_providers")
+        if rows is not None:
+            return rows
+        return await scan_providers()
+
+    return await cache.get_or_load(("providers",), load, tags=("providers",), with_etag=with_etag)
+
+
+async def scan_providers():
+    """Every provider, straight from upstream."""
+    response = await execute(admin_client().table("providers").select("*"))
+    return response.data
+
+
+async def existing_provider_ids(provider_ids) -> set:
+    """The subset of ``provider_ids`` that exist, bypassing the read cache."""
+    provider_ids = list(provider_ids)
+    found = set()
+    for i in range(0, len(provider_ids), IN_FILTER_BATCH):
+        response = await execute(
+            admin_client().table("providers")
+            .select("provider_id")
+            .in_("provider_id", provider_ids[i:i + IN_FILTER_BATCH])
+        )
+        found.update(row["provider_id"] for row in response.data)
+    return found
+
+
+async def get_provider_with_programs(provider_id: str, with_etag: bool = False):
+    async def load():
+        rows = await _from_replica("providers", "get_provider_with_programs", provider_id)
+        if rows is not None:
+            return rows
+        response = await execute(
+            admin_client().table("providers")
+            .select(PROVIDER_WITH_PROGRAMS)
+            .eq("provider_id", provider_id)
+        )
+        return response.data
+
+    def tags(rows):
+        yield f"provider:{provider_id}"
+        for provider in rows:
+            for program in provider.get("programs") or ():
+                yield f"program:{program['program_id']}"
+
+    return await cache.get_or_load(("provider", provider_id), load, tags=tags, with_etag=with_etag)
+
+
+# ---------------------------------------------------------------------------
+# place locations
+# ---------------------------------------------------------------------------
+
+async def get_place_locations(place_ids) -> list:
+    """Fetch stored coordinates for ``place_ids``."""
+    place_ids = list(place_ids)
+    rows = []
+    for i in range(0, len(place_ids), IN_FILTER_BATCH):
+        response = await execute(
+            admin_client().table("place_locations")
+            .select("place_id, lat, lng")
+            .in_("place_id", place_ids[i:i + IN_FILTER_BATCH])
+        )
+        rows.extend(response.data)
+    return rows
+
+
+async def save_place_locations(rows: list):
+    """Upsert resolved coordinates, one row per place_id."""
+    if not rows:
+        return
+    await execute(
+        admin_client().table("place_locations")
+        .upsert(rows, on_conflict="place_id", returning=ReturnMethod.minimal)
+    )
+
+
+# ---------------------------------------------------------------------------
+# profiles
+# ---------------------------------------------------------------------------
+
+async def get_or_create_profile(user_id: str, email: str = None, cached: bool = True) -> dict:
+    """
+    The user's profile, created on first use.
+
+    One upsert both creates a missing row and returns an existing one, so
+    concurrent first requests (several tabs) can't race into a duplicate
+    insert. It only sets user_id and email (kept in step with the token);
+    role and any other columns keep their stored or default values.
+    Profiles are cached per user for ``PROFILE_CACHE_TTL`` seconds; pass
+    ``cached=False`` to read the stored row (for authorization decisions).
+    """
+    profile = profile_cache.get(user_id) if cached else None
+    if profile is not None:
+        return profile
+    row = {"user_id": user_id}
+    if email:
+        row["email"] = email
+    response = await execute(
+        admin_client().table("profiles").upsert(row, on_conflict="user_id")
+    )
+    if not response.data:
+        raise Exception("Failed to create profile - no data returned after upsert.")
+    profile = response.data[0]
+    profile_cache.set(user_id, profile)
+    return profile
+
+
+async def set_profile_role(user_id: str, role: str):
+    """Change a user's role and return the updated profile; [] if there is none."""
+    response = await execute(
+        admin_client().table("profiles").update({"role": role}).eq("user_id", user_id)
+    )
+    # Drop the cached profile even if nothing was updated: it may be stale anyway
+    profile_cache.pop(user_id)
+    return response.data
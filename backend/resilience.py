@@ -0,0 +1,258 @@
+"""
+Timeouts, retries and circuit breakers for calls to Supabase.
+
+Every PostgREST query goes through :func:`call` (from ``repository.execute``):
+
+* It has a time budget: ``UPSTREAM_READ_TIMEOUT`` seconds for selects,
+  ``UPSTREAM_WRITE_TIMEOUT`` for writes, retries included.
+* Selects are idempotent, so one that fails because upstream is unavailable
+  is retried after a jittered exponential backoff, while the budget lasts.
+  Writes are never retried: one that timed out may still have been applied.
+* Each table has a :class:`CircuitBreaker`. After ``BREAKER_FAILURES``
+  failures in a row it opens, and calls to that table fail at once for
+  ``BREAKER_RESET_SECONDS`` instead of waiting on upstream; then one trial
+  call decides whether it closes again.
+
+Only availability failures count: timeouts, connection errors and 5xx
+answers. Any other error (a missing foreign key, a bad filter) means
+upstream answered, and is raised unchanged.
+
+A call that fails for good raises :class:`UpstreamUnavailable`, an HTTP 503
+with Retry-After, which routes re-raise like their other HTTPExceptions.
+Reads with a last known good copy (the read cache, the in-memory indexes, a
+lagging replica) serve that instead and call :func:`served_stale`, and
+:class:`StaleWarningMiddleware` adds a ``Warning: 110`` header to the response.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+from starlette.datastructures import MutableHeaders
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "5"))
+WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "10"))
+READ_RETRIES = int(os.getenv("UPSTREAM_READ_RETRIES", "2"))
+# Backoff before retry n is uniform in [0, min(BACKOFF_MAX, BACKOFF_BASE * 2**n)]
+BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.1"))
+BACKOFF_MAX = 1.0
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "10"))
+
+# HTTP statuses, and PostgREST and Postgres error codes, for failures of
+# upstream rather than of the request: gateway errors, PostgREST unable to
+# reach or get a connection to Postgres, statement timeout, shutting down
+UNAVAILABLE_CODES = {
+    "500", "502", "503", "504",
+    "PGRST000", "PGRST001", "PGRST002", "PGRST003",
+    "57014", "57P01", "57P03",
+}
+
+STALE_WARNING = '110 - "Response is Stale"'
+
+RETRIES = metrics.Counter(
+    "upstream_retries_total", "Upstream reads retried after an availability failure, by table.", ("table",)
+)
+REJECTED = metrics.Counter(
+    "upstream_rejected_total", "Upstream calls failed at once by an open circuit breaker, by table.", ("table",)
+)
+STALE_RESPONSES = metrics.Counter(
+    "stale_responses_total", "Responses served from a last known good copy because upstream was unavailable."
+)
+
+
+class UpstreamUnavailable(HTTPException):
+    """Supabase is unavailable for ``table``; a 503 when it reaches a route."""
+
+    def __init__(self, table: str, reason: str, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail=f"Upstream temporarily unavailable ({reason})",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        self.table = table
+        self.reason = reason
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """Whether ``error`` means upstream couldn't answer, rather than rejecting the request."""
+    if isinstance(error, (TimeoutError, httpx.TransportError, UpstreamUnavailable)):
+        return True
+    return isinstance(error, APIError) and str(error.code) in UNAVAILABLE_CODES
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open: calls are refused until ``reset_after``
+    seconds have passed. Half-open: one trial call goes through, and closes
+    the breaker if it succeeds or opens it again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, table: str, failures: int = BREAKER_FAILURES, reset_after: float = BREAKER_RESET_SECONDS):
+        self.table = table
+        self.failure_threshold = failures
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = float("-inf")
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now; in half-open state, claims the trial."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = self.HALF_OPEN
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a call through again."""
+        return max(0.0, self.opened_at + self.reset_after - time.monotonic())
+
+    def success(self):
+        self._trial_in_flight = False
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logger.info("Circuit closed", extra={"table": self.table})
+            self.state = self.CLOSED
+
+    def failure(self):
+        self._trial_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            logger.warning("Circuit opened", extra={"table": self.table, "failures": self.failures})
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """The call was cancelled before it finished; it says nothing about upstream."""
+        self._trial_in_flight = False
+
+
+# table -> CircuitBreaker
+breakers = {}
+
+_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+metrics.CallbackMetric(
+    "upstream_circuit_state", "Circuit breaker state by table: 0 closed, 1 half-open, 2 open.",
+    lambda: {(table, ): _STATE_VALUES[breaker.state] for table, breaker in breakers.items()},
+    ("table",),
+)
+
+
+def breaker_for(table: str) -> CircuitBreaker:
+    breaker = breakers.get(table)
+    if breaker is None:
+        breaker = breakers[table] = CircuitBreaker(table, BREAKER_FAILURES, BREAKER_RESET_SECONDS)
+    return breaker
+
+
+def is_open(table: str) -> bool:
+    """Whether calls to ``table`` are being refused right now."""
+    breaker = breakers.get(table)
+    return breaker is not None and breaker.state != CircuitBreaker.CLOSED and breaker.retry_after() > 0
+
+
+async def call(table: str, operation: str, attempt):
+    """
+    ``await attempt()`` under ``table``'s breaker, within the operation's
+    budget, retrying selects. Raises :class:`UpstreamUnavailable` if upstream
+    doesn't answer; any other error from ``attempt`` is raised as is.
+    """
+    breaker = breaker_for(table)
+    read = operation == "select"
+    deadline = time.monotonic() + (READ_TIMEOUT if read else WRITE_TIMEOUT)
+    attempts = 1 + (READ_RETRIES if read else 0)
+    reason = "timed out"
+
+    for n in range(attempts):
+        if not breaker.allow():
+            REJECTED.inc(table)
+            raise UpstreamUnavailable(table, "circuit open", breaker.retry_after())
+        try:
+            result = await asyncio.wait_for(attempt(), deadline - time.monotonic())
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as error:
+            if not is_unavailable(error):
+                # Upstream answered; the request was at fault
+                breaker.success()
+                raise
+            breaker.failure()
+            reason = "timed out" if isinstance(error, TimeoutError) else "upstream error"
+            logger.warning(
+                "Upstream call failed",
+                extra={"table": table, "operation": operation, "attempt": n + 1, "error": repr(error)},
+            )
+        else:
+            breaker.success()
+            return result
+
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n))
+        if n + 1 == attempts or time.monotonic() + delay >= deadline:
+            break
+        RETRIES.inc(table)
+        await asyncio.sleep(delay)
+
+    raise UpstreamUnavailable(table, reason, breaker.retry_after())
+
+
+# The current request's stale marks; see StaleWarningMiddleware
+_stale: ContextVar[Optional[list]] = ContextVar("stale", default=None)
+
+
+def served_stale(source: str):
+    """Record that the current response uses a last known good copy from ``source``."""
+    STALE_RESPONSES.inc()
+    marks = _stale.get()
+    if marks is not None:
+        marks.append(source)
+
+
+class StaleWarningMiddleware:
+    """Adds ``Warning: 110`` to responses built from data upstream couldn't refresh."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # A list, not a flag, so marks made in a copied context (a task
+        # spawned for the request) are seen here too
+        marks = []
+        token = _stale.set(marks)
+
+        async def send_with_warning(message):
+            if message["type"] == "http.response.start" and marks:
+                MutableHeaders(scope=message).append("Warning", STALE_WARNING)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_warning)
+        finally:
+            _stale.reset(token)
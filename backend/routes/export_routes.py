@@ -0,0 +1,73 @@
+from typing import Literal
+import logging
+import math
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+import conditional
+import export
+import repository
+import resilience
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Mirrors revalidate on every pull; an unchanged catalogue is a 304
+EXPORT_CACHE_CONTROL = "public, no-cache"
+
+
+@router.get("/api/export/programs.{fmt}")
+async def export_programs(fmt: Literal["ndjson", "csv", "ics"], request: Request, response: Response):
+    """
+    The whole catalogue as NDJSON, CSV or iCalendar, streamed.
+
+    The first pull after a change streams from upstream page by page and
+    saves a snapshot as it goes; later pulls are sent from the snapshot, with
+    an ETag, until the catalogue changes. If upstream is unavailable, the
+    newest snapshot is sent, however old, with a stale Warning.
+    """
+    layout = export.FORMATS[fmt]
+    try:
+        try:
+            version = await repository.latest_program_version()
+            snapshot = export.snapshots.open(fmt, version)
+        except resilience.UpstreamUnavailable:
+            snapshot = export.snapshots.open(fmt, None, max_age=math.inf)
+            if snapshot is None:
+                raise
+            resilience.served_stale("export")
+
+        if snapshot is None:
+            return StreamingResponse(
+                export.snapshots.stream(fmt, version),
+                media_type=layout.media_type,
+                headers={"Cache-Control": EXPORT_CACHE_CONTROL},
+            )
+
+        unchanged = conditional.not_modified(request, response, snapshot.etag, EXPORT_CACHE_CONTROL)
+        if unchanged is not None:
+            snapshot.close()
+            return unchanged
+        return StreamingResponse(
+            snapshot.chunks(),
+            media_type=layout.media_type,
+            headers={
+                "ETag": snapshot.etag,
+                "Cache-Control": EXPORT_CACHE_CONTROL,
+                "Content-Length": str(snapshot.size),
+            },
+        )
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error exporting programs")
+
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error while exporting programs"
+        )
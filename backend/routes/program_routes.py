@@ -1,14 +1,43 @@
-from datetime import date
-from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException
-import traceback
+from datetime import date, datetime
+import asyncio
+import json
+import logging
+from typing import Dict, List, Literal, Optional
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 
-from pydantic import BaseModel
+from postgrest.exceptions import APIError
+from pydantic import BaseModel, Field
 
-from config import supabase_admin
+import bulk_import
+import changes
+import conditional
+import facets
+import geo
+import recurrence
+import repository
+import resilience
+import serialization
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_OCCURRENCE_WINDOW_DAYS = 366
+MAX_NEAR_RADIUS_M = 100_000
+MAX_APPROVALS = 1000
+MAX_BATCH_IDS = 500
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl", "application/json-seq"}
+
+# Browsers revalidate on every read (a 304 when unchanged); a CDN may serve its
+# copy for as long as the backend's own read cache would
+CATALOGUE_CACHE_CONTROL = (
+    f"public, max-age=0, s-maxage={int(repository.cache.ttl)}, "
+    f"stale-while-revalidate={int(repository.cache.stale_ttl)}"
+)
+
 class ProgramCreate(BaseModel):
     name: str
     category: Optional[str] = None
@@ -16,7 +45,7 @@ class ProgramCreate(BaseModel):
     start_date: Optional[date] = None
     end_date: Optional[date] = None
     date_interval: Optional[str] = None
-    repeat_interval: Optional[int] = None
+    repeat_interval: Optional[int] = Field(None, ge=0, le=recurrence.MAX_REPEATS)
     place_id: Optional[str] = None
     address: Optional[str] = None
     phone: Optional[str] = None
@@ -31,7 +60,7 @@ class ProgramUpdate(BaseModel):
     start_date: Optional[date] = None
     end_date: Optional[date] = None
     date_interval: Optional[str] = None
-    repeat_interval: Optional[int] = None
+    repeat_interval: Optional[int] = Field(None, ge=0, le=recurrence.MAX_REPEATS)
     place_id: Optional[str] = None
     address: Optional[str] = None
     phone: Optional[str] = None
@@ -57,85 +86,53 @@ class Program(BaseModel):
     provider_id: Optional[str] = None
     provider_name: Optional[str] = None
     is_approved: Optional[bool] = None
+    version: Optional[int] = None
+    updated_at: Optional[datetime] = None
 
 
 
 @router.post("/api/programs", response_model=Program)
 async def create_program(program_data: ProgramCreate):
     try:
-        # Debug: Log the received program data
-        print(f"Backend - Received program data: {program_data}")
-        print(f"Backend - place_id value: {program_data.place_id}")
-        print(f"Backend - place_id type: {type(program_data.place_id)}")
-        print(f"Backend - place_id is None: {program_data.place_id is None}")
-        print(f"Backend - place_id == '': {program_data.place_id == ''}")
-        
-        # Validate that provider exists if provider_id is provided
-        if program_data.provider_id:
-            provider_response = supabase_admin.table("providers").select("provider_id, name").eq("provider_id", program_data.provider_id).execute()
-            
-            if not provider_response.data:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Provider with ID {program_data.provider_id} not found"
-                )
-        
         # Prepare data for insertion - include all fields including place_id
         insert_data = program_data.model_dump()
         
         # Remove None values but keep empty strings and other falsy values
         insert_data = {k: v for k, v in insert_data.items() if v is not None}
-        
-        # Debug: Log the data being inserted
-        print(f"Backend - Insert data: {insert_data}")
-        print(f"Backend - place_id in insert_data: {insert_data.get('place_id')}")
 
         if 'start_date' in insert_data:
             insert_data['start_date'] = insert_data['start_date'].isoformat()
         if 'end_date' in insert_data:
             insert_data['end_date'] = insert_data['end_date'].isoformat()
         
-        # Insert the new program
-        response = supabase_admin.table("programs").insert(insert_data).execute()
-        
-        # Debug: Log the response
-        print(f"Backend - Insert response: {response}")
-        if response.data:
-            print(f"Backend - Created program: {response.data[0]}")
+        # Insert the new program; the created row comes back with its provider
+        # embedded, and the foreign key validates provider_id in the same trip
+        try:
+            inserted = await repository.insert_program(insert_data)
+        except APIError as e:
+            if e.code == repository.FOREIGN_KEY_VIOLATION:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Provider with ID {program_data.provider_id} not found"
+                )
+            raise
         
         # Check if the insertion was successful
-        if response.data is None or not response.data:
+        if not inserted:
             raise HTTPException(status_code=500, detail="Failed to create program")
+
+        logger.debug("Created program", extra={"program_id": inserted[0]["program_id"],
+                                               "place_id": inserted[0].get("place_id")})
         
-        # Get the created program with provider information
-        created_program_id = response.data[0]["program_id"]
-        
-        # Fetch the complete program data with provider name
-        program_response = supabase_admin.table("programs").select(
-            "*, providers(provider_id, name)"
-        ).eq("program_id", created_program_id).execute()
-        
-        if not program_response.data:
-            raise HTTPException(status_code=500, detail="Failed to fetch created program")
-        
-        program_dict = dict(program_response.data[0])
-        
-        # Handle provider name
-        if program_dict.get('providers'):
-            program_dict['provider_name'] = program_dict['providers']['name']
-            del program_dict['providers']
-        else:
-            program_dict['provider_name'] = None
-        
-        return Program(**program_dict)
+        # The row comes straight from the database; no need to re-validate it
+        return serialization.json_response(serialization.program_out(inserted[0]))
     
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
-    except Exception as e:
+    except Exception:
         # Log the error for debugging
-        print(f"Error creating program: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error creating program")
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -144,21 +141,243 @@ async def create_program(program_data: ProgramCreate):
         )
 
 
+@router.post("/api/programs/bulk")
+async def bulk_create_programs(
+    request: Request,
+    format: Optional[Literal["csv", "ndjson"]] = None,
+    batch_size: int = Query(500, ge=1, le=5000),
+    concurrency: int = Query(4, ge=1, le=16),
+    provider_id: Optional[str] = None,
+):
+    """
+    Import programs from a streamed CSV (with a header row) or NDJSON body.
+
+    The format comes from ``format`` or the Content-Type. Rows are validated
+    like POST /api/programs; rows without a provider_id get ``provider_id``.
+    Valid rows are inserted in batches of ``batch_size``, ``concurrency`` at a
+    time. Invalid rows are skipped and reported by row number.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type in NDJSON_TYPES:
+            format = "ndjson"
+        elif content_type in ("text/csv", "application/csv"):
+            format = "csv"
+        else:
+            raise HTTPException(
+                status_code=415,
+                detail="Send text/csv or application/x-ndjson, or pass format="
+            )
+
+    records = (bulk_import.csv_records if format == "csv" else bulk_import.ndjson_records)(request.stream())
+    importer = bulk_import.ProgramImport(
+        ProgramCreate,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        default_provider_id=provider_id,
+    )
+    try:
+        return await importer.run(records)
+
+    except bulk_import.ImportFormatError as e:
+        # Rows before the malformed part were imported; say how far it got
+        raise HTTPException(status_code=400, detail={"message": str(e), **importer.summary()})
+    except resilience.UpstreamUnavailable as e:
+        # Likewise for the rows read before upstream went away
+        raise HTTPException(status_code=503, detail={"message": e.detail, **importer.summary()}, headers=e.headers)
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error importing programs")
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while importing programs"
+        )
+
+
+class ApprovalDecision(BaseModel):
+    program_id: UUID
+    decision: Literal["approve", "reject"]
+    changes: Optional[ProgramUpdate] = None
+
+class ApprovalRequest(BaseModel):
+    decisions: List[ApprovalDecision] = Field(..., min_length=1, max_length=MAX_APPROVALS)
+
+class ApprovalError(BaseModel):
+    program_ids: List[str]
+    error: str
+
+class ApprovalResult(BaseModel):
+    updated: List[Program]
+    not_found: List[str]
+    errors: List[ApprovalError]
+
+
+@router.post("/api/programs/approvals", response_model=ApprovalResult)
+async def review_programs(request: ApprovalRequest):
+    """
+    Approve or reject many programs at once, optionally editing them too.
+
+    Decisions with the same resulting patch (typically "approve", no edits)
+    are applied together by one upstream PATCH; all patches are sent
+    concurrently. Rejecting sets is_approved to false. Each patch succeeds
+    or fails on its own, and failures are listed in ``errors``.
+    """
+    try:
+        program_ids = [str(d.program_id) for d in request.decisions]
+        if len(set(program_ids)) != len(program_ids):
+            raise HTTPException(status_code=400, detail="Each program_id may appear only once")
+
+        # Group programs by the exact patch they need
+        groups = {}
+        for decision in request.decisions:
+            patch = decision.changes.model_dump(mode="json", exclude_unset=True) if decision.changes else {}
+            patch["is_approved"] = decision.decision == "approve"
+            key = json.dumps(patch, sort_keys=True)
+            groups.setdefault(key, (patch, []))[1].append(str(decision.program_id))
+
+        results = await asyncio.gather(
+            *(repository.update_programs(ids, patch) for patch, ids in groups.values()),
+            return_exceptions=True,
+        )
+
+        updated, errors = [], []
+        for (patch, ids), result in zip(groups.values(), results):
+            if isinstance(result, APIError):
+                if result.code == repository.FOREIGN_KEY_VIOLATION:
+                    message = f"Provider with ID {patch.get('provider_id')} not found"
+                else:
+                    message = result.message or "Rejected by the database"
+                errors.append(ApprovalError(program_ids=ids, error=message))
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                updated.extend(result)
+
+        failed = {program_id for error in errors for program_id in error.program_ids}
+        found = {row["program_id"] for row in updated}
+        not_found = [pid for pid in program_ids if pid not in found and pid not in failed]
+
+        return serialization.json_response({
+            "updated": [serialization.program_out(row) for row in updated],
+            "not_found": not_found,
+            "errors": [error.model_dump() for error in errors],
+        })
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error reviewing programs")
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while reviewing programs"
+        )
+
+
+def _select_columns(fields: Optional[str]):
+    """
+    Translate a ``fields=`` projection into a PostgREST select string.
+
+    Returns the select string and whether provider_name was requested, in which
+    case the provider is embedded and has to be flattened afterwards.
+    """
+    if not fields:
+        return "*", False
+
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = set(requested) - set(Program.model_fields)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+
+    columns = [f for f in requested if f != "provider_name"]
+    # program_id is the pagination key, so it is always returned
+    if "program_id" not in columns:
+        columns.insert(0, "program_id")
+    with_provider = "provider_name" in requested
+    if with_provider:
+        columns.append("providers(name)")
+    return ",".join(columns), with_provider
+
+
 @router.get("/api/programs")
-async def list_programs():
+async def list_programs(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    category: Optional[str] = None,
+    provider_id: Optional[str] = None,
+    is_approved: Optional[bool] = None,
+    has_place: Optional[bool] = None,
+    start_date_from: Optional[date] = None,
+    start_date_to: Optional[date] = None,
+):
+    """
+    List programs one page at a time, ordered by program_id.
+
+    When more rows are available the response carries an ``X-Next-Cursor``
+    header; pass it back as ``cursor`` to fetch the next page. Pages carry an
+    ETag; a matching ``If-None-Match`` gets a 304.
+    """
     try:
-        response = supabase_admin.table("programs").select("*").execute()
+        if cursor is not None:
+            try:
+                UUID(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+
+        columns, with_provider = _select_columns(fields)
+
+        # Fetch one extra row to learn whether there is a next page
+        programs, etag = await repository.list_programs(
+            columns=columns,
+            after=cursor,
+            limit=limit + 1,
+            category=category,
+            provider_id=provider_id,
+            is_approved=is_approved,
+            has_place=has_place,
+            start_date_from=start_date_from,
+            start_date_to=start_date_to,
+            with_etag=True,
+        )
         
         # Check if the query was successful
-        if response.data is None:
+        if programs is None:
             raise HTTPException(status_code=500, detail="Failed to fetch programs")
+
+        unchanged = conditional.not_modified(request, response, etag, CATALOGUE_CACHE_CONTROL)
+        if unchanged is not None:
+            return unchanged
         
-        return response.data
+        if len(programs) > limit:
+            programs = programs[:limit]
+            response.headers["X-Next-Cursor"] = programs[-1]["program_id"]
+
+        if with_provider:
+            # Build new dicts; the rows may be shared with the read cache
+            programs = [serialization.program_out(program) for program in programs]
+
+        return serialization.json_response(programs, response)
     
-    except Exception as e:
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
         # Log the error for debugging
-        print(f"Error fetching programs: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error fetching programs")
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -167,41 +386,256 @@ async def list_programs():
         )
     
 
+class ProgramChanges(BaseModel):
+    changes: List[Program]
+    cursor: int
+    reset: bool
+
+
+class ProgramBatchRequest(BaseModel):
+    program_ids: List[UUID] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+
+class ProgramBatch(BaseModel):
+    # program_id -> the program, or null if it doesn't exist
+    programs: Dict[str, Optional[Program]]
+
+
+@router.post("/api/programs/batch", response_model=ProgramBatch)
+async def get_programs(request: ProgramBatchRequest):
+    """
+    Look up many programs by id in one request, in place of one
+    ``GET /api/programs/{program_id}`` each. Programs are keyed by id in the
+    order requested; ids that don't exist map to null.
+    """
+    try:
+        program_ids = list(dict.fromkeys(str(program_id) for program_id in request.program_ids))
+        rows = await repository.get_programs(program_ids)
+
+        return serialization.json_response({
+            "programs": {
+                program_id: serialization.program_out(rows[program_id]) if rows[program_id] else None
+                for program_id in program_ids
+            },
+        })
+
+    except HTTPException:
+        # Re-raise HTTP exceptions
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error fetching programs", extra={"count": len(request.program_ids)})
+
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error while fetching programs"
+        )
+
+
+@router.get("/api/programs/changes", response_model=ProgramChanges)
+async def list_program_changes(since: Optional[int] = Query(None, ge=0)):
+    """
+    Programs inserted or updated after the ``since`` cursor, oldest change first.
+
+    Pass the returned ``cursor`` as ``since`` on the next poll. When ``reset``
+    is true (first sync, or too far behind) no changes are listed: reload
+    GET /api/programs, then poll from the returned cursor.
+    """
+    try:
+        result = await changes.log.since(since)
+
+        return serialization.json_response({
+            "changes": [serialization.program_out(row) for row in result["changes"]],
+            "cursor": result["cursor"],
+            "reset": result["reset"],
+        })
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error fetching program changes", extra={"since": since})
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while fetching program changes"
+        )
+
+
+@router.get("/api/programs/facets")
+async def program_facets(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    provider_id: Optional[str] = None,
+    is_approved: Optional[bool] = None,
+    has_place: Optional[bool] = None,
+    start_date_from: Optional[date] = None,
+    start_date_to: Optional[date] = None,
+):
+    """
+    Program counts by category, provider, approval status and start month.
+
+    Takes the filters of GET /api/programs. ``total`` counts the programs
+    matching all of them; each facet is counted without its own filter, so
+    the other choices still show their counts.
+    """
+    try:
+        filters = {
+            "category": category,
+            "provider_id": provider_id,
+            "is_approved": is_approved,
+            "has_place": has_place,
+            "start_date_from": start_date_from,
+            "start_date_to": start_date_to,
+        }
+        counts, etag = await repository.cache.get_or_load(
+            ("facets", *filters.values()),
+            lambda: facets.aggregates.counts(**filters),
+            tags=("programs",),
+            with_etag=True,
+        )
+
+        unchanged = conditional.not_modified(request, response, etag, CATALOGUE_CACHE_CONTROL)
+        if unchanged is not None:
+            return unchanged
+        return serialization.json_response(counts, response)
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error counting program facets")
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while counting programs"
+        )
+
+
+@router.get("/api/programs/occurrences")
+async def list_occurrences(
+    window_start: date = Query(..., alias="from"),
+    window_end: date = Query(..., alias="to"),
+):
+    """
+    Expand recurring programs into the occurrences overlapping [from, to].
+
+    Dates are inclusive. Expanded windows are cached until the next program write.
+    """
+    try:
+        if window_end < window_start:
+            raise HTTPException(status_code=400, detail="'to' must not be before 'from'")
+        if (window_end - window_start).days > MAX_OCCURRENCE_WINDOW_DAYS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Window must span at most {MAX_OCCURRENCE_WINDOW_DAYS} days"
+            )
+
+        occurrences = await repository.cache.get_or_load(
+            ("occurrences", window_start, window_end),
+            lambda: recurrence.occurrences.expand(window_start, window_end),
+            tags=("programs",),
+        )
+        return serialization.json_response(occurrences)
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error expanding occurrences")
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while fetching occurrences"
+        )
+
+
+def _parse_bbox(bbox: str) -> tuple:
+    """Parse ``south,west,north,east`` (Google's LatLngBounds.toUrlValue order)."""
+    try:
+        south, west, north, east = (float(part) for part in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be 'south,west,north,east'")
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise HTTPException(status_code=400, detail="bbox is out of range")
+    return south, west, north, east
+
+
+@router.get("/api/programs/near")
+async def programs_near(
+    bbox: Optional[str] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius: Optional[float] = Query(None, gt=0, le=MAX_NEAR_RADIUS_M),
+    zoom: Optional[int] = Query(None, ge=0, le=22),
+):
+    """
+    Programs located inside ``bbox``, or within ``radius`` metres of ``lat``/``lng``.
+
+    Coordinates come from the server-side geocode cache. Radius results are
+    nearest first and carry ``distance_m``. With ``zoom``, results are grouped
+    into clusters sized for that map zoom level instead.
+    """
+    try:
+        if bbox is not None:
+            programs = await geo.locations.within_bbox(*_parse_bbox(bbox))
+        elif lat is not None and lng is not None and radius is not None:
+            programs = await geo.locations.within_radius(lat, lng, radius)
+        else:
+            raise HTTPException(status_code=400, detail="Pass either bbox or lat, lng and radius")
+
+        if zoom is not None:
+            return serialization.json_response({"clusters": geo.cluster(programs, zoom)})
+        return serialization.json_response({"programs": programs})
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 400)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error finding programs near location")
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while fetching nearby programs"
+        )
+
+
 @router.get("/api/programs/{program_id}", response_model=Program)
-async def get_program(program_id: str):
+async def get_program(program_id: str, request: Request, response: Response):
     try:
-        response = supabase_admin.table("programs").select(
-            "*, providers(provider_id, name)"
-        ).eq("program_id", program_id).execute()
+        program_rows, etag = await repository.get_program(program_id, with_etag=True)
         
         # Check if the query was successful
-        if response.data is None:
+        if program_rows is None:
             raise HTTPException(status_code=500, detail="Failed to fetch program")
         
         # Check if program exists
-        if not response.data:
+        if not program_rows:
             raise HTTPException(status_code=404, detail=f"Program with ID {program_id} not found")
+
+        # The client's copy is current; skip building the body
+        unchanged = conditional.not_modified(request, response, etag, CATALOGUE_CACHE_CONTROL)
+        if unchanged is not None:
+            return unchanged
         
         # Return the first (and should be only) result
-        program_data = response.data[0]
-
-        program_dict = dict(program_data)
-        if program_dict.get('providers'):
-            program_dict['provider_name'] = program_dict['providers']['name']
-            # Remove the nested providers object as it's not needed in the response model
-            del program_dict['providers']
-        else:
-            program_dict['provider_name'] = None
-        print(program_dict)
-        return Program(**program_dict)
+        return serialization.json_response(serialization.program_out(program_rows[0]), response)
     
     except HTTPException:
         # Re-raise HTTP exceptions (like 404)
         raise
-    except Exception as e:
+    except Exception:
         # Log the error for debugging
-        print(f"Error fetching program {program_id}: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error fetching program", extra={"program_id": program_id})
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -213,22 +647,6 @@ async def get_program(program_id: str):
 @router.put("/api/programs/{program_id}", response_model=Program)
 async def update_program(program_id: str, program_data: ProgramUpdate):
     try:
-        # Check if program exists
-        existing_program = supabase_admin.table("programs").select("*").eq("program_id", program_id).execute()
-        
-        if not existing_program.data:
-            raise HTTPException(status_code=404, detail=f"Program with ID {program_id} not found")
-        
-        # Validate that provider exists if provider_id is being updated
-        if program_data.provider_id:
-            provider_response = supabase_admin.table("providers").select("provider_id, name").eq("provider_id", program_data.provider_id).execute()
-            
-            if not provider_response.data:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Provider with ID {program_data.provider_id} not found"
-                )
-        
         # Prepare data for update - only include fields that were provided
         update_data = program_data.model_dump(exclude_unset=True)
         
@@ -238,38 +656,34 @@ async def update_program(program_id: str, program_data: ProgramUpdate):
         if 'end_date' in update_data and update_data['end_date']:
             update_data['end_date'] = update_data['end_date'].isoformat()
         
-        # Update the program
-        response = supabase_admin.table("programs").update(update_data).eq("program_id", program_id).execute()
-        
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to update program")
-        
-        # Fetch the updated program with provider information
-        program_response = supabase_admin.table("programs").select(
-            "*, providers(provider_id, name)"
-        ).eq("program_id", program_id).execute()
-        
-        if not program_response.data:
-            raise HTTPException(status_code=500, detail="Failed to fetch updated program")
-        
-        program_dict = dict(program_response.data[0])
+        # Update the program; the updated row comes back with its provider
+        # embedded, and the foreign key validates provider_id in the same trip.
+        # An empty patch has nothing to write, so just read the program back.
+        try:
+            if update_data:
+                program_rows = await repository.update_program(program_id, update_data)
+            else:
+                program_rows = await repository.get_program(program_id)
+        except APIError as e:
+            if e.code == repository.FOREIGN_KEY_VIOLATION:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Provider with ID {program_data.provider_id} not found"
+                )
+            raise
         
-        # Handle provider name
-        if program_dict.get('providers'):
-            program_dict['provider_name'] = program_dict['providers']['name']
-            del program_dict['providers']
-        else:
-            program_dict['provider_name'] = None
+        # No row matched the filter, so the program doesn't exist
+        if not program_rows:
+            raise HTTPException(status_code=404, detail=f"Program with ID {program_id} not found")
         
-        return Program(**program_dict)
+        return serialization.json_response(serialization.program_out(program_rows[0]))
     
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
-    except Exception as e:
+    except Exception:
         # Log the error for debugging
-        print(f"Error updating program {program_id}: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error updating program", extra={"program_id": program_id})
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -1,14 +1,30 @@
 from datetime import date
 from typing import Optional, List
-from fastapi import APIRouter, Depends, HTTPException
-import traceback
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
 from pydantic import BaseModel
 
-from config import supabase_admin
+import conditional
+import repository
+import serialization
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Providers only change in the database, never through this API, so shared
+# caches may keep them as long as the read cache keeps a stale copy
+PROVIDERS_CACHE_CONTROL = (
+    f"public, max-age=0, s-maxage={int(repository.cache.stale_ttl)}, "
+    f"stale-while-revalidate={int(repository.cache.stale_ttl)}"
+)
+# A provider's page lists its programs, which do change through the API
+PROVIDER_CACHE_CONTROL = (
+    f"public, max-age=0, s-maxage={int(repository.cache.ttl)}, "
+    f"stale-while-revalidate={int(repository.cache.stale_ttl)}"
+)
+
 class Program(BaseModel):
     program_id: str
     name: str
@@ -25,20 +41,26 @@ class ProviderWithPrograms(BaseModel):
     programs: List[Program]
 
 @router.get("/api/providers")
-async def list_providers():
+async def list_providers(request: Request, response: Response):
     try:
-        response = supabase_admin.table("providers").select("*").execute()
+        providers, etag = await repository.list_providers(with_etag=True)
         
         # Check if the query was successful
-        if response.data is None:
+        if providers is None:
             raise HTTPException(status_code=500, detail="Failed to fetch providers")
+
+        unchanged = conditional.not_modified(request, response, etag, PROVIDERS_CACHE_CONTROL)
+        if unchanged is not None:
+            return unchanged
         
-        return response.data
+        return serialization.json_response(providers, response)
     
-    except Exception as e:
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
+    except Exception:
         # Log the error for debugging
-        print(f"Error fetching providers: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error fetching providers")
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -48,22 +70,25 @@ async def list_providers():
     
 
 @router.get("/api/providers/{provider_id}", response_model=ProviderWithPrograms)
-async def get_provider(provider_id: str):
+async def get_provider(provider_id: str, request: Request, response: Response):
     try:
-        response = supabase_admin.table("providers").select(
-            "provider_id, name, description, programs(program_id, name)"
-        ).eq("provider_id", provider_id).execute()
+        provider_rows, etag = await repository.get_provider_with_programs(provider_id, with_etag=True)
         
         # Check if the query was successful
-        if response.data is None:
+        if provider_rows is None:
             raise HTTPException(status_code=500, detail="Failed to fetch provider")
         
         # Check if provider exists
-        if not response.data:
+        if not provider_rows:
             raise HTTPException(status_code=404, detail=f"provider with ID {provider_id} not found")
+
+        # The client's copy is current; skip building the body
+        unchanged = conditional.not_modified(request, response, etag, PROVIDER_CACHE_CONTROL)
+        if unchanged is not None:
+            return unchanged
         
         # Return the first (and should be only) result
-        provider_data = response.data[0]
+        provider_data = provider_rows[0]
 
         programs = provider_data.get('programs', [])
 
@@ -79,15 +104,14 @@ async def get_provider(provider_id: str):
                 for program in programs
             ]
         }
-        return ProviderWithPrograms(**provider_response)
+        return serialization.json_response(provider_response, response)
     
     except HTTPException:
         # Re-raise HTTP exceptions (like 404)
         raise
-    except Exception as e:
+    except Exception:
         # Log the error for debugging
-        print(f"Error fetching provider {provider_id}: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error fetching provider", extra={"provider_id": provider_id})
         
         # Return appropriate HTTP error
         raise HTTPException(
@@ -0,0 +1,41 @@
+from typing import Literal, Optional
+import logging
+from fastapi import APIRouter, HTTPException, Query
+
+import search
+import serialization
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+MAX_SEARCH_RESULTS = 100
+
+
+@router.get("/api/search")
+async def search_catalogue(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS),
+    type: Optional[Literal["program", "provider"]] = None,
+):
+    """
+    Rank programs and providers against ``q``, best first.
+
+    Every word must match; the last word also matches as a prefix so the
+    results can follow the user's typing. ``type`` limits results to one kind.
+    """
+    try:
+        return serialization.json_response(await search.catalogue.search(q, limit, type))
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error searching the catalogue", extra={"query": q})
+        
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500, 
+            detail="Internal server error while searching"
+        )
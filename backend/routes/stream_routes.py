@@ -0,0 +1,52 @@
+from typing import Optional
+import logging
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+import events
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+@router.get("/api/stream/programs")
+async def stream_programs(
+    last_event_id: Optional[int] = Header(None, ge=0),
+    since: Optional[int] = Query(None, ge=0),
+):
+    """
+    Server-Sent Events feed of program inserts and updates.
+
+    Each ``program`` event carries the program as GET /api/programs/{id}
+    returns it. EventSource sends ``Last-Event-ID`` when it reconnects, and
+    the feed resumes after it; ``since`` does the same for a first
+    connection. A ``reset`` event means the client was too far behind and
+    should reload the catalogue.
+    """
+    try:
+        resume = last_event_id if last_event_id is not None else since
+        subscription = await events.feed.subscribe(resume)
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error subscribing to program stream")
+
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error while subscribing to program changes"
+        )
+
+    return StreamingResponse(
+        subscription.stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Stop nginx from buffering the stream
+            "X-Accel-Buffering": "no",
+        },
+    )
@@ -1,12 +1,24 @@
+import logging
+from uuid import UUID
+
 from fastapi import APIRouter, Depends, HTTPException
-import traceback
+from pydantic import BaseModel, Field
 
 # Import dependencies from our modular files
 from auth import get_current_user
-from config import supabase_admin
+import repository
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+ADMIN_ROLE = "admin"
+
+
+class RoleUpdate(BaseModel):
+    role: str = Field(..., min_length=1)
+
+
 @router.get("/api/profile")
 async def get_profile(current_user=Depends(get_current_user)):
     """
@@ -14,38 +26,45 @@ async def get_profile(current_user=Depends(get_current_user)):
     create one.
     """
     try:
-        user_id_str = str(current_user.id)
-        print(f"Getting profile for user: {user_id_str}, email: {current_user.email}")
-
-        # Fetch profile from the 'profiles' table
-        result = supabase_admin.table("profiles").select("*").eq("user_id", user_id_str).execute()
-        
-        if result.data:
-            print("Found existing profile.")
-            return result.data[0]
-        
-        # If no profile exists, create one
-        print("No profile found, creating a new one.")
-        new_profile = {
-            "user_id": user_id_str,
-            "email": current_user.email,
-        }
-        insert_result = supabase_admin.table("profiles").insert(new_profile).execute()
-        
-        if insert_result.data:
-            print("Profile created successfully.")
-            return insert_result.data[0]
-        
-        raise Exception("Failed to create profile - no data returned after insert.")
+        return await repository.get_or_create_profile(str(current_user.id), current_user.email)
             
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 503)
+        raise
     except Exception as e:
-        print(f"Error in get_profile: {str(e)}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in get_profile")
         raise HTTPException(
             status_code=500,
             detail={"error": str(e), "message": "An error occurred while fetching or creating the profile."}
         )
 
+@router.put("/api/profiles/{user_id}/role")
+async def set_role(user_id: UUID, update: RoleUpdate, current_user=Depends(get_current_user)):
+    """Change another user's role. Only admins may do this."""
+    try:
+        # Uncached: a demoted admin must lose the right at once, in every worker
+        caller = await repository.get_or_create_profile(str(current_user.id), current_user.email, cached=False)
+        if caller.get("role") != ADMIN_ROLE:
+            raise HTTPException(status_code=403, detail="Only admins can change roles")
+
+        updated = await repository.set_profile_role(str(user_id), update.role)
+        if not updated:
+            raise HTTPException(status_code=404, detail=f"Profile for user {user_id} not found")
+        return updated[0]
+
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 and 404)
+        raise
+    except Exception:
+        # Log the error for debugging
+        logger.exception("Error setting role", extra={"user_id": str(user_id)})
+
+        # Return appropriate HTTP error
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error while setting role"
+        )
+
 @router.get("/api/debug-auth")
 async def debug_auth(current_user=Depends(get_current_user)):
     """Debug endpoint to verify authentication and check user data."""
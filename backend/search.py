@@ -0,0 +1,351 @@
+"""
+In-process full-text search over programs and providers.
+
+:class:`InvertedIndex` maps each term to the documents containing it, with a
+field-weighted term frequency per document, and ranks matches with BM25.
+The last word of a query is matched as a prefix so results update as the user
+types; prefixes are looked up in a sorted copy of the vocabulary.
+
+:class:`SearchStore` keeps an index of every program and provider, updated in
+place on program writes, so a keystroke never scans the database.
+"""
+import heapq
+import math
+import os
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from operator import itemgetter
+from typing import Optional
+
+import repository
+from program_index import ProgramIndex
+
+# Rebuild the index from upstream this often, to pick up writes made by other workers
+INDEX_MAX_AGE = float(os.getenv("SEARCH_INDEX_MAX_AGE", "300"))
+
+# Vocabulary terms a one-word type-ahead prefix may expand to
+MAX_PREFIX_EXPANSIONS = 200
+
+# Documents a multi-word query scores at most, taken from its rarest word's
+# best matches; bounds the cost of queries made only of common words
+MAX_CANDIDATES = 1000
+
+# Score multiplier for a completion of the last word, so "art" ranks "Art"
+# above "Artists"
+PREFIX_MATCH_WEIGHT = 0.7
+
+# A match in the name counts three times as much as one in the description
+PROGRAM_FIELDS = {"name": 3.0, "category": 2.0, "description": 1.0, "address": 1.0}
+PROVIDER_FIELDS = {"name": 3.0, "description": 1.0}
+
+SEARCH_COLUMNS = "program_id, name, description, category, address, providers(name)"
+
+# Too common to narrow a search; not indexed, and dropped from queries unless
+# still being typed
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from in into is it of on or the to with".split()
+)
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: Optional[str]) -> list:
+    """Lowercase, strip accents and split into words."""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", text.lower())
+    if not text.isascii():
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _WORD.findall(text)
+
+
+class InvertedIndex:
+    """
+    Term -> {document key: weighted term frequency}, ranked with BM25.
+
+    Each document has a stored payload that is returned with its hits.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.payloads = {}
+        self._postings = {}
+        self._doc_terms = {}
+        self._lengths = {}
+        self._total_length = 0.0
+        self._ranked_postings = {}
+        # Sorted vocabulary for prefix lookups; built on first query after a bulk load
+        self._sorted_terms = None
+
+    def add(self, key, fields: dict, weights: dict, payload: dict):
+        """Index ``fields`` (name -> text) under ``key``, replacing any previous version."""
+        self.remove(key)
+        frequencies = {}
+        length = 0.0
+        for field, weight in weights.items():
+            for term in tokenize(fields.get(field)):
+                if term in STOP_WORDS:
+                    continue
+                frequencies[term] = frequencies.get(term, 0.0) + weight
+                length += weight
+        for term, frequency in frequencies.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if self._sorted_terms is not None:
+                    insort(self._sorted_terms, term)
+            postings[key] = frequency
+            self._ranked_postings.pop(term, None)
+        self._doc_terms[key] = frequencies
+        self._lengths[key] = length
+        self._total_length += length
+        self.payloads[key] = payload
+
+    def remove(self, key):
+        terms = self._doc_terms.pop(key, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self._postings[term]
+            del postings[key]
+            self._ranked_postings.pop(term, None)
+            if not postings:
+                del self._postings[term]
+                if self._sorted_terms is not None:
+                    del self._sorted_terms[bisect_left(self._sorted_terms, term)]
+        self._total_length -= self._lengths.pop(key)
+        del self.payloads[key]
+
+    def _vocabulary(self, prefix: str) -> list:
+        """Every vocabulary term starting with ``prefix``, in order."""
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        lo = bisect_left(self._sorted_terms, prefix)
+        hi = bisect_left(self._sorted_terms, prefix + "\U0010ffff", lo)
+        return self._sorted_terms[lo:hi]
+
+    def _completions(self, prefix: str) -> dict:
+        """
+        Terms a one-word type-ahead ``prefix`` expands to, as {term: score weight}.
+
+        At most ``MAX_PREFIX_EXPANSIONS``, preferring the terms most documents use.
+        """
+        terms = self._vocabulary(prefix)
+        if len(terms) > MAX_PREFIX_EXPANSIONS:
+            terms = heapq.nlargest(MAX_PREFIX_EXPANSIONS, terms, key=lambda t: len(self._postings[t]))
+        return {term: 1.0 if term == prefix else PREFIX_MATCH_WEIGHT for term in terms}
+
+    def _idf(self, term: str) -> float:
+        frequency = len(self._postings[term])
+        return math.log(1 + (len(self._lengths) - frequency + 0.5) / (frequency + 0.5))
+
+    def _impact(self, frequency: float, length: float, average_length: float) -> float:
+        """BM25's saturated, length-normalised term frequency."""
+        norm = self.k1 * (1 - self.b + self.b * length / average_length)
+        return frequency * (self.k1 + 1) / (frequency + norm)
+
+    def _ranked(self, term: str) -> list:
+        """
+        ``term``'s postings as ``(impact, key)``, highest impact first.
+
+        Built on first use and dropped whenever a document containing the term
+        changes. Impacts use the average length at build time; the drift from
+        later writes only nudges the order of near ties.
+        """
+        ranked = self._ranked_postings.get(term)
+        if ranked is None:
+            average_length = self._total_length / len(self._lengths)
+            ranked = sorted(
+                ((self._impact(frequency, self._lengths[key], average_length), key)
+                 for key, frequency in self._postings[term].items()),
+                key=itemgetter(0),
+                reverse=True,
+            )
+            self._ranked_postings[term] = ranked
+        return ranked
+
+    def _top(self, terms: dict, limit: int, accept) -> dict:
+        """
+        Scores of the best ``limit`` documents matching any of ``terms``.
+
+        A document's score is its best term's, so the overall top ``limit`` is
+        among each term's own top ``limit``; only those postings are read.
+        """
+        scores = {}
+        for term, weight in terms.items():
+            if term not in self._postings:
+                continue
+            idf = weight * self._idf(term)
+            taken = 0
+            for impact, key in self._ranked(term):
+                if accept is not None and not accept(key):
+                    continue
+                score = idf * impact
+                if score > scores.get(key, 0.0):
+                    scores[key] = score
+                taken += 1
+                if taken == limit:
+                    break
+        return scores
+
+    def _candidates(self, word: str, accept) -> list:
+        """Documents containing ``word``; only its best ``MAX_CANDIDATES`` if it is common."""
+        postings = self._postings[word]
+        if len(postings) <= MAX_CANDIDATES:
+            return [key for key in postings if accept is None or accept(key)]
+        candidates = []
+        for _, key in self._ranked(word):
+            if accept is None or accept(key):
+                candidates.append(key)
+                if len(candidates) == MAX_CANDIDATES:
+                    break
+        return candidates
+
+    def search(self, text: str, limit: int = 20, accept=None) -> list:
+        """
+        Return up to ``limit`` ``(score, key)`` pairs, best first.
+
+        Every query word must match; the last one also matches as a prefix
+        unless the query ends in whitespace. ``accept(key)`` filters documents.
+        """
+        words = tokenize(text)
+        if not words or not self._lengths:
+            return []
+        prefix = None if text[-1].isspace() else words.pop()
+        words = [word for word in dict.fromkeys(words) if word not in STOP_WORDS]
+
+        if not words:
+            if prefix is None:
+                return []
+            # A single word being typed: merge the best of each completion
+            scores = self._top(self._completions(prefix), limit, accept)
+            best = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+            return [(score, key) for key, score in best]
+
+        if any(word not in self._postings for word in words):
+            return []
+        # The rarest complete word picks the candidates; the other words are
+        # looked up in each candidate's own terms
+        words.sort(key=lambda word: len(self._postings[word]))
+        average_length = self._total_length / len(self._lengths)
+        idf = {word: self._idf(word) for word in words}
+        scores = {}
+        for key in self._candidates(words[0], accept):
+            terms, length = self._doc_terms[key], self._lengths[key]
+            score = 0.0
+            for word in words:
+                frequency = terms.get(word)
+                if frequency is None:
+                    break
+                score += idf[word] * self._impact(frequency, length, average_length)
+            else:
+                scores[key] = score
+        if prefix is not None and scores:
+            matches = self._prefix_scores(prefix, scores, average_length)
+            scores = {key: score + matches[key] for key, score in scores.items() if key in matches}
+
+        best = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+        return [(score, key) for key, score in best]
+
+    def _prefix_scores(self, prefix: str, candidates: dict, average_length: float) -> dict:
+        """Each candidate's best score for a term starting with ``prefix``."""
+        completions = self._vocabulary(prefix)
+        walk = sum(len(self._postings[term]) for term in completions)
+        probe = sum(len(self._doc_terms[key]) for key in candidates)
+        k1, b = self.k1, self.b
+        idf = {
+            term: (1.0 if term == prefix else PREFIX_MATCH_WEIGHT) * self._idf(term)
+            for term in completions
+        } if walk < probe else {}
+        scores = {}
+
+        # Walk the completions' postings or each candidate's terms, whichever is shorter
+        if walk < probe:
+            for term in completions:
+                weight = idf[term] * (k1 + 1)
+                for key, frequency in self._postings[term].items():
+                    if key in candidates:
+                        norm = k1 * (1 - b + b * self._lengths[key] / average_length)
+                        score = weight * frequency / (frequency + norm)
+                        if score > scores.get(key, 0.0):
+                            scores[key] = score
+        else:
+            for key in candidates:
+                norm = k1 * (1 - b + b * self._lengths[key] / average_length)
+                best = 0.0
+                for term, frequency in self._doc_terms[key].items():
+                    if term.startswith(prefix):
+                        weight = idf.get(term)
+                        if weight is None:
+                            weight = idf[term] = (
+                                (1.0 if term == prefix else PREFIX_MATCH_WEIGHT) * self._idf(term) * (k1 + 1)
+                            )
+                        score = weight * frequency / (frequency + norm)
+                        if score > best:
+                            best = score
+                if best:
+                    scores[key] = best
+        return scores
+
+    def __len__(self):
+        return len(self._lengths)
+
+
+class SearchStore(ProgramIndex):
+    """Keeps the search index in step with program writes."""
+
+    columns = SEARCH_COLUMNS
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self._providers = {}
+        super().__init__(max_age=INDEX_MAX_AGE)
+
+    def reset(self):
+        self.index = InvertedIndex()
+        for provider in self._providers.values():
+            self._add_provider(provider)
+
+    def add(self, row: dict):
+        provider = row.get("providers")
+        self.index.add(("program", row["program_id"]), row, PROGRAM_FIELDS, {
+            "type": "program",
+            "id": row["program_id"],
+            "name": row["name"],
+            "category": row.get("category"),
+            "address": row.get("address"),
+            "provider_name": provider["name"] if provider else None,
+        })
+
+    def discard(self, program_id: str):
+        self.index.remove(("program", program_id))
+
+    def _add_provider(self, row: dict):
+        self.index.add(("provider", row["provider_id"]), row, PROVIDER_FIELDS, {
+            "type": "provider",
+            "id": row["provider_id"],
+            "name": row["name"],
+            "description": row.get("description"),
+        })
+
+    async def after_load(self):
+        # Providers have no write routes, so they are only refreshed with the programs
+        providers = {row["provider_id"]: row for row in await repository.list_providers()}
+        for provider_id in self._providers.keys() - providers.keys():
+            self.index.remove(("provider", provider_id))
+        for provider in providers.values():
+            self._add_provider(provider)
+        self._providers = providers
+
+    async def search(self, text: str, limit: int = 20, kind: str = None) -> list:
+        await self.ensure_loaded()
+        accept = (lambda key: key[0] == kind) if kind else None
+        return [
+            {**self.index.payloads[key], "score": round(score, 4)}
+            for score, key in self.index.search(text, limit, accept)
+        ]
+
+
+catalogue = SearchStore()
@@ -0,0 +1,38 @@
+"""
+Upstream rows to response bytes.
+
+Rows read from PostgREST already have the schema's types, so the read
+routes don't rebuild and re-validate them as Pydantic models: they reshape
+them with :func:`program_out` and serialise straight to bytes with orjson
+through :func:`json_response`. The models stay as the routes'
+``response_model`` for validation of writes and the OpenAPI schema.
+"""
+from typing import Optional
+
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+
+
+def dumps(value) -> bytes:
+    """orjson with a ``str`` fallback for types it doesn't know (UUID is native)."""
+    return orjson.dumps(value, default=str)
+
+
+def program_out(row: dict) -> dict:
+    """A program row as the API returns it: the embedded provider flattened to provider_name."""
+    program = {key: value for key, value in row.items() if key != "providers"}
+    provider = row.get("providers")
+    program["provider_name"] = provider["name"] if provider else None
+    return program
+
+
+def json_response(content, response: Optional[Response] = None) -> ORJSONResponse:
+    """
+    Serialise ``content`` with orjson, skipping FastAPI's response validation.
+
+    Headers already set on the route's injected ``response`` (ETag,
+    X-Next-Cursor, ...) are carried over, since FastAPI ignores them when a
+    route returns a Response of its own.
+    """
+    return ORJSONResponse(content, headers=response.headers if response is not None else None)
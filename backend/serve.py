@@ -0,0 +1,104 @@
+"""
+Production server: gunicorn managing one uvicorn worker per CPU core.
+
+    python serve.py
+
+Each worker is a single event loop, so one per core (``WEB_CONCURRENCY`` to
+override) keeps every core busy without the switching that more would add.
+The app is imported once, in the master, before the workers are forked
+(``preload_app``): a worker starts without importing anything and shares the
+imported code's memory with the others. Anything holding sockets or threads
+(the Supabase clients, the upstream thread pool, background tasks) is created
+in each worker, on first use or in the app's lifespan, never at import.
+
+A worker warms up (see :mod:`health`) before it accepts connections. On
+SIGTERM it stops accepting, ends its event streams and gives requests in
+flight up to ``GRACEFUL_TIMEOUT`` seconds to finish; a crashed worker is
+replaced by the master.
+"""
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn_worker import UvicornWorker
+
+import health
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+
+# Seconds a stopping worker waits for requests in flight
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "25"))
+
+# Seconds an idle keep-alive connection is held open (nginx reuses them)
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+
+
+def worker_count() -> int:
+    """One worker per core this process may run on."""
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.getenv("WEB_CONCURRENCY"))
+    try:
+        # Respects CPU affinity, e.g. under taskset or a container's cpuset
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class DrainingServer(Server):
+    """A uvicorn server that drains the app before it waits for connections to close."""
+
+    async def shutdown(self, sockets=None):
+        health.drain()
+        await super().shutdown(sockets)
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "timeout_graceful_shutdown": GRACEFUL_TIMEOUT}
+
+    async def _serve(self):
+        # As UvicornWorker._serve, with DrainingServer
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+class Application(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def options() -> dict:
+    return {
+        "bind": f"{HOST}:{PORT}",
+        "workers": worker_count(),
+        "worker_class": Worker,
+        "preload_app": True,
+        "keepalive": KEEPALIVE,
+        # After this the master kills a stopping worker; leave room for the lifespan shutdown
+        "graceful_timeout": GRACEFUL_TIMEOUT + 5,
+        # Request logs would duplicate http_requests_total; errors still go to stderr
+        "accesslog": None,
+    }
+
+
+def main():
+    Application(options()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,89 @@ Unit tests for the Inner Voice Sydney backend application.
 These tests cover basic functionality including models and API endpoints.
 """
 
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import time
+
+import jwt
+import httpx
 import pytest
 from datetime import date
 from fastapi.testclient import TestClient
+from supabase import create_client
+
+from benchmarks import load_profiles
+from benchmarks.stub_postgrest import StubPostgREST, access_token, seed
+from cache import ReadThroughCache
 from main import app
-from routes.program_routes import ProgramCreate, ProgramUpdate, Program
+from routes.program_routes import MAX_BATCH_IDS, ProgramCreate, ProgramUpdate, Program
+import admission
+import auth
+import bulk_import
+import changes
+import compression
+import conditional
+import events
+import export
+import facets
+import geo
+import health
+import logs
+import metrics
+import recurrence
+import replica
+import repository
+import resilience
+import search
+import serialization
+import serve
+import tracing
 
 
 # Create a test client
 client = TestClient(app)
 
 
+@pytest.fixture
+def upstream(monkeypatch):
+    """A local stub PostgREST server seeded with a small catalogue."""
+    stub = StubPostgREST(seed(programs=50, providers=5))
+    stub.start()
+    monkeypatch.setattr(repository, "supabase_admin", create_client(stub.url, "stub.service.key"))
+    repository.cache.clear()
+    # Make the in-memory indexes reload from this stub
+    monkeypatch.setattr(recurrence.occurrences, "_loaded_at", float("-inf"))
+    monkeypatch.setattr(geo.locations, "_loaded_at", float("-inf"))
+    monkeypatch.setattr(geo.locations, "_places", {})
+    monkeypatch.setattr(geo.locations, "_unresolved", set())
+    monkeypatch.setattr(geo.locations, "_resolving", None)
+    monkeypatch.setattr(search.catalogue, "_loaded_at", float("-inf"))
+    monkeypatch.setattr(search.catalogue, "_providers", {})
+    monkeypatch.setattr(facets.aggregates, "_loaded_at", float("-inf"))
+    repository.profile_cache.clear()
+    monkeypatch.setattr(resilience, "breakers", {})
+    monkeypatch.setattr(changes.log, "_settled", None)
+    monkeypatch.setattr(changes.log, "_entries", {})
+    monkeypatch.setattr(changes.log, "_versions", [])
+    monkeypatch.setattr(changes.log, "_refreshed_at", float("-inf"))
+    # A pump task from an earlier test's event loop may have died holding it
+    monkeypatch.setattr(changes.log, "_lock", asyncio.Lock())
+    monkeypatch.setattr(events.feed, "_subscribers", set())
+    monkeypatch.setattr(events.feed, "_published", {})
+    monkeypatch.setattr(events.feed, "_cursor", None)
+    monkeypatch.setattr(events.feed, "_pump", None)
+    yield stub
+    repository.cache.clear()
+    stub.stop()
+
+
 class TestPydanticModels:
     """Test cases for Pydantic models validation."""
     
@@ -162,6 +234,2117 @@ class TestModelValidation:
         assert program_dict["category"] == "Test Category"
 
 
+class TestRepository:
+    """Test cases for the async data-access layer (no database access)."""
+
+    def test_execute_does_not_block_event_loop(self):
+        """Test that concurrent queries overlap instead of running back to back."""
+        class SlowQuery:
+            def execute(self):
+                time.sleep(0.2)
+                return "done"
+
+        async def run_many():
+            return await asyncio.gather(*(repository.execute(SlowQuery()) for _ in range(10)))
+
+        started = time.perf_counter()
+        results = asyncio.run(run_many())
+
+        assert results == ["done"] * 10
+        assert time.perf_counter() - started < 1.0
+
+    def test_get_program_flattens_provider_name(self, monkeypatch):
+        """Test that the route maps the embedded provider onto provider_name."""
+        async def fake_get_program(program_id, with_etag=False):
+            return [{
+                "program_id": program_id,
+                "name": "Repo Program",
+                "provider_id": "provider123",
+                "providers": {"provider_id": "provider123", "name": "Repo Provider"},
+            }], '"etag"'
+
+        monkeypatch.setattr(repository, "get_program", fake_get_program)
+        response = client.get("/api/programs/abc")
+
+        assert response.status_code == 200
+        assert response.json()["provider_name"] == "Repo Provider"
+        assert "providers" not in response.json()
+
+    def test_get_program_not_found(self, monkeypatch):
+        """Test that an empty upstream result becomes a 404."""
+        async def fake_get_program(program_id, with_etag=False):
+            return [], None
+
+        monkeypatch.setattr(repository, "get_program", fake_get_program)
+        response = client.get("/api/programs/missing")
+
+        assert response.status_code == 404
+
+
+class TestAuth:
+    """Test cases for in-process JWT verification (no calls to Supabase auth)."""
+
+    SECRET = "test-jwt-secret"
+
+    @pytest.fixture(autouse=True)
+    def local_secret(self, monkeypatch):
+        monkeypatch.setattr(auth, "JWT_SECRET", self.SECRET)
+        auth._user_cache.clear()
+
+        def no_remote_calls(token):
+            raise AssertionError("auth.get_user should not be called")
+
+        monkeypatch.setattr(auth.public_client().auth, "get_user", no_remote_calls)
+        yield
+        auth._user_cache.clear()
+
+    def make_token(self, secret=SECRET, expires_in=3600, **claims):
+        payload = {
+            "sub": "user-123",
+            "email": "user@example.com",
+            "aud": "authenticated",
+            "role": "authenticated",
+            "exp": int(time.time()) + expires_in,
+            "user_metadata": {"full_name": "Test User"},
+            **claims,
+        }
+        return jwt.encode(payload, secret, algorithm="HS256")
+
+    def test_valid_token_is_verified_locally(self):
+        """Test that a token signed with the project secret authenticates."""
+        response = client.get(
+            "/api/debug-auth", headers={"Authorization": f"Bearer {self.make_token()}"}
+        )
+
+        assert response.status_code == 200
+        assert response.json()["user_id"] == "user-123"
+        assert response.json()["user_metadata"] == {"full_name": "Test User"}
+
+    def test_verified_user_is_cached(self):
+        """Test that a second request with the same token skips verification."""
+        token = self.make_token()
+        client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}"})
+
+        assert len(auth._user_cache) == 1
+
+    def test_wrong_secret_rejected(self):
+        """Test that a token signed with another secret is rejected."""
+        token = self.make_token(secret="someone-elses-secret")
+        response = client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}"})
+
+        assert response.status_code == 401
+
+    def test_expired_token_rejected(self):
+        """Test that an expired token is rejected."""
+        token = self.make_token(expires_in=-3600)
+        response = client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}"})
+
+        assert response.status_code == 401
+
+    def test_asymmetric_token_verified_with_cached_jwks(self, monkeypatch):
+        """Test that ES256 tokens are verified against the cached key set."""
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key()))
+        jwk.update({"kid": "key-1", "alg": "ES256"})
+
+        key_set = auth.KeySet("http://jwks.invalid")
+        key_set._keys = {"key-1": jwt.PyJWK(jwk)}
+        key_set._fetched_at = time.monotonic()
+        monkeypatch.setattr(auth, "_key_set", key_set)
+
+        token = jwt.encode(
+            {"sub": "user-456", "aud": "authenticated", "exp": int(time.time()) + 60},
+            private_key,
+            algorithm="ES256",
+            headers={"kid": "key-1"},
+        )
+        response = client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}"})
+
+        assert response.status_code == 200
+        assert response.json()["user_id"] == "user-456"
+
+
+class TestListPrograms:
+    """Test cases for pagination and filtering of GET /api/programs."""
+
+    def test_keyset_pagination_walks_whole_catalogue(self, upstream):
+        """Test that following X-Next-Cursor returns every program exactly once."""
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 20, **({"cursor": cursor} if cursor else {})}
+            response = client.get("/api/programs", params=params)
+            assert response.status_code == 200
+            assert len(response.json()) <= 20
+            seen += [p["program_id"] for p in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+
+        assert seen == sorted(p["program_id"] for p in upstream.store.tables["programs"])
+
+    def test_filters_are_pushed_down(self, upstream):
+        """Test that is_approved and has_place filter upstream."""
+        rows = upstream.store.tables["programs"]
+        response = client.get(
+            "/api/programs", params={"is_approved": "false", "has_place": "true", "limit": 1000}
+        )
+
+        expected = [p for p in rows if p["is_approved"] is False and p["place_id"]]
+        assert len(response.json()) == len(expected)
+        assert all(p["is_approved"] is False and p["place_id"] for p in response.json())
+
+    def test_fields_projection(self, upstream):
+        """Test that fields= limits the returned columns and can flatten provider_name."""
+        response = client.get("/api/programs", params={"fields": "name,provider_name"})
+        program = response.json()[0]
+
+        assert set(program) == {"program_id", "name", "provider_name"}
+        assert program["provider_name"].startswith("Provider")
+
+    def test_unknown_field_rejected(self, upstream):
+        """Test that an unknown projection field is a 400, not a 500."""
+        response = client.get("/api/programs", params={"fields": "name,password"})
+
+        assert response.status_code == 400
+
+    def test_invalid_cursor_rejected(self, upstream):
+        """Test that a malformed cursor is a 400."""
+        response = client.get("/api/programs", params={"cursor": "not-a-uuid"})
+
+        assert response.status_code == 400
+
+
+class TestProgramWrites:
+    """Test cases for single-round-trip program create and update."""
+
+    def test_create_program_single_round_trip(self, upstream):
+        """Test that create returns the provider name from one upstream call."""
+        provider = upstream.store.tables["providers"][0]
+        response = client.post(
+            "/api/programs", json={"name": "New Program", "provider_id": provider["provider_id"]}
+        )
+
+        assert response.status_code == 200
+        assert response.json()["provider_name"] == provider["name"]
+        assert sum(upstream.requests.values()) == 1
+
+    def test_create_program_unknown_provider(self, upstream):
+        """Test that the foreign key violation is reported as a 400."""
+        response = client.post(
+            "/api/programs",
+            json={"name": "Orphan", "provider_id": "00000000-0000-4000-8000-000000000000"},
+        )
+
+        assert response.status_code == 400
+
+    def test_update_program_single_round_trip(self, upstream):
+        """Test that update returns the updated program from one upstream call."""
+        program = upstream.store.tables["programs"][0]
+        response = client.put(
+            f"/api/programs/{program['program_id']}", json={"is_approved": False}
+        )
+
+        assert response.status_code == 200
+        assert response.json()["is_approved"] is False
+        assert response.json()["provider_name"] is not None
+        assert sum(upstream.requests.values()) == 1
+
+    def test_update_missing_program(self, upstream):
+        """Test that updating a program that doesn't exist is a 404."""
+        response = client.put(
+            "/api/programs/00000000-0000-4000-8000-000000000000", json={"name": "Ghost"}
+        )
+
+        assert response.status_code == 404
+
+
+class TestReadCache:
+    """Test cases for the catalogue read-through cache."""
+
+    def test_repeat_reads_hit_cache(self, upstream):
+        """Test that a second read of the same program doesn't go upstream."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        first = client.get(f"/api/programs/{program_id}")
+        second = client.get(f"/api/programs/{program_id}")
+
+        assert first.json() == second.json()
+        assert upstream.requests[("GET", "programs")] == 1
+        assert client.get("/api/cache/stats").json()["hits"] >= 1
+
+    def test_update_invalidates_program_list_and_providers(self, upstream):
+        """Test that an update drops the program, list pages and both providers' entries."""
+        program = upstream.store.tables["programs"][0]
+        old_provider = program["provider_id"]
+        new_provider = next(
+            p["provider_id"] for p in upstream.store.tables["providers"] if p["provider_id"] != old_provider
+        )
+        client.get(f"/api/programs/{program['program_id']}")
+        client.get("/api/programs")
+        client.get(f"/api/providers/{old_provider}")
+        client.get(f"/api/providers/{new_provider}")
+
+        client.put(f"/api/programs/{program['program_id']}", json={"provider_id": new_provider})
+
+        old_ids = [p["program_id"] for p in client.get(f"/api/providers/{old_provider}").json()["programs"]]
+        new_ids = [p["program_id"] for p in client.get(f"/api/providers/{new_provider}").json()["programs"]]
+        assert program["program_id"] not in old_ids
+        assert program["program_id"] in new_ids
+        assert client.get(f"/api/programs/{program['program_id']}").json()["provider_id"] == new_provider
+        assert upstream.requests[("GET", "programs")] == 3
+
+    def test_stale_while_revalidate(self):
+        """Test that an expired entry is served stale while it reloads in the background."""
+        cache = ReadThroughCache(ttl=0, stale_ttl=60)
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            return len(calls)
+
+        async def scenario():
+            first = await cache.get_or_load("k", loader)
+            stale = await cache.get_or_load("k", loader)
+            await asyncio.sleep(0)
+            return first, stale
+
+        first, stale = asyncio.run(scenario())
+
+        assert (first, stale) == (1, 1)
+        assert len(calls) == 2
+        assert cache.stale_hits == 1
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        """Test that the byte bound evicts the least recently used entries first."""
+        cache = ReadThroughCache(max_bytes=250)
+
+        async def scenario():
+            for key in ("a", "b", "c"):
+                await cache.get_or_load(key, lambda: asyncio.sleep(0, result="x" * 100))
+
+        asyncio.run(scenario())
+
+        assert cache.evictions == 1
+        assert cache.bytes <= 250
+        assert list(cache._entries) == ["b", "c"]
+
+
+class TestOccurrences:
+    """Test cases for server-side recurrence expansion."""
+
+    def schedule(self, **fields):
+        return recurrence._Schedule({"program_id": "p1", "name": "P", **fields})
+
+    def test_weekly_occurrences_in_window(self):
+        """Test that only the occurrences overlapping the window are produced."""
+        schedule = self.schedule(start_date="2025-01-06", date_interval="Weekly", repeat_interval=4)
+        found = list(schedule.between(date(2025, 1, 13), date(2025, 1, 20)))
+
+        assert [(i, start) for i, start, _ in found] == [(1, date(2025, 1, 13)), (2, date(2025, 1, 20))]
+
+    def test_monthly_clamps_to_month_end(self):
+        """Test that a monthly program on the 31st falls on the last day of short months."""
+        schedule = self.schedule(start_date="2025-01-31", date_interval="Monthly", repeat_interval=3)
+
+        assert [schedule.occurrence(i)[0] for i in range(3)] == [
+            date(2025, 1, 31), date(2025, 2, 28), date(2025, 3, 31)
+        ]
+
+    def test_index_matches_brute_force(self):
+        """Test that the interval tree returns exactly the overlapping programs."""
+        schedules = [recurrence._Schedule(p) for p in seed(programs=500)["programs"]]
+        index = recurrence.OccurrenceIndex(schedules)
+
+        for window_start, window_end in [
+            (date(2025, 1, 1), date(2025, 1, 31)),
+            (date(2025, 6, 10), date(2025, 6, 12)),
+            (date(2026, 3, 1), date(2026, 3, 31)),
+        ]:
+            expected = {s.program["program_id"] for s in schedules
+                        if s.first <= window_end and s.last >= window_start}
+            found = {s.program["program_id"] for s in index.overlapping(window_start, window_end)}
+            assert found == expected
+
+    def test_endpoint_reflects_new_program(self, upstream):
+        """Test that a created program shows up in an already expanded window."""
+        params = {"from": "2030-03-01", "to": "2030-03-31"}
+        assert client.get("/api/programs/occurrences", params=params).json() == []
+
+        client.post("/api/programs", json={
+            "name": "Fortnightly Club", "start_date": "2030-03-02",
+            "date_interval": "Fortnightly", "repeat_interval": 5,
+        })
+        starts = [o["start"] for o in client.get("/api/programs/occurrences", params=params).json()]
+
+        assert starts == ["2030-03-02", "2030-03-16", "2030-03-30"]
+
+    def test_oversized_repeats_are_capped_and_rejected(self, upstream):
+        """Test that stored rows with huge or out-of-range schedules don't break the index, and writes can't add them."""
+        programs = upstream.store.tables["programs"]
+        programs[0].update(start_date="2030-05-01", date_interval="Daily", repeat_interval=10**7)
+        programs[1].update(start_date="9999-12-20", date_interval="Weekly", repeat_interval=5)
+
+        # Daily from 2030-05-01, occurrence 999 is on 2033-01-24
+        response = client.get("/api/programs/occurrences", params={"from": "2033-01-01", "to": "2033-12-31"})
+        rejected = client.post("/api/programs", json={"name": "Forever", "repeat_interval": 10**7})
+
+        assert response.status_code == 200
+        found = [o for o in response.json() if o["program_id"] == programs[0]["program_id"]]
+        assert [o["occurrence"] for o in found] == list(range(976, recurrence.MAX_REPEATS))
+        assert found[-1]["start"] == "2033-01-24"
+        assert all(o["program_id"] != programs[1]["program_id"] for o in response.json())
+        assert rejected.status_code == 422
+
+    def test_endpoint_rejects_inverted_window(self, upstream):
+        """Test that a window ending before it starts is a 400."""
+        response = client.get("/api/programs/occurrences", params={"from": "2025-02-01", "to": "2025-01-01"})
+
+        assert response.status_code == 400
+
+
+def _fixture_location(place_id: str) -> tuple:
+    """Spread the seeded place_ids over a 20 x 25 grid around the Sydney CBD."""
+    n = int(place_id.split("-")[1])
+    return -33.90 + (n % 20) * 0.005, 151.15 + (n // 20) * 0.005
+
+
+class TestGeo:
+    """Test cases for the geocode cache, spatial index and GET /api/programs/near."""
+
+    @pytest.fixture
+    def geocoder(self, monkeypatch):
+        places = {f"place-{n}": _fixture_location(f"place-{n}") for n in range(0, 501, 2)}
+        geocoder = geo.FixtureGeocoder(places)
+        monkeypatch.setattr(geo.locations, "geocoder", geocoder)
+        return geocoder
+
+    def test_grid_matches_brute_force(self):
+        """Test that bbox and radius queries return exactly the points a full scan would."""
+        import random
+        rng = random.Random(7)
+        points = {i: (rng.uniform(-34.2, -33.5), rng.uniform(150.8, 151.5)) for i in range(2000)}
+        index = geo.GridIndex(cell=0.02)
+        for key, (lat, lng) in points.items():
+            index.put(key, lat, lng)
+
+        bbox = (-33.95, 151.0, -33.80, 151.25)
+        assert {k for k, _, _ in index.within_bbox(*bbox)} == {
+            k for k, (lat, lng) in points.items()
+            if bbox[0] <= lat <= bbox[2] and bbox[1] <= lng <= bbox[3]
+        }
+        assert {k for k, *_ in index.within_radius(-33.87, 151.21, 5000)} == {
+            k for k, (lat, lng) in points.items() if geo.haversine_m(-33.87, 151.21, lat, lng) <= 5000
+        }
+
+    def test_bbox_returns_located_programs(self, upstream, geocoder):
+        """Test that bbox results carry coordinates and stay inside the box."""
+        response = client.get("/api/programs/near", params={"bbox": "-33.90,151.15,-33.85,151.20"})
+
+        assert response.status_code == 200
+        programs = response.json()["programs"]
+        assert programs
+        for program in programs:
+            assert -33.90 <= program["lat"] <= -33.85 and 151.15 <= program["lng"] <= 151.20
+            assert int(program["place_id"].split("-")[1]) % 2 == 0
+
+    def test_places_are_geocoded_once_and_persisted(self, upstream, geocoder):
+        """Test that a reload reads stored coordinates instead of calling the geocoder."""
+        client.get("/api/programs/near", params={"bbox": "-90,-180,90,180"})
+        calls = geocoder.calls
+        stored = upstream.store.tables["place_locations"]
+
+        assert calls == len({p["place_id"] for p in upstream.store.tables["programs"] if p["place_id"]})
+        assert len(stored) == calls
+        assert any(row["lat"] is None for row in stored)
+
+        geo.locations.invalidate()
+        geo.locations._places.clear()
+        client.get("/api/programs/near", params={"bbox": "-90,-180,90,180"})
+
+        assert geocoder.calls == calls
+
+    def test_radius_is_nearest_first(self, upstream, geocoder):
+        """Test that radius results are sorted by distance and within the radius."""
+        params = {"lat": -33.87, "lng": 151.20, "radius": 2000}
+        programs = client.get("/api/programs/near", params=params).json()["programs"]
+
+        distances = [p["distance_m"] for p in programs]
+        assert distances == sorted(distances)
+        assert all(d <= 2000 for d in distances)
+
+    def test_clusters_cover_every_program(self, upstream, geocoder):
+        """Test that clustering at a low zoom keeps every located program."""
+        params = {"bbox": "-34,151,-33.7,151.4"}
+        programs = client.get("/api/programs/near", params=params).json()["programs"]
+        clusters = client.get("/api/programs/near", params={**params, "zoom": 10}).json()["clusters"]
+
+        assert sum(c["count"] for c in clusters) == len(programs)
+        assert len(clusters) < len(programs)
+
+    def test_new_program_is_geocoded_in_background(self, upstream, geocoder):
+        """Test that a created program with a new place_id becomes searchable."""
+        geocoder.locations["place-new"] = (-33.8688, 151.2093)
+        client.get("/api/programs/near", params={"bbox": "-90,-180,90,180"})
+
+        created = client.post("/api/programs", json={"name": "Harbour Walk", "place_id": "place-new"}).json()
+        params = {"lat": -33.8688, "lng": 151.2093, "radius": 50}
+        for _ in range(50):
+            programs = client.get("/api/programs/near", params=params).json()["programs"]
+            if programs:
+                break
+            time.sleep(0.02)
+
+        assert [p["program_id"] for p in programs] == [created["program_id"]]
+
+    def test_overlapping_resolves_geocode_each_place_once(self, upstream, geocoder, monkeypatch):
+        """Test that a resolve started while another is running waits for it instead of geocoding again."""
+        client.get("/api/programs/near", params={"bbox": "-90,-180,90,180"})
+        for place_id in ("place-new-1", "place-new-2"):
+            geocoder.locations[place_id] = (-33.8688, 151.2093)
+        monkeypatch.setattr(geo.locations, "_unresolved", {"place-new-1", "place-new-2"})
+        calls = geocoder.calls
+
+        async def overlapping():
+            await asyncio.gather(*(geo.locations.resolve_pending() for _ in range(3)))
+
+        asyncio.run(overlapping())
+
+        assert geocoder.calls == calls + 2
+        assert not geo.locations._unresolved
+
+    def test_requires_bbox_or_radius(self, upstream):
+        """Test that a query without a location is a 400."""
+        assert client.get("/api/programs/near", params={"lat": -33.87}).status_code == 400
+        assert client.get("/api/programs/near", params={"bbox": "1,2,3"}).status_code == 400
+
+
+class TestSearch:
+    """Test cases for the search index and GET /api/search."""
+
+    @staticmethod
+    def _index(documents: dict) -> search.InvertedIndex:
+        index = search.InvertedIndex()
+        for key, text in documents.items():
+            index.add(key, {"name": text}, {"name": 1.0}, {"id": key})
+        return index
+
+    def test_bm25_prefers_rarer_and_denser_matches(self):
+        """Test that a rare term outranks a common one and short fields outrank long ones."""
+        index = self._index({
+            "a": "yoga in the park",
+            "b": "yoga yoga",
+            "c": "park run",
+            "d": "park cleanup",
+            "e": "yoga for seniors and carers and families in the inner west",
+        })
+
+        assert [key for _, key in index.search("yoga ")] == ["b", "a", "e"]
+        assert [key for _, key in index.search("yoga park ")] == ["a"]
+
+    def test_last_word_matches_as_prefix(self):
+        """Test type-ahead: the last word is a prefix, earlier words are exact."""
+        index = self._index({"a": "Swimming lessons", "b": "Swim squad", "c": "Swing dance"})
+
+        assert {key for _, key in index.search("swi")} == {"a", "b", "c"}
+        assert {key for _, key in index.search("swim")} == {"a", "b"}
+        assert {key for _, key in index.search("swim ")} == {"b"}
+        assert index.search("swim dan") == []
+
+    def test_stop_words_are_ignored_between_words(self):
+        """Test that common words in a multi-word query don't have to match."""
+        index = self._index({"a": "Yoga by the harbour", "b": "Yoga at home"})
+
+        assert [key for _, key in index.search("yoga in the harb")] == ["a"]
+        assert {key for _, key in index.search("yoga h")} == {"a", "b"}
+
+    def test_accents_and_case_are_folded(self):
+        """Test that queries match regardless of accents and case."""
+        index = self._index({"a": "Café Connect"})
+
+        assert index.search("CAFE conn") != []
+
+    def test_remove_updates_vocabulary(self):
+        """Test that replacing a document drops terms it no longer has."""
+        index = self._index({"a": "Chess club"})
+        assert index.search("che")
+
+        index.add("a", {"name": "Book club"}, {"name": 1.0}, {"id": "a"})
+
+        assert index.search("che") == []
+        assert [key for _, key in index.search("boo")] == ["a"]
+        assert len(index) == 1
+
+    def test_endpoint_searches_programs_and_providers(self, upstream):
+        """Test that /api/search returns both kinds and honours type=."""
+        results = client.get("/api/search", params={"q": "provider 3"}).json()
+        assert results[0]["type"] == "provider" and results[0]["name"] == "Provider 3"
+
+        programs = client.get("/api/search", params={"q": "program 1", "type": "program"}).json()
+        assert programs and all(r["type"] == "program" for r in programs)
+        assert programs[0]["name"] == "Program 1"
+
+    def test_endpoint_reflects_writes(self, upstream):
+        """Test that created and renamed programs are searchable without a reload."""
+        client.get("/api/search", params={"q": "warmup"})
+        scans = upstream.requests[("GET", "programs")]
+
+        created = client.post("/api/programs", json={"name": "Origami Workshop"}).json()
+        assert [r["id"] for r in client.get("/api/search", params={"q": "orig"}).json()] == [created["program_id"]]
+
+        client.put(f"/api/programs/{created['program_id']}", json={"name": "Paper Cranes"})
+        assert client.get("/api/search", params={"q": "orig"}).json() == []
+        assert client.get("/api/search", params={"q": "crane"}).json()[0]["id"] == created["program_id"]
+        assert upstream.requests[("GET", "programs")] == scans
+
+    def test_failed_provider_load_is_retried(self, upstream, monkeypatch):
+        """Test that an index whose providers failed to load isn't kept as loaded, so the next search retries."""
+        list_providers = repository.list_providers
+
+        async def fail_once():
+            monkeypatch.setattr(repository, "list_providers", list_providers)
+            raise RuntimeError("providers query failed")
+
+        monkeypatch.setattr(repository, "list_providers", fail_once)
+
+        failed = client.get("/api/search", params={"q": "provider 3", "type": "provider"})
+        retried = client.get("/api/search", params={"q": "provider 3", "type": "provider"})
+
+        assert failed.status_code == 500
+        assert retried.status_code == 200
+        assert retried.json()[0]["name"] == "Provider 3"
+
+
+class TestBulkImport:
+    """Test cases for POST /api/programs/bulk."""
+
+    MISSING_PROVIDER = "00000000-0000-4000-8000-000000000000"
+
+    def test_csv_import_in_batches(self, upstream):
+        """Test that a CSV body is inserted in batches with one provider lookup."""
+        provider = upstream.store.tables["providers"][0]
+        before = len(upstream.store.tables["programs"])
+        lines = ["name,description,start_date,repeat_interval"]
+        lines += [f"Imported {i},,2025-03-0{i % 9 + 1},{i % 4 or ''}" for i in range(25)]
+        lines.append('"Quoted, Program","Runs on\ntwo lines",,')
+        body = "\r\n".join(lines).encode()
+
+        response = client.post(
+            "/api/programs/bulk",
+            params={"batch_size": 10, "provider_id": provider["provider_id"]},
+            content=body,
+            headers={"Content-Type": "text/csv"},
+        )
+
+        assert response.json() == {"inserted": 26, "failed": 0, "errors": [], "errors_truncated": False}
+        programs = upstream.store.tables["programs"][before:]
+        assert {p["provider_id"] for p in programs} == {provider["provider_id"]}
+        assert any(p.get("description") == "Runs on\ntwo lines" for p in programs)
+        assert upstream.requests[("GET", "providers")] == 1
+        assert upstream.requests[("POST", "programs")] == 3
+
+    def test_open_breaker_stops_the_import_with_a_503(self, upstream):
+        """Test that an import during an outage is a 503 with Retry-After, saying which rows to send again."""
+        breaker = resilience.breaker_for("programs")
+        breaker.state, breaker.opened_at = resilience.CircuitBreaker.OPEN, time.monotonic()
+        before = len(upstream.store.tables["programs"])
+        body = "\n".join(json.dumps({"name": f"Outage {i}"}) for i in range(50)).encode()
+
+        response = client.post(
+            "/api/programs/bulk",
+            params={"batch_size": 10, "concurrency": 1},
+            content=body,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+
+        assert response.status_code == 503
+        assert int(response.headers["retry-after"]) >= 1
+        detail = response.json()["detail"]
+        assert detail["inserted"] == 0
+        assert detail["failed"] == len(detail["errors"]) < 50
+        assert {e["error"] for e in detail["errors"]} == {"Upstream unavailable, retry this row"}
+        assert len(upstream.store.tables["programs"]) == before
+
+    def test_ndjson_reports_row_errors(self, upstream):
+        """Test that invalid rows are reported by row number and valid rows still land."""
+        provider_id = upstream.store.tables["providers"][0]["provider_id"]
+        rows = [
+            json.dumps({"name": "Good One", "provider_id": provider_id}),
+            "{not json",
+            json.dumps({"description": "no name"}),
+            json.dumps({"name": "Bad Date", "start_date": "2025-13-40"}),
+            "",
+            json.dumps({"name": "Orphan", "provider_id": self.MISSING_PROVIDER}),
+            json.dumps({"name": "Not A UUID", "provider_id": "acme"}),
+            json.dumps({"name": "Good Two"}),
+        ]
+
+        response = client.post(
+            "/api/programs/bulk",
+            content="\n".join(rows).encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+
+        result = response.json()
+        assert result["inserted"] == 2
+        assert [e["row"] for e in result["errors"]] == [2, 3, 4, 5, 6]
+        assert "not found" in result["errors"][3]["error"]
+
+    def test_rejected_batch_is_split_to_the_bad_row(self, upstream):
+        """Test that a batch the database rejects is retried in halves."""
+        provider_id = upstream.store.tables["providers"][0]["provider_id"]
+        importer = bulk_import.ProgramImport(ProgramCreate)
+        batch = [(i + 1, {"name": f"Row {i}", "provider_id": provider_id}) for i in range(8)]
+        # Slip a row past the provider check so only the database can reject it
+        batch[5][1]["provider_id"] = self.MISSING_PROVIDER
+
+        asyncio.run(importer._insert(batch))
+
+        assert importer.inserted == 7
+        assert [e["row"] for e in importer.errors] == [6]
+
+    def test_requires_a_known_format(self, upstream):
+        """Test that a body without a recognised Content-Type or format= is a 415."""
+        response = client.post("/api/programs/bulk", content=b"name\nX", headers={"Content-Type": "text/plain"})
+
+        assert response.status_code == 415
+
+    def test_csv_without_name_column(self, upstream):
+        """Test that a CSV header without a name column is a 400 before anything is inserted."""
+        response = client.post("/api/programs/bulk", params={"format": "csv"}, content=b"title\nX")
+
+        assert response.status_code == 400
+        assert response.json()["detail"]["inserted"] == 0
+
+
+class TestProgramBatch:
+    """Test cases for POST /api/programs/batch."""
+
+    MISSING = "00000000-0000-4000-8000-000000000000"
+
+    def test_one_query_for_many_programs(self, upstream):
+        """Test that uncached programs are read with a single upstream query, in request order."""
+        program_ids = [p["program_id"] for p in upstream.store.tables["programs"][:20]][::-1]
+        upstream.requests.clear()
+
+        response = client.post("/api/programs/batch", json={"program_ids": [*program_ids, self.MISSING]})
+
+        assert response.status_code == 200
+        programs = response.json()["programs"]
+        assert list(programs) == [*program_ids, self.MISSING]
+        assert programs[self.MISSING] is None
+        assert programs[program_ids[0]] == client.get(f"/api/programs/{program_ids[0]}").json()
+        assert upstream.requests == {("GET", "programs"): 1}
+
+    def test_shares_the_cache_with_single_reads(self, upstream):
+        """Test that cached programs, found or not, aren't read again, and batch reads fill the cache."""
+        first, second, third = (p["program_id"] for p in upstream.store.tables["programs"][:3])
+        client.get(f"/api/programs/{first}")
+        client.get(f"/api/programs/{self.MISSING}")
+        upstream.requests.clear()
+
+        client.post("/api/programs/batch", json={"program_ids": [first, second, self.MISSING]})
+        client.get(f"/api/programs/{second}")
+        assert upstream.requests == {("GET", "programs"): 1}
+
+        client.put(f"/api/programs/{first}", json={"name": "Renamed"})
+        upstream.requests.clear()
+        programs = client.post("/api/programs/batch", json={"program_ids": [first, second, third]}).json()["programs"]
+
+        assert programs[first]["name"] == "Renamed"
+        assert upstream.requests == {("GET", "programs"): 1}
+
+    def test_batch_lookups_are_counted_apart(self, upstream):
+        """Test that a batch's per-id cache lookups don't count as get_or_load hits or misses."""
+        program_ids = [p["program_id"] for p in upstream.store.tables["programs"][:10]]
+        client.get(f"/api/programs/{program_ids[0]}")
+        before = repository.cache.stats()
+
+        client.post("/api/programs/batch", json={"program_ids": program_ids})
+        after = repository.cache.stats()
+
+        assert (after["hits"], after["misses"]) == (before["hits"], before["misses"])
+        assert after["batch_hits"] - before["batch_hits"] == 1
+        assert after["batch_misses"] - before["batch_misses"] == 9
+
+    def test_limits(self, upstream):
+        """Test that empty, oversized and malformed id lists are rejected."""
+        too_many = [self.MISSING] * (MAX_BATCH_IDS + 1)
+
+        assert client.post("/api/programs/batch", json={"program_ids": []}).status_code == 422
+        assert client.post("/api/programs/batch", json={"program_ids": too_many}).status_code == 422
+        assert client.post("/api/programs/batch", json={"program_ids": ["not-a-uuid"]}).status_code == 422
+
+
+class TestProfile:
+    """Test cases for GET /api/profile and PUT /api/profiles/{user_id}/role."""
+
+    @pytest.fixture(autouse=True)
+    def stub_auth(self, upstream, monkeypatch):
+        monkeypatch.setattr(auth, "JWT_SECRET", upstream.jwt_secret)
+        auth._user_cache.clear()
+        yield
+        auth._user_cache.clear()
+
+    @staticmethod
+    def headers(upstream, email):
+        return {"Authorization": f"Bearer {access_token(upstream.jwt_secret, email=email)}"}
+
+    def test_first_request_creates_and_later_ones_are_cached(self, upstream):
+        """Test that a new user's profile is created by one upsert and then served from the cache."""
+        headers = self.headers(upstream, "new@example.com")
+        upstream.requests.clear()
+
+        first = client.get("/api/profile", headers=headers)
+        for _ in range(5):
+            assert client.get("/api/profile", headers=headers).json() == first.json()
+
+        assert first.status_code == 200
+        assert first.json()["email"] == "new@example.com"
+        assert upstream.requests == {("POST", "profiles"): 1}
+
+    def test_existing_profile_keeps_its_role(self, upstream):
+        """Test that the upsert returns an existing profile without resetting its other columns."""
+        headers = self.headers(upstream, "staff@example.com")
+        user_id = client.get("/api/profile", headers=headers).json()["user_id"]
+        upstream.store.index["profiles"][user_id]["role"] = "admin"
+        repository.profile_cache.clear()
+
+        profile = client.get("/api/profile", headers=headers).json()
+
+        assert profile["role"] == "admin"
+        assert len(upstream.store.tables["profiles"]) == 1
+
+    def test_role_change_invalidates_the_cached_profile(self, upstream):
+        """Test that an admin's role change is visible on the user's next request."""
+        admin, user = self.headers(upstream, "admin@example.com"), self.headers(upstream, "user@example.com")
+        admin_id = client.get("/api/profile", headers=admin).json()["user_id"]
+        user_id = client.get("/api/profile", headers=user).json()["user_id"]
+        upstream.store.index["profiles"][admin_id]["role"] = "admin"
+        repository.profile_cache.pop(admin_id)
+
+        response = client.put(f"/api/profiles/{user_id}/role", json={"role": "moderator"}, headers=admin)
+
+        assert response.status_code == 200
+        assert client.get("/api/profile", headers=user).json()["role"] == "moderator"
+
+    def test_role_change_requires_admin(self, upstream):
+        """Test that non-admins get a 403 and unknown users a 404."""
+        admin, user = self.headers(upstream, "admin@example.com"), self.headers(upstream, "user@example.com")
+        admin_id = client.get("/api/profile", headers=admin).json()["user_id"]
+        user_id = client.get("/api/profile", headers=user).json()["user_id"]
+        upstream.store.index["profiles"][admin_id]["role"] = "admin"
+        repository.profile_cache.pop(admin_id)
+
+        forbidden = client.put(f"/api/profiles/{user_id}/role", json={"role": "admin"}, headers=user)
+        missing = client.put(f"/api/profiles/{TestApprovals.MISSING}/role", json={"role": "user"}, headers=admin)
+
+        assert forbidden.status_code == 403
+        assert upstream.store.index["profiles"][user_id].get("role") != "admin"
+        assert missing.status_code == 404
+
+    def test_demoted_admin_loses_the_right_at_once(self, upstream):
+        """Test that the admin check reads the stored role, not the cached profile."""
+        admin, user = self.headers(upstream, "admin@example.com"), self.headers(upstream, "user@example.com")
+        admin_id = client.get("/api/profile", headers=admin).json()["user_id"]
+        user_id = client.get("/api/profile", headers=user).json()["user_id"]
+        upstream.store.index["profiles"][admin_id]["role"] = "admin"
+        repository.profile_cache.pop(admin_id)
+        assert client.get("/api/profile", headers=admin).json()["role"] == "admin"
+
+        # Demoted elsewhere (another worker, or by hand); this worker's cache still says admin
+        upstream.store.index["profiles"][admin_id]["role"] = "user"
+        response = client.put(f"/api/profiles/{user_id}/role", json={"role": "moderator"}, headers=admin)
+
+        assert response.status_code == 403
+        assert client.get("/api/profile", headers=admin).json()["role"] == "user"
+
+
+class TestResilience:
+    """Test cases for upstream timeouts, retries, circuit breakers and serving stale data."""
+
+    @pytest.fixture(autouse=True)
+    def fast_backoff(self, monkeypatch):
+        monkeypatch.setattr(resilience, "BACKOFF_BASE", 0.001)
+
+    def test_failed_read_is_retried(self, upstream):
+        """Test that a read that hits a 503 is retried and succeeds."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        upstream.failures["programs"] = 1
+        upstream.requests.clear()
+        retries = resilience.RETRIES.value("programs")
+
+        response = client.get(f"/api/programs/{program_id}")
+
+        assert response.status_code == 200
+        assert upstream.requests == {("GET", "programs"): 2}
+        assert resilience.RETRIES.value("programs") == retries + 1
+
+    def test_failed_write_is_not_retried(self, upstream):
+        """Test that a write that hits a 503 is reported as a 503, after one attempt."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        upstream.failures["programs"] = 1
+        upstream.requests.clear()
+
+        response = client.put(f"/api/programs/{program_id}", json={"name": "Renamed"})
+
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+        assert upstream.requests == {("PATCH", "programs"): 1}
+
+    def test_slow_reads_are_cut_off(self, upstream, monkeypatch):
+        """Test that a read gives up after its budget instead of waiting on upstream."""
+        monkeypatch.setattr(resilience, "READ_TIMEOUT", 0.2)
+        upstream.latency = 1.0
+
+        started = time.monotonic()
+        response = client.get(f"/api/programs/{TestApprovals.MISSING}")
+
+        assert response.status_code == 503
+        assert time.monotonic() - started < 0.8
+
+    def test_open_breaker_fails_fast_then_recovers(self, upstream, monkeypatch):
+        """Test that the breaker stops calls after repeated failures and lets a trial call close it."""
+        monkeypatch.setattr(resilience, "READ_RETRIES", 0)
+        monkeypatch.setattr(resilience, "BREAKER_RESET_SECONDS", 0.2)
+        program_ids = [p["program_id"] for p in upstream.store.tables["programs"]]
+        upstream.failures["programs"] = float("inf")
+        for program_id in program_ids[:resilience.BREAKER_FAILURES]:
+            assert client.get(f"/api/programs/{program_id}").status_code == 503
+        upstream.requests.clear()
+
+        rejected = client.get(f"/api/programs/{program_ids[10]}")
+        assert rejected.status_code == 503
+        assert upstream.requests == {}
+        assert resilience.is_open("programs")
+        assert not resilience.is_open("providers")
+
+        upstream.failures.clear()
+        time.sleep(0.25)
+        assert client.get(f"/api/programs/{program_ids[10]}").status_code == 200
+        assert resilience.breakers["programs"].state == resilience.CircuitBreaker.CLOSED
+
+    def test_client_errors_do_not_open_the_breaker(self, upstream):
+        """Test that rejected writes (a missing foreign key) count as upstream answering."""
+        for _ in range(resilience.BREAKER_FAILURES + 1):
+            response = client.post("/api/programs", json={"name": "x", "provider_id": TestApprovals.MISSING})
+            assert response.status_code == 400
+
+        assert not resilience.is_open("programs")
+
+    def test_expired_entries_are_served_stale_during_an_outage(self, upstream):
+        """Test that an expired cached read is served with a Warning instead of a 503."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        fresh = client.get(f"/api/programs/{program_id}")
+        assert "warning" not in fresh.headers
+        for entry in repository.cache._entries.values():
+            entry.fresh_until = entry.stale_until = 0
+        upstream.failures["programs"] = float("inf")
+
+        stale = client.get(f"/api/programs/{program_id}")
+        missing = client.get(f"/api/programs/{upstream.store.tables['programs'][1]['program_id']}")
+
+        assert stale.status_code == 200
+        assert stale.json() == fresh.json()
+        assert stale.headers["warning"] == resilience.STALE_WARNING
+        assert missing.status_code == 503
+
+    def test_indexes_keep_serving_during_an_outage(self, upstream):
+        """Test that a due index reload that fails leaves the old index in service, marked stale."""
+        assert client.get("/api/search", params={"q": "provider 3"}).status_code == 200
+        search.catalogue._loaded_at -= search.catalogue.max_age + 1
+        upstream.failures["programs"] = float("inf")
+        upstream.requests.clear()
+
+        responses = [client.get("/api/search", params={"q": "provider 3"}) for _ in range(3)]
+
+        assert all(response.status_code == 200 for response in responses)
+        assert all(response.headers["warning"] == resilience.STALE_WARNING for response in responses)
+        # One reload attempt, with its retries; the later requests don't try again
+        assert upstream.requests[("GET", "programs")] == 1 + resilience.READ_RETRIES
+
+    def test_outage_is_a_503_on_every_route(self, upstream, monkeypatch):
+        """Test that routes without a last good copy report an outage as a 503 with Retry-After, not a 500."""
+        monkeypatch.setattr(auth, "JWT_SECRET", upstream.jwt_secret)
+        auth._user_cache.clear()
+        for table in ("programs", "providers", "profiles"):
+            upstream.failures[table] = float("inf")
+        headers = {"Authorization": f"Bearer {access_token(upstream.jwt_secret, email='outage@example.com')}"}
+
+        responses = {
+            "providers": client.get("/api/providers"),
+            "search": client.get("/api/search", params={"q": "provider"}),
+            "profile": client.get("/api/profile", headers=headers),
+        }
+        auth._user_cache.clear()
+
+        for route, response in responses.items():
+            assert response.status_code == 503, route
+            assert int(response.headers["retry-after"]) >= 1, route
+
+
+class TestAdmission:
+    """Test cases for concurrency limits, load shedding and per-token rate limits."""
+
+    def test_limit_queues_in_order_and_sheds(self):
+        """Test that waiters are admitted first come first served, and the overflow is shed."""
+        async def scenario():
+            limit = admission.ConcurrencyLimit(limit=1, queue=2, timeout=0.5)
+            admitted = []
+
+            async def request(n):
+                await limit.acquire()
+                admitted.append(n)
+
+            await limit.acquire()
+            waiting = [asyncio.create_task(request(n)) for n in (1, 2)]
+            await asyncio.sleep(0)
+            with pytest.raises(admission.Shed, match="queue_full"):
+                await limit.acquire()
+            assert limit.waiting == 2
+
+            limit.release()
+            await waiting[0]
+            limit.release()
+            await waiting[1]
+            assert admitted == [1, 2] and limit.active == 1 and limit.waiting == 0
+
+            with pytest.raises(admission.Shed, match="queue_timeout"):
+                await asyncio.wait_for(limit.acquire(), 0.1 + limit.timeout)
+            assert limit.waiting == 0
+
+        asyncio.run(scenario())
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        """Test that a client going away while queued frees its place."""
+        async def scenario():
+            limit = admission.ConcurrencyLimit(limit=1, queue=1, timeout=5)
+            await limit.acquire()
+            waiter = asyncio.create_task(limit.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            limit.release()
+            assert limit.active == 0 and limit.waiting == 0
+
+        asyncio.run(scenario())
+
+    def test_saturated_class_gets_fast_503(self, upstream, monkeypatch):
+        """Test that a full class is refused with Retry-After while other classes and health checks run."""
+        reads = admission.ConcurrencyLimit(limit=1, queue=0)
+        reads.active = 1
+        monkeypatch.setitem(admission.limits, admission.READS, reads)
+        shed = admission.SHED.value(admission.READS, "queue_full")
+
+        response = client.get("/api/programs", headers={"Origin": "http://localhost:5173"})
+
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "2"
+        assert response.headers["access-control-allow-origin"] == "*"
+        assert admission.SHED.value(admission.READS, "queue_full") == shed + 1
+        assert client.get("/health").status_code == 200
+        assert client.post("/api/programs", json={"name": "Still accepted"}).status_code == 200
+        assert reads.active == 1
+
+    def test_request_classes(self):
+        """Test how requests are sorted into classes."""
+        assert admission.request_class("GET", "/api/programs") == admission.READS
+        assert admission.request_class("POST", "/api/programs/batch") == admission.READS
+        assert admission.request_class("PUT", "/api/programs/abc") == admission.WRITES
+        assert admission.request_class("GET", "/api/profile") == admission.AUTH
+        assert admission.request_class("PUT", "/api/profiles/abc/role") == admission.WRITES
+        assert admission.request_class("GET", "/api/export/programs.csv") == admission.EXPORTS
+        assert admission.request_class("GET", "/api/stream/programs") is None
+        assert admission.request_class("GET", "/health/ready") is None
+
+    def test_per_token_rate_limit(self, upstream, monkeypatch):
+        """Test that a token past its burst gets a 429, without affecting other tokens."""
+        monkeypatch.setattr(admission, "RATE_LIMIT_PER_SECOND", 0.5)
+        monkeypatch.setattr(admission, "RATE_LIMIT_BURST", 2)
+        monkeypatch.setattr(admission, "buckets", admission.OrderedDict())
+        busy, other = {"Authorization": "Bearer busy"}, {"Authorization": "Bearer other"}
+
+        statuses = [client.get("/api/programs", headers=busy).status_code for _ in range(3)]
+        refused = client.get("/api/programs", headers=busy)
+
+        assert statuses == [200, 200, 429]
+        assert refused.headers["retry-after"] == "2"
+        assert client.get("/api/programs", headers=other).status_code == 200
+        assert client.get("/api/programs").status_code == 200
+
+
+class TestApprovals:
+    """Test cases for POST /api/programs/approvals."""
+
+    MISSING = "00000000-0000-4000-8000-000000000000"
+
+    def test_plain_approvals_take_one_upstream_call(self, upstream):
+        """Test that approving without edits is one PATCH however many programs."""
+        pending = [p["program_id"] for p in upstream.store.tables["programs"] if not p["is_approved"]]
+        assert client.get("/api/programs", params={"is_approved": "false"}).json()
+        upstream.requests.clear()
+
+        response = client.post("/api/programs/approvals", json={
+            "decisions": [{"program_id": pid, "decision": "approve"} for pid in pending],
+        })
+
+        assert response.status_code == 200
+        assert {p["program_id"] for p in response.json()["updated"]} == set(pending)
+        assert upstream.requests == {("PATCH", "programs"): 1}
+        assert client.get("/api/programs", params={"is_approved": "false"}).json() == []
+
+    def test_mixed_decisions_group_by_patch(self, upstream):
+        """Test that edits, rejections and unknown ids are handled in one request."""
+        first, second, third = (p["program_id"] for p in upstream.store.tables["programs"][:3])
+        upstream.requests.clear()
+
+        result = client.post("/api/programs/approvals", json={"decisions": [
+            {"program_id": first, "decision": "approve"},
+            {"program_id": second, "decision": "approve", "changes": {"name": "Renamed", "start_date": "2025-02-03"}},
+            {"program_id": third, "decision": "reject"},
+            {"program_id": self.MISSING, "decision": "approve"},
+        ]}).json()
+
+        by_id = {p["program_id"]: p for p in result["updated"]}
+        assert by_id[second]["name"] == "Renamed" and by_id[second]["is_approved"] is True
+        assert by_id[third]["is_approved"] is False
+        assert result["not_found"] == [self.MISSING]
+        assert upstream.requests == {("PATCH", "programs"): 3}
+
+    def test_failed_patch_is_reported_without_blocking_others(self, upstream):
+        """Test that a foreign key failure only affects the programs sharing that patch."""
+        first, second = (p["program_id"] for p in upstream.store.tables["programs"][:2])
+
+        result = client.post("/api/programs/approvals", json={"decisions": [
+            {"program_id": first, "decision": "approve"},
+            {"program_id": second, "decision": "approve", "changes": {"provider_id": self.MISSING}},
+        ]}).json()
+
+        assert [p["program_id"] for p in result["updated"]] == [first]
+        assert result["errors"] == [{"program_ids": [second], "error": f"Provider with ID {self.MISSING} not found"}]
+        assert result["not_found"] == []
+
+    def test_duplicate_program_ids(self, upstream):
+        """Test that deciding the same program twice is a 400."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        response = client.post("/api/programs/approvals", json={"decisions": [
+            {"program_id": program_id, "decision": "approve"},
+            {"program_id": program_id, "decision": "reject"},
+        ]})
+
+        assert response.status_code == 400
+
+
+class TestChanges:
+    """Test cases for delta sync through GET /api/programs/changes."""
+
+    @pytest.fixture
+    def settled(self, monkeypatch):
+        """Refresh on every poll and treat every seen version as committed."""
+        monkeypatch.setattr(changes, "REFRESH_INTERVAL", 0.0)
+        monkeypatch.setattr(changes, "SETTLE_SECONDS", 0.0)
+
+    @staticmethod
+    def poll(since=None):
+        params = {} if since is None else {"since": since}
+        response = client.get("/api/programs/changes", params=params)
+        assert response.status_code == 200
+        return response.json()
+
+    def test_first_sync_resets(self, upstream):
+        """Test that a client without a cursor is told to reload, with a cursor to resume from."""
+        result = self.poll()
+
+        assert result["reset"] is True
+        assert result["changes"] == []
+        assert isinstance(result["cursor"], int)
+
+    def test_first_cursor_is_the_settled_head(self, upstream):
+        """Test that after a reset the next poll only sends changes newer than the catalogue the client loaded."""
+        seeded = max(p["version"] for p in upstream.store.tables["programs"])
+        program_id = upstream.store.tables["programs"][5]["program_id"]
+        # Written moments before the log loads, so it may not have settled yet
+        client.put(f"/api/programs/{program_id}", json={"name": "Just renamed"})
+
+        cursor = self.poll()["cursor"]
+        result = self.poll(cursor)
+
+        assert cursor == seeded
+        assert [row["program_id"] for row in result["changes"]] == [program_id]
+
+    def test_failed_first_load_is_retried(self, upstream, monkeypatch):
+        """Test that a poll during an outage before the log has loaded is a 503, and the next poll loads it."""
+        monkeypatch.setattr(resilience, "BACKOFF_BASE", 0.001)
+        upstream.failures["programs"] = float("inf")
+
+        failed = client.get("/api/programs/changes", params={"since": 5})
+        upstream.failures.clear()
+        result = self.poll(5)
+
+        assert failed.status_code == 503
+        assert result["reset"] is False
+        assert result["cursor"] >= 5
+
+    def test_only_changed_programs_are_returned(self, upstream, settled):
+        """Test that a poll returns only the programs written after the cursor."""
+        cursor = self.poll(self.poll()["cursor"])["cursor"]
+        program_id = upstream.store.tables["programs"][3]["program_id"]
+        client.put(f"/api/programs/{program_id}", json={"name": "Renamed"})
+
+        result = self.poll(cursor)
+
+        assert [p["program_id"] for p in result["changes"]] == [program_id]
+        assert result["changes"][0]["name"] == "Renamed"
+        assert result["changes"][0]["provider_name"] is not None
+        assert result["cursor"] == result["changes"][0]["version"] > cursor
+        assert self.poll(result["cursor"])["changes"] == []
+
+    def test_writes_by_other_workers_are_picked_up(self, upstream, settled):
+        """Test that rows changed upstream behind our back appear after a refresh."""
+        cursor = self.poll(self.poll()["cursor"])["cursor"]
+        row = upstream.store.tables["programs"][7]
+        with upstream.store.lock:
+            row["name"] = "Edited elsewhere"
+            upstream.store.touch("programs", row)
+
+        result = self.poll(cursor)
+
+        assert [(p["program_id"], p["name"]) for p in result["changes"]] == [(row["program_id"], "Edited elsewhere")]
+
+    def test_polls_share_one_upstream_scan(self, upstream, monkeypatch):
+        """Test that many polls within the refresh interval cost one range scan."""
+        monkeypatch.setattr(changes, "REFRESH_INTERVAL", 60.0)
+        cursor = self.poll()["cursor"]
+        upstream.requests.clear()
+
+        for _ in range(5):
+            self.poll(cursor)
+
+        assert upstream.requests == {}
+
+    def test_cursor_trails_unsettled_writes(self, upstream, monkeypatch):
+        """Test that a write too recent to be settled is sent again rather than skipped past."""
+        monkeypatch.setattr(changes, "REFRESH_INTERVAL", 0.0)
+        monkeypatch.setattr(changes, "SETTLE_SECONDS", 60.0)
+        cursor = self.poll()["cursor"]
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        version = client.put(f"/api/programs/{program_id}", json={"name": "Recent"}).json()["version"]
+
+        first = self.poll(cursor)
+        second = self.poll(first["cursor"])
+
+        assert first["cursor"] < version
+        assert program_id in [p["program_id"] for p in second["changes"]]
+
+    def test_cursor_older_than_log_uses_range_scan(self, upstream, settled, monkeypatch):
+        """Test that a cursor from before the in-memory log is served by an upstream range scan."""
+        monkeypatch.setattr(changes, "INITIAL_ENTRIES", 10)
+        newest = sorted(p["version"] for p in upstream.store.tables["programs"])
+        self.poll()
+        upstream.requests.clear()
+
+        result = self.poll(newest[5])
+
+        assert [p["version"] for p in result["changes"]] == newest[6:]
+        assert upstream.requests[("GET", "programs")] == 2
+
+    def test_far_behind_client_resets(self, upstream, settled, monkeypatch):
+        """Test that a client more than MAX_CHANGES behind is told to reload."""
+        monkeypatch.setattr(changes, "MAX_CHANGES", 3)
+        cursor = self.poll()["cursor"]
+
+        result = self.poll(0)
+
+        assert result["reset"] is True and result["changes"] == []
+        assert result["cursor"] >= cursor
+
+
+class TestProgramStream:
+    """Test cases for the SSE program feed at GET /api/stream/programs."""
+
+    @pytest.fixture(autouse=True)
+    def settled(self, monkeypatch):
+        monkeypatch.setattr(changes, "REFRESH_INTERVAL", 0.0)
+        monkeypatch.setattr(changes, "SETTLE_SECONDS", 0.0)
+        monkeypatch.setattr(events, "POLL_SECONDS", 60.0)
+
+    @staticmethod
+    def parse(message: str) -> dict:
+        fields = dict(line.split(": ", 1) for line in message.strip().splitlines() if not line.startswith(":"))
+        if "data" in fields:
+            fields["data"] = json.loads(fields["data"])
+        return fields
+
+    @staticmethod
+    async def take(stream, count: int) -> list:
+        return [await asyncio.wait_for(stream.__anext__(), 5) for _ in range(count)]
+
+    @staticmethod
+    def settle() -> int:
+        """Load the change log and let it settle; returns the cursor."""
+        cursor = client.get("/api/programs/changes").json()["cursor"]
+        return client.get("/api/programs/changes", params={"since": cursor}).json()["cursor"]
+
+    def test_writes_are_pushed_to_subscribers(self, upstream):
+        """Test that an update made through the API reaches an open stream."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+
+        async def scenario():
+            subscription = await events.feed.subscribe()
+            stream = subscription.stream()
+            assert (await self.take(stream, 1))[0].startswith("retry:")
+            await repository.update_program(program_id, {"name": "Live"})
+            message = self.parse((await self.take(stream, 1))[0])
+            await stream.aclose()
+            return message
+
+        message = asyncio.run(scenario())
+
+        assert message["event"] == "program"
+        assert message["data"]["program_id"] == program_id
+        assert message["data"]["name"] == "Live"
+        assert "providers" not in message["data"]
+        assert len(events.feed) == 0
+
+    def test_resume_replays_changes_after_last_event_id(self, upstream):
+        """Test that reconnecting with Last-Event-ID replays what was missed."""
+        cursor = self.settle()
+        missed = [p["program_id"] for p in upstream.store.tables["programs"][:2]]
+        for program_id in missed:
+            client.put(f"/api/programs/{program_id}", json={"name": "While away"})
+
+        async def scenario():
+            stream = (await events.feed.subscribe(cursor)).stream()
+            messages = await self.take(stream, 3)
+            await stream.aclose()
+            return [self.parse(m) for m in messages[1:]]
+
+        replayed = asyncio.run(scenario())
+
+        assert [m["data"]["program_id"] for m in replayed] == missed
+        assert int(replayed[-1]["id"]) > cursor
+
+    def test_slow_subscriber_catches_up_from_log(self, upstream, monkeypatch):
+        """Test that overflowing a subscriber's queue drops the backlog, not the changes."""
+        monkeypatch.setattr(events, "QUEUE_SIZE", 2)
+        rows = upstream.store.tables["programs"][:5]
+        self.settle()
+
+        async def scenario():
+            subscription = await events.feed.subscribe()
+            stream = subscription.stream()
+            await self.take(stream, 1)
+            await repository.update_programs([r["program_id"] for r in rows], {"category": "Arts"})
+            assert subscription.lagging
+            messages = await self.take(stream, len(rows))
+            await stream.aclose()
+            return [self.parse(m) for m in messages]
+
+        received = asyncio.run(scenario())
+
+        assert {m["data"]["program_id"] for m in received} == {r["program_id"] for r in rows}
+
+    def test_idle_stream_sends_heartbeats(self, upstream, monkeypatch):
+        """Test that an idle connection gets a comment line to keep it open."""
+        monkeypatch.setattr(events, "HEARTBEAT_SECONDS", 0.01)
+
+        async def scenario():
+            stream = (await events.feed.subscribe()).stream()
+            messages = await self.take(stream, 2)
+            await stream.aclose()
+            return messages
+
+        assert asyncio.run(scenario())[1] == ": heartbeat\n\n"
+
+    def test_stream_endpoint_is_event_stream(self, upstream):
+        """Test that the route answers with an unbuffered text/event-stream."""
+        from routes.stream_routes import stream_programs
+
+        async def scenario():
+            response = await stream_programs(last_event_id=None, since=None)
+            first = await response.body_iterator.__anext__()
+            await response.body_iterator.aclose()
+            return response, first
+
+        response, first = asyncio.run(scenario())
+
+        assert response.media_type == "text/event-stream"
+        assert response.headers["x-accel-buffering"] == "no"
+        assert first.startswith("retry:")
+
+
+class TestConditionalGet:
+    """Test cases for ETags, If-None-Match and Cache-Control on the read routes."""
+
+    def test_program_not_modified(self, upstream):
+        """Test that a matching If-None-Match gets an empty 304 from the cached entry."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        first = client.get(f"/api/programs/{program_id}")
+        etag = first.headers["etag"]
+
+        second = client.get(f"/api/programs/{program_id}", headers={"If-None-Match": etag})
+
+        assert first.status_code == 200
+        assert "s-maxage" in first.headers["cache-control"]
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["etag"] == etag
+        assert upstream.requests[("GET", "programs")] == 1
+
+    def test_write_changes_etag(self, upstream):
+        """Test that an updated program no longer matches its old ETag."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        etag = client.get(f"/api/programs/{program_id}").headers["etag"]
+        client.put(f"/api/programs/{program_id}", json={"name": "Changed"})
+
+        response = client.get(f"/api/programs/{program_id}", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.json()["name"] == "Changed"
+        assert response.headers["etag"] != etag
+
+    def test_list_routes_support_if_none_match(self, upstream):
+        """Test that program pages, the provider list and provider pages answer 304."""
+        provider_id = upstream.store.tables["providers"][0]["provider_id"]
+        for path, params in [
+            ("/api/programs", {"limit": 10, "fields": "name,provider_name"}),
+            ("/api/providers", {}),
+            (f"/api/providers/{provider_id}", {}),
+        ]:
+            etag = client.get(path, params=params).headers["etag"]
+            response = client.get(path, params=params, headers={"If-None-Match": f'"other", {etag}'})
+            assert response.status_code == 304, path
+
+    def test_etags_differ_between_pages(self, upstream):
+        """Test that each page and projection has its own ETag."""
+        first = client.get("/api/programs", params={"limit": 10})
+        second = client.get("/api/programs", params={"limit": 10, "cursor": first.headers["x-next-cursor"]})
+        projected = client.get("/api/programs", params={"limit": 10, "fields": "name"})
+
+        assert len({first.headers["etag"], second.headers["etag"], projected.headers["etag"]}) == 3
+
+    def test_etag_matching(self):
+        """Test If-None-Match parsing: lists, weak validators and the wildcard."""
+        assert conditional.etag_matches('"a", W/"b"', '"b"')
+        assert conditional.etag_matches("*", '"b"')
+        assert not conditional.etag_matches('"a"', '"b"')
+        assert not conditional.etag_matches(None, '"b"')
+
+
+class TestCompression:
+    """Test cases for orjson serialisation and response compression."""
+
+    def test_negotiate(self):
+        """Test Accept-Encoding negotiation with q-values, wildcards and identity."""
+        assert compression.negotiate("gzip, deflate") == "gzip"
+        assert compression.negotiate("gzip;q=0") is None
+        assert compression.negotiate("identity") is None
+        assert compression.negotiate("*;q=0.5") in ("br", "gzip")
+        assert compression.negotiate("") is None
+
+    def test_large_list_is_compressed(self, upstream):
+        """Test that a large page is gzipped with a suffixed ETag and Vary."""
+        response = client.get("/api/programs", params={"limit": 50}, headers={"Accept-Encoding": "gzip"})
+
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"].endswith('-gzip"')
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert len(response.json()) == 50
+
+    def test_small_body_is_not_compressed(self, upstream):
+        """Test that bodies under the minimum size are sent as they are."""
+        response = client.get("/api/programs", params={"limit": 1, "fields": "name"}, headers={"Accept-Encoding": "gzip"})
+
+        assert response.status_code == 200
+        assert "content-encoding" not in response.headers
+
+    def test_compressed_etag_revalidates(self, upstream):
+        """Test that the suffixed ETag gets a 304 echoing the same tag."""
+        params = {"limit": 50}
+        etag = client.get("/api/programs", params=params, headers={"Accept-Encoding": "gzip"}).headers["etag"]
+
+        response = client.get("/api/programs", params=params, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+    def test_event_stream_is_not_compressed(self):
+        """Test that text/event-stream passes through without buffering or encoding."""
+        sent = []
+
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream")]})
+            await send({"type": "http.response.body", "body": b"x" * 4096, "more_body": True})
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+        asyncio.run(compression.CompressionMiddleware(app)(scope, None, send))
+
+        assert sent[1]["body"] == b"x" * 4096
+        assert (b"content-encoding", b"gzip") not in sent[0]["headers"]
+
+    def test_program_out(self):
+        """Test that the embedded provider is flattened to provider_name."""
+        row = {"program_id": "p1", "name": "Yoga", "providers": {"provider_id": "v1", "name": "Studio"}}
+
+        assert serialization.program_out(row) == {"program_id": "p1", "name": "Yoga", "provider_name": "Studio"}
+        assert serialization.program_out({"program_id": "p2", "providers": None})["provider_name"] is None
+
+
+class TestCoalescing:
+    """Test cases for single-flight loading of concurrent identical reads."""
+
+    def test_concurrent_misses_share_one_load(self):
+        """Test that concurrent misses on one key make a single upstream call."""
+        cache = ReadThroughCache()
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"n": len(calls)}
+
+        async def scenario():
+            return await asyncio.gather(*(cache.get_or_load(("program", "p1"), loader) for _ in range(10)))
+
+        results = asyncio.run(scenario())
+
+        assert len(calls) == 1
+        assert all(result == {"n": 1} for result in results)
+        assert cache.stats()["coalesced"] == 9
+        assert cache.stats()["coalesced_by_kind"] == {"program": 9}
+        assert cache.stats()["in_flight"] == 0
+
+    def test_invalidation_starts_a_new_flight(self):
+        """Test that a read arriving after a write doesn't join a load started before it."""
+        cache = ReadThroughCache()
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            n = len(calls)
+            await asyncio.sleep(0.01)
+            return n
+
+        async def scenario():
+            before = asyncio.create_task(cache.get_or_load("k", loader))
+            await asyncio.sleep(0)
+            cache.invalidate("anything")
+            after = await cache.get_or_load("k", loader)
+            return await before, after
+
+        before, after = asyncio.run(scenario())
+
+        assert (before, after) == (1, 2)
+        assert cache.coalesced == 0
+
+    def test_failure_reaches_every_waiter(self):
+        """Test that a failed load raises for each coalesced caller and isn't cached."""
+        cache = ReadThroughCache()
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        async def scenario():
+            return await asyncio.gather(
+                *(cache.get_or_load("k", loader) for _ in range(3)), return_exceptions=True
+            )
+
+        results = asyncio.run(scenario())
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert cache.stats()["entries"] == 0
+
+    def test_cancelled_caller_does_not_cancel_load(self):
+        """Test that a caller going away leaves the shared load running for the rest."""
+        cache = ReadThroughCache()
+
+        async def loader():
+            await asyncio.sleep(0.02)
+            return "value"
+
+        async def scenario():
+            first = asyncio.create_task(cache.get_or_load("k", loader))
+            second = asyncio.create_task(cache.get_or_load("k", loader))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(scenario()) == "value"
+
+    def test_concurrent_program_requests(self, upstream):
+        """Test that simultaneous GETs of one program reach PostgREST once."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        upstream.latency = 0.05
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await asyncio.gather(*(http.get(f"/api/programs/{program_id}") for _ in range(20)))
+
+        responses = asyncio.run(scenario())
+
+        assert all(response.status_code == 200 for response in responses)
+        assert upstream.requests[("GET", "programs")] == 1
+        assert repository.cache.stats()["coalesced_by_kind"]["program"] >= 19
+
+
+class TestLoadHarness:
+    """Test cases for the stub PostgREST/GoTrue and the load test profiles."""
+
+    def test_remote_auth_against_stub_gotrue(self, upstream, monkeypatch):
+        """Test that without a JWT secret tokens are checked with the stub's /auth/v1/user."""
+        monkeypatch.setattr(auth, "JWT_SECRET", None)
+        stub_client = create_client(upstream.url, "stub.anon.key")
+        monkeypatch.setattr(auth, "public_client", lambda: stub_client)
+        auth._user_cache.clear()
+        token = upstream.issue_token(user_id="user-789", email="someone@example.com")
+
+        accepted = client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}"})
+        rejected = client.get("/api/debug-auth", headers={"Authorization": f"Bearer {token}x"})
+        auth._user_cache.clear()
+
+        assert accepted.status_code == 200
+        assert accepted.json()["user_id"] == "user-789"
+        assert rejected.status_code == 401
+        assert upstream.requests[("GET", "auth/user")] == 2
+
+    def test_indexed_scans_match_full_sort(self, upstream):
+        """Test that keyset and version scans walked from an index equal a sort of the table."""
+        store = upstream.store
+        programs = store.tables["programs"]
+        after = sorted(p["program_id"] for p in programs)[10]
+        by_id = store.query("programs", [("order", "program_id"), ("program_id", f"gt.{after}"), ("limit", "5")])
+        store.update("programs", programs[3], {"name": "Touched"})
+        by_version = store.query("programs", [("version", "gt.45"), ("order", "version")])
+
+        assert by_id == sorted((p for p in programs if p["program_id"] > after), key=lambda p: p["program_id"])[:5]
+        assert by_version == sorted((p for p in programs if p["version"] > 45), key=lambda p: p["version"])
+        assert by_version[-1]["name"] == "Touched"
+
+    def test_every_route_profile_succeeds(self, upstream, monkeypatch):
+        """Test that each scripted route request is accepted by the current API."""
+        import random
+        monkeypatch.setattr(auth, "JWT_SECRET", upstream.jwt_secret)
+        ctx = load_profiles.LoadContext.from_seed(upstream.store.tables, [upstream.issue_token(email="load@example.com")])
+        rng = random.Random(1)
+
+        for name, build in load_profiles.ROUTES.items():
+            request = build(ctx, rng)
+            response = client.request(request.method, request.path, params=request.params, json=request.json,
+                                      content=request.content, headers=request.headers)
+            assert response.status_code == 200, (name, response.text)
+        auth._user_cache.clear()
+
+
+class TestObservability:
+    """Test cases for /metrics, upstream timing spans and queue-backed logging."""
+
+    def test_route_metrics_use_path_templates(self, upstream):
+        """Test that request counts and latencies are labelled by route template and status."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        before = tracing.HTTP_REQUESTS.value("GET", "/api/programs/{program_id}", "200")
+        client.get(f"/api/programs/{program_id}")
+
+        response = client.get("/metrics")
+
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert tracing.HTTP_REQUESTS.value("GET", "/api/programs/{program_id}", "200") == before + 1
+        assert 'http_request_duration_seconds_bucket{method="GET",route="/api/programs/{program_id}",le="+Inf"}' in response.text
+        assert program_id not in response.text
+        assert tracing.HTTP_IN_FLIGHT.value("GET", "/metrics") == 0
+
+    def test_upstream_calls_are_timed_by_table_and_operation(self, upstream):
+        """Test that every Supabase call is recorded with its table, operation and outcome."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        selects = tracing.UPSTREAM_DURATION.count("programs", "select")
+        updates = tracing.UPSTREAM_REQUESTS.value("programs", "update", "ok")
+
+        client.get(f"/api/programs/{program_id}")
+        client.put(f"/api/programs/{program_id}", json={"name": "Timed"})
+
+        assert tracing.UPSTREAM_DURATION.count("programs", "select") == selects + 1
+        assert tracing.UPSTREAM_REQUESTS.value("programs", "update", "ok") == updates + 1
+
+    def test_request_id_is_echoed_or_generated(self):
+        """Test that X-Request-ID is passed through, or a new one is made."""
+        assert client.get("/", headers={"X-Request-ID": "req-1"}).headers["x-request-id"] == "req-1"
+        assert len(client.get("/").headers["x-request-id"]) == 32
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test the text exposition of a histogram."""
+        histogram = metrics.Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.0), register=False)
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value, "/a")
+
+        lines = histogram.render()
+
+        assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{route="/a",le="1"} 3' in lines
+        assert 'test_seconds_bucket{route="/a",le="+Inf"} 4' in lines
+        assert 'test_seconds_count{route="/a"} 4' in lines
+
+    def test_structured_log_records(self):
+        """Test that records are written as JSON with the request id, extras and traceback."""
+        stream = io.StringIO()
+        logs.configure(level="INFO", fmt="json", stream=stream)
+        token = tracing.request_id.set("req-2")
+        try:
+            logging.getLogger("test").info("Imported", extra={"inserted": 3})
+            try:
+                raise ValueError("bad row")
+            except ValueError:
+                logging.getLogger("test").exception("Import failed")
+        finally:
+            tracing.request_id.reset(token)
+            logs.shutdown()
+            logs.configure()
+
+        info, error = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert info["message"] == "Imported" and info["level"] == "info"
+        assert info["inserted"] == 3 and info["request_id"] == "req-2"
+        assert "ValueError: bad row" in error["exception"]
+
+    def test_full_log_queue_drops_instead_of_blocking(self):
+        """Test that a record that doesn't fit in the queue is dropped and counted."""
+        handler = logs._QueueHandler(queue.Queue(maxsize=1))
+        dropped = logs.DROPPED.value()
+        record = logging.LogRecord("test", logging.INFO, __file__, 0, "message", None, None)
+
+        handler.handle(record)
+        handler.handle(record)
+
+        assert logs.DROPPED.value() == dropped + 1
+
+    def test_create_program_prints_nothing(self, upstream, capsys):
+        """Test that creating a program no longer prints debug output."""
+        response = client.post("/api/programs", json={"name": "Quiet", "place_id": ""})
+
+        assert response.status_code == 200
+        assert capsys.readouterr().out == ""
+
+
+class TestReplica:
+    """Test cases for serving catalogue reads from the local SQLite replica."""
+
+    @pytest.fixture
+    def local(self, upstream, tmp_path, monkeypatch):
+        """A replica synced from the stub, not yet serving reads."""
+        monkeypatch.setattr(changes, "REFRESH_INTERVAL", 0.0)
+        monkeypatch.setattr(changes, "SETTLE_SECONDS", 0.0)
+        copy = replica.Replica(str(tmp_path / "catalogue.db"))
+        asyncio.run(copy.sync())
+        yield copy
+        copy.close()
+
+    @staticmethod
+    def serve_from(copy, monkeypatch):
+        monkeypatch.setattr(repository, "read_replica", copy)
+        repository.cache.clear()
+
+    @staticmethod
+    def reads():
+        return {
+            "page": client.get("/api/programs", params={"limit": 20}).json(),
+            "projected": client.get("/api/programs", params={"fields": "name,provider_name", "limit": 20}).json(),
+            "filtered": client.get("/api/programs", params={
+                "category": "Community", "is_approved": "true", "has_place": "false",
+                "start_date_from": "2025-03-01", "start_date_to": "2025-10-31",
+            }).json(),
+            "providers": client.get("/api/providers").json(),
+        }
+
+    def test_replica_reads_match_upstream(self, upstream, local, monkeypatch):
+        """Test that every catalogue read returns the same rows from the replica, without upstream calls."""
+        program_id = upstream.store.tables["programs"][4]["program_id"]
+        provider_id = upstream.store.tables["providers"][2]["provider_id"]
+        expected = self.reads()
+        expected["program"] = client.get(f"/api/programs/{program_id}").json()
+        expected["provider"] = client.get(f"/api/providers/{provider_id}").json()
+        batch = {"program_ids": [p["program_id"] for p in upstream.store.tables["programs"][10:15]]}
+        expected["batch"] = client.post("/api/programs/batch", json=batch).json()
+        self.serve_from(local, monkeypatch)
+        upstream.requests.clear()
+        served = repository.replica_reads.value("replica")
+
+        actual = self.reads()
+        actual["program"] = client.get(f"/api/programs/{program_id}").json()
+        actual["provider"] = client.get(f"/api/providers/{provider_id}").json()
+        actual["batch"] = client.post("/api/programs/batch", json=batch).json()
+
+        # PostgREST doesn't order embedded rows
+        for result in (expected, actual):
+            result["provider"]["programs"].sort(key=lambda program: program["program_id"])
+        assert expected["filtered"]
+        assert actual == expected
+        assert upstream.requests == {}
+        assert repository.replica_reads.value("replica") == served + 7
+
+    def test_poll_reads_only_new_changes(self, upstream, local):
+        """Test that a sync after the snapshot applies rows changed upstream, and only those."""
+        row = upstream.store.tables["programs"][9]
+        with upstream.store.lock:
+            upstream.store.update("programs", row, {"name": "Edited elsewhere"})
+        cursor = local.cursor
+
+        asyncio.run(local.sync())
+        upstream.requests.clear()
+        # The change log's cursor only passes a version once it has settled
+        asyncio.run(local.sync())
+
+        assert local.get_program(row["program_id"])[0]["name"] == "Edited elsewhere"
+        assert local.cursor == row["version"] > cursor
+        assert upstream.requests == {("GET", "programs"): 1}
+        assert local.lag() < 1
+
+    def test_metrics_do_not_read_the_file(self, upstream, local, monkeypatch):
+        """Test that the replica gauges come from the sync state kept in memory, not from SQLite on the loop."""
+        monkeypatch.setattr(replica, "replica", local)
+        cursor = local.cursor
+
+        def no_sqlite():
+            raise AssertionError("SQLite read while rendering metrics")
+
+        monkeypatch.setattr(local, "_connection", no_sqlite)
+        rendered = metrics.render()
+
+        assert f"replica_cursor {cursor}" in rendered
+        assert "replica_lag_seconds 0." in rendered
+
+    def test_own_writes_are_read_back(self, upstream, local, monkeypatch):
+        """Test that a program written by this worker is in the replica before the next sync, written off the loop."""
+        self.serve_from(local, monkeypatch)
+        monkeypatch.setattr(replica, "replica", local)
+        program_id = upstream.store.tables["programs"][1]["program_id"]
+        on_loop = []
+        apply_programs = local.apply_programs
+
+        def record_thread(rows):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return apply_programs(rows)
+
+        monkeypatch.setattr(local, "apply_programs", record_thread)
+
+        client.put(f"/api/programs/{program_id}", json={"name": "Renamed here"})
+
+        assert client.get(f"/api/programs/{program_id}").json()["name"] == "Renamed here"
+        assert local.get_program(program_id)[0]["name"] == "Renamed here"
+        assert on_loop == [False]
+
+    def test_lagging_replica_falls_back_upstream(self, upstream, local, monkeypatch):
+        """Test that reads go upstream once the replica is further behind than the threshold."""
+        self.serve_from(local, monkeypatch)
+        monkeypatch.setattr(replica, "MAX_LAG_SECONDS", -1.0)
+        row = upstream.store.tables["programs"][0]
+        with upstream.store.lock:
+            upstream.store.update("programs", row, {"name": "Not synced yet"})
+        fallbacks = repository.replica_reads.value("upstream")
+
+        response = client.get(f"/api/programs/{row['program_id']}")
+
+        assert response.json()["name"] == "Not synced yet"
+        assert repository.replica_reads.value("upstream") == fallbacks + 1
+
+    def test_removed_provider_takes_its_programs(self, upstream, local, monkeypatch):
+        """Test that a provider refresh drops programs of providers deleted upstream, as the cascade does."""
+        provider_id = upstream.store.tables["providers"][0]["provider_id"]
+        local.replace_providers([p for p in upstream.store.tables["providers"] if p["provider_id"] != provider_id])
+
+        assert local.get_provider_with_programs(provider_id) == []
+        assert local.list_programs(provider_id=provider_id) == []
+
+    def test_one_worker_syncs(self, tmp_path):
+        """Test that only one worker per file holds the lead, and another takes over when it goes."""
+        path = str(tmp_path / "catalogue.db")
+        first, second = replica.Replica(path), replica.Replica(path)
+
+        assert first.try_lead() is True
+        assert second.try_lead() is False
+        first.close()
+        assert second.try_lead() is True
+        second.close()
+
+
+class TestServer:
+    """Test cases for warm-up, health checks and draining in the production server."""
+
+    @pytest.fixture(autouse=True)
+    def fresh_state(self, monkeypatch):
+        monkeypatch.setattr(health, "state", health.STARTING)
+        monkeypatch.setattr(health, "warmup", {})
+
+    def test_liveness(self):
+        """Test that /health answers whatever the worker's state."""
+        response = client.get("/health")
+
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+    def test_ready_after_warm_up(self):
+        """Test that readiness waits for warm-up, and a failed step doesn't keep the worker out."""
+        async def fails():
+            raise RuntimeError("upstream down")
+
+        async def loads():
+            pass
+
+        assert client.get("/health/ready").status_code == 503
+        asyncio.run(health.warm({"programs": loads, "search": fails}))
+
+        response = client.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json() == {"status": "ready", "warmup": {"programs": "ok", "search": "failed"}}
+
+    def test_slow_warm_up_is_cut_short(self, monkeypatch):
+        """Test that a step still running at the warm-up timeout doesn't delay readiness."""
+        monkeypatch.setattr(health, "WARMUP_TIMEOUT", 0.05)
+
+        async def slow():
+            await asyncio.sleep(5)
+
+        async def scenario():
+            started = time.monotonic()
+            await health.warm({"search": slow})
+            elapsed = time.monotonic() - started
+            health.drain()
+            return elapsed
+
+        assert asyncio.run(scenario()) < 1
+        assert health.warmup == {"search": "loading"}
+
+    def test_drain_ends_streams(self, upstream):
+        """Test that draining reports not ready and ends open event streams."""
+        async def scenario():
+            stream = (await events.feed.subscribe()).stream()
+            await stream.__anext__()
+            waiting = asyncio.ensure_future(stream.__anext__())
+            await asyncio.sleep(0.05)
+            health.drain()
+            with pytest.raises(StopAsyncIteration):
+                await asyncio.wait_for(waiting, 5)
+
+        asyncio.run(scenario())
+
+        assert client.get("/health/ready").json()["status"] == "draining"
+        assert len(events.feed) == 0
+
+    def test_one_worker_per_core(self, monkeypatch):
+        """Test that workers default to the usable cores and WEB_CONCURRENCY overrides it."""
+        monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+        assert serve.worker_count() == len(os.sched_getaffinity(0))
+        monkeypatch.setenv("WEB_CONCURRENCY", "3")
+        assert serve.options()["workers"] == 3
+        assert serve.options()["preload_app"] is True
+
+    def test_import_creates_no_clients(self):
+        """Test that importing the app opens nothing a forked worker would share."""
+        script = "import config, main, repository; print(config.admin_client.cache_info().currsize, " \
+                 "config.public_client.cache_info().currsize, repository.supabase_admin, repository._executor)"
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        assert output.stdout.split() == ["0", "0", "None", "None"]
+
+
+class TestFacets:
+    """Test cases for GET /api/programs/facets."""
+
+    FILTERS = ("category", "provider_id", "is_approved", "has_place", "start_date_from", "start_date_to")
+
+    @staticmethod
+    def brute_force(rows, **filters):
+        """Count by scanning every row, each facet without its own filter."""
+        def keep(row, skip=()):
+            checks = {
+                "category": lambda: row.get("category") == filters["category"],
+                "provider_id": lambda: row.get("provider_id") == filters["provider_id"],
+                "is_approved": lambda: row.get("is_approved") == (filters["is_approved"] == "true"),
+                "has_place": lambda: bool(row.get("place_id")) == (filters["has_place"] == "true"),
+                "start_date_from": lambda: bool(row.get("start_date")) and row.get("start_date") >= filters["start_date_from"],
+                "start_date_to": lambda: bool(row.get("start_date")) and row.get("start_date") <= filters["start_date_to"],
+            }
+            return all(check() for name, check in checks.items() if name in filters and name not in skip)
+
+        def count(skip, value):
+            counts = {}
+            for row in rows:
+                if keep(row, skip):
+                    counts[value(row)] = counts.get(value(row), 0) + 1
+            return counts
+
+        month = lambda row: row["start_date"][:7] if row.get("start_date") else None
+        return {
+            "total": sum(1 for row in rows if keep(row)),
+            "category": count(("category",), lambda row: row.get("category")),
+            "provider": count(("provider_id",), lambda row: row.get("provider_id")),
+            "is_approved": count(("is_approved",), lambda row: row.get("is_approved")),
+            "start_month": count(("start_date_from", "start_date_to"), month),
+        }
+
+    @staticmethod
+    def fetch(**filters):
+        response = client.get("/api/programs/facets", params=filters)
+        assert response.status_code == 200
+        body = response.json()
+        return {
+            "total": body["total"],
+            "category": {entry["value"]: entry["count"] for entry in body["category"]},
+            "provider": {entry["provider_id"]: entry["count"] for entry in body["provider"]},
+            "is_approved": {entry["value"]: entry["count"] for entry in body["is_approved"]},
+            "start_month": {entry["value"]: entry["count"] for entry in body["start_month"]},
+        }
+
+    def test_counts_match_brute_force(self, upstream):
+        """Test every facet against a scan of the catalogue, for combinations of filters."""
+        rows = upstream.store.tables["programs"]
+        provider_id = upstream.store.tables["providers"][1]["provider_id"]
+        combinations = [
+            {},
+            {"category": "Community"},
+            {"provider_id": provider_id, "is_approved": "true"},
+            {"has_place": "false", "start_date_from": "2025-03-15"},
+            {"start_date_from": "2025-02-10", "start_date_to": "2025-06-20", "category": "Health"},
+            {"category": "Health", "provider_id": provider_id, "is_approved": "false", "has_place": "true"},
+        ]
+
+        for filters in combinations:
+            assert self.fetch(**filters) == self.brute_force(rows, **filters), filters
+
+    def test_writes_update_counts_without_rescanning(self, upstream):
+        """Test that creating and updating programs moves the counts, with no aggregate query."""
+        program = upstream.store.tables["programs"][0]
+        before = self.fetch()
+        upstream.requests.clear()
+
+        client.put(f"/api/programs/{program['program_id']}", json={"category": "Brand new", "start_date": "2031-01-05"})
+        client.post("/api/programs", json={"name": "Also new", "category": "Brand new"})
+        after = self.fetch()
+
+        assert after["total"] == before["total"] + 1
+        assert after["category"]["Brand new"] == 2
+        assert after["start_month"]["2031-01"] == 1
+        assert after == self.brute_force(upstream.store.tables["programs"])
+        assert ("GET", "programs") not in upstream.requests
+
+    def test_unchanged_counts_are_not_modified(self, upstream):
+        """Test that facet responses carry an ETag and revalidate with a 304."""
+        etag = client.get("/api/programs/facets").headers["etag"]
+
+        response = client.get("/api/programs/facets", headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+
+
+class TestExport:
+    """Test cases for GET /api/export/programs.{ndjson,csv,ics}."""
+
+    @pytest.fixture(autouse=True)
+    def snapshot_dir(self, upstream, monkeypatch, tmp_path):
+        monkeypatch.setattr(export, "snapshots", export.SnapshotStore(str(tmp_path)))
+        monkeypatch.setattr(resilience, "BACKOFF_BASE", 0.001)
+
+    def test_ndjson_is_each_program_as_read_singly(self, upstream, monkeypatch):
+        """Test that NDJSON has one line per program, in keyset pages, each as GET /api/programs/{id} returns it."""
+        monkeypatch.setattr(export, "PAGE_SIZE", 7)
+        upstream.requests.clear()
+
+        response = client.get("/api/export/programs.ndjson")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        # The version query, then ceil(50 / 7) pages
+        assert upstream.requests == {("GET", "programs"): 1 + 8}
+        programs = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(p["program_id"] for p in programs) == sorted(
+            p["program_id"] for p in upstream.store.tables["programs"]
+        )
+        for program in programs[:5]:
+            assert program == client.get(f"/api/programs/{program['program_id']}").json()
+
+    def test_csv_has_a_header_and_a_row_per_program(self, upstream):
+        """Test that CSV rows parse back to the programs' fields, quoting included."""
+        response = client.get("/api/export/programs.csv")
+
+        assert response.status_code == 200
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert tuple(rows[0]) == export.CSV_COLUMNS
+        assert len(rows) == 1 + len(upstream.store.tables["programs"])
+        by_id = {p["program_id"]: p for p in upstream.store.tables["programs"]}
+        for row in rows[1:]:
+            program = dict(zip(export.CSV_COLUMNS, row))
+            assert program["address"] == by_id[program["program_id"]]["address"]
+            assert program["is_approved"] == ("true" if by_id[program["program_id"]]["is_approved"] else "false")
+
+    def test_ics_expands_recurrences(self, upstream):
+        """Test that the iCalendar feed has a VEVENT per occurrence, in folded CRLF lines."""
+        upstream.store.tables["programs"][0]["description"] = "Ünïcode, long; " * 20
+
+        response = client.get("/api/export/programs.ics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "text/calendar; charset=utf-8"
+        body = response.content
+        assert body.startswith(b"BEGIN:VCALENDAR\r\n") and body.endswith(b"END:VCALENDAR\r\n")
+        lines = body.split(b"\r\n")[:-1]
+        assert all(len(line) <= 75 for line in lines)
+        expected = sum(
+            (p["repeat_interval"] if p["date_interval"] else 1)
+            for p in upstream.store.tables["programs"] if p["start_date"]
+        )
+        assert lines.count(b"BEGIN:VEVENT") == expected
+        unfolded = body.decode().replace("\r\n ", "").split("\r\n")
+        assert "DESCRIPTION:" + "Ünïcode\\, long\\; " * 20 in unfolded
+
+    def test_repeat_pulls_are_served_from_the_snapshot(self, upstream):
+        """Test that an unchanged catalogue is sent from the snapshot, with an ETag, after one version query."""
+        first = client.get("/api/export/programs.csv")
+        upstream.requests.clear()
+
+        second = client.get("/api/export/programs.csv")
+        unchanged = client.get("/api/export/programs.csv", headers={"If-None-Match": second.headers["etag"]})
+
+        assert "etag" not in first.headers
+        assert second.content == first.content
+        assert second.headers["content-length"] == str(len(first.content))
+        assert unchanged.status_code == 304
+        assert upstream.requests == {("GET", "programs"): 2}
+
+    def test_writes_make_a_new_snapshot(self, upstream):
+        """Test that a write changes the version, so the next pull reads upstream again."""
+        program_id = upstream.store.tables["programs"][0]["program_id"]
+        client.get("/api/export/programs.ndjson")
+        etag = client.get("/api/export/programs.ndjson").headers["etag"]
+
+        client.put(f"/api/programs/{program_id}", json={"name": "Renamed for export"})
+        fresh = client.get("/api/export/programs.ndjson")
+        cached = client.get("/api/export/programs.ndjson")
+
+        assert b"Renamed for export" in fresh.content
+        assert cached.content == fresh.content
+        assert cached.headers["etag"] != etag
+
+    def test_unavailable_upstream_serves_the_last_snapshot(self, upstream):
+        """Test that the newest snapshot is sent with a Warning when upstream is down, and 503 without one."""
+        client.get("/api/export/programs.ndjson")
+        upstream.failures["programs"] = 100
+
+        stale = client.get("/api/export/programs.ndjson")
+        missing = client.get("/api/export/programs.csv")
+
+        assert stale.status_code == 200
+        assert stale.headers["warning"] == resilience.STALE_WARNING
+        assert missing.status_code == 503
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
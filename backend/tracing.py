@@ -0,0 +1,150 @@
+"""
+Per-request metrics, request ids and timing spans for upstream calls.
+
+:class:`RequestMetricsMiddleware` records each request's latency, status and
+in-flight count by route template, and gives it an id (the client's
+``X-Request-ID``, or a new one) in :data:`request_id`. Log records carry the
+id, so everything logged while serving a request can be found together.
+
+:func:`span` times a call to Supabase, labelled by table and operation. The
+duration goes into the ``upstream_request_duration_seconds`` histogram, the
+outcome into ``upstream_requests_total``, and a debug log record is written
+with the request id, so ``LOG_LEVEL=DEBUG`` shows each request's upstream
+calls in order.
+"""
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Longer client-supplied ids are cut, so they can't bloat every log line
+MAX_REQUEST_ID = 64
+
+HTTP_DURATION = metrics.Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, to the last byte of the response, by method and route.",
+    ("method", "route"),
+)
+HTTP_REQUESTS = metrics.Counter(
+    "http_requests_total",
+    "Requests served, by method, route and status code.",
+    ("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = metrics.Gauge(
+    "http_requests_in_flight",
+    "Requests being served right now, by method and route.",
+    ("method", "route"),
+)
+UPSTREAM_DURATION = metrics.Histogram(
+    "upstream_request_duration_seconds",
+    "Time spent in calls to Supabase, by table and operation.",
+    ("table", "operation"),
+)
+UPSTREAM_REQUESTS = metrics.Counter(
+    "upstream_requests_total",
+    "Calls to Supabase, by table, operation and outcome (ok or error).",
+    ("table", "operation", "outcome"),
+)
+
+_OPERATIONS = {"GET": "select", "HEAD": "select", "POST": "insert", "PATCH": "update", "DELETE": "delete"}
+
+
+def describe(query) -> tuple:
+    """(table, operation) for a built postgrest query."""
+    table = getattr(query, "path", "unknown").rsplit("/", 1)[-1]
+    method = getattr(query, "http_method", "unknown")
+    operation = _OPERATIONS.get(method.upper(), method.lower())
+    if operation == "insert" and "resolution=" in getattr(query, "headers", {}).get("prefer", ""):
+        operation = "upsert"
+    return table, operation
+
+
+@contextmanager
+def span(table: str, operation: str):
+    """Time the enclosed upstream call."""
+    outcome = "error"
+    started = time.perf_counter()
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        elapsed = time.perf_counter() - started
+        UPSTREAM_DURATION.observe(elapsed, table, operation)
+        UPSTREAM_REQUESTS.inc(table, operation, outcome)
+        logger.debug(
+            "upstream call",
+            extra={"table": table, "operation": operation, "outcome": outcome,
+                   "duration_ms": round(elapsed * 1000, 3)},
+        )
+
+
+def _route_of(scope) -> str:
+    """The path template of the route ``scope`` goes to, so ids don't become labels."""
+    app = scope.get("app")
+    partial = None
+    # As the router does: the first full match, else the first path-only match (a 405)
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording per-route latency, status counts and in-flight
+    requests, and setting :data:`request_id` (echoed as ``X-Request-ID``).
+
+    A streamed response counts as in flight until its last byte, so SSE
+    connections show up in ``http_requests_in_flight`` while they are open.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        route = _route_of(scope)
+        rid = Headers(scope=scope).get("x-request-id", "")[:MAX_REQUEST_ID] or uuid.uuid4().hex
+        token = request_id.set(rid)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                MutableHeaders(scope=message)["X-Request-ID"] = rid
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method, route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec(method, route)
+            HTTP_DURATION.observe(elapsed, method, route)
+            HTTP_REQUESTS.inc(method, route, str(status))
+            logger.debug(
+                "request served",
+                extra={"method": method, "route": route, "status": status,
+                       "duration_ms": round(elapsed * 1000, 3)},
+            )
+            request_id.reset(token)
@@ -48,12 +48,140 @@ export const updateProgramAPI = async (
   return response.data
 }
 
-export const listProgramsAPI = async (): Promise<Program[]> => {
-  const response = await apiClient.get('/programs')
+export type ApprovalDecision = {
+  program_id: string
+  decision: 'approve' | 'reject'
+  changes?: ProgramUpdatePayload
+}
+
+export type ApprovalResult = {
+  updated: Program[]
+  not_found: string[]
+  errors: { program_ids: string[]; error: string }[]
+}
+
+// Approve or reject many programs in one request
+export const reviewProgramsAPI = async (decisions: ApprovalDecision[]): Promise<ApprovalResult> => {
+  const response = await apiClient.post('/programs/approvals', { decisions })
   return response.data
 }
 
+export type ProgramListParams = {
+  fields?: string
+  category?: string
+  provider_id?: string
+  is_approved?: boolean
+  has_place?: boolean
+  start_date_from?: string
+  start_date_to?: string
+}
+
+const PAGE_SIZE = 1000
+
+// Follows the X-Next-Cursor header until every matching page has been fetched
+export const listProgramsAPI = async (params: ProgramListParams = {}): Promise<Program[]> => {
+  const programs: Program[] = []
+  let cursor: string | undefined
+  do {
+    const response = await apiClient.get('/programs', {
+      params: { ...params, limit: PAGE_SIZE, cursor },
+    })
+    programs.push(...response.data)
+    cursor = response.headers['x-next-cursor']
+  } while (cursor)
+  return programs
+}
+
+export type ProgramChanges = {
+  changes: Program[]
+  cursor: number
+  reset: boolean
+}
+
+// Programs written after `since`; with no cursor (or reset) the caller must reload the full list
+export const programChangesAPI = async (since?: number): Promise<ProgramChanges> => {
+  const response = await apiClient.get('/programs/changes', { params: { since } })
+  return response.data
+}
+
+export type ProgramStreamHandlers = {
+  // cursor can be passed back as `since` to resume after this event
+  onProgram: (program: Program, cursor: number) => void
+  // Too much was missed; reload the list
+  onReset: (cursor: number) => void
+}
+
+// Live program inserts and updates over Server-Sent Events; returns a function that closes the stream
+export const streamProgramsAPI = (handlers: ProgramStreamHandlers, since?: number): (() => void) => {
+  const url = new URL(`${apiClient.defaults.baseURL}/stream/programs`, window.location.origin)
+  if (since !== undefined) url.searchParams.set('since', String(since))
+  const source = new EventSource(url)
+  source.addEventListener('program', (event: MessageEvent) => {
+    handlers.onProgram(JSON.parse(event.data), Number(event.lastEventId))
+  })
+  source.addEventListener('reset', (event: MessageEvent) => {
+    handlers.onReset(JSON.parse(event.data).cursor)
+  })
+  return () => source.close()
+}
+
 export const getProgramAPI = async (id: string): Promise<Program> => {
   const response = await apiClient.get(`/programs/${id}`)
   return response.data
 }
+
+// Many programs in one request (up to 500 ids); ids that don't exist map to null
+export const getProgramsAPI = async (ids: string[]): Promise<Record<string, Program | null>> => {
+  const response = await apiClient.post('/programs/batch', { program_ids: ids })
+  return response.data.programs
+}
+
+export type Occurrence = {
+  program_id: string
+  occurrence: number
+  name: string
+  start: string
+  end: string
+  category?: string | null
+  description?: string | null
+  address?: string | null
+  provider_name?: string | null
+}
+
+// Occurrences overlapping [from, to] (inclusive ISO dates), expanded by the backend
+export const listOccurrencesAPI = async (from: string, to: string): Promise<Occurrence[]> => {
+  const response = await apiClient.get('/programs/occurrences', { params: { from, to } })
+  return response.data
+}
+
+export type LocatedProgram = {
+  program_id: string
+  name: string
+  category?: string | null
+  address?: string | null
+  place_id: string
+  provider_name?: string | null
+  lat: number
+  lng: number
+  distance_m?: number
+}
+
+export type ProgramCluster = {
+  lat: number
+  lng: number
+  count: number
+  program_ids: string[]
+}
+
+// bbox is 'south,west,north,east', the format of google.maps.LatLngBounds.toUrlValue()
+export type NearParams =
+  | { bbox: string; zoom?: number }
+  | { lat: number; lng: number; radius: number; zoom?: number }
+
+// Programs with coordinates resolved by the backend's geocode cache
+export const nearProgramsAPI = async (
+  params: NearParams,
+): Promise<{ programs?: LocatedProgram[]; clusters?: ProgramCluster[] }> => {
+  const response = await apiClient.get('/programs/near', { params })
+  return response.data
+}
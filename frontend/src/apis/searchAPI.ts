@@ -0,0 +1,28 @@
+import apiClient from './apiClient'
+
+export type SearchResult =
+  | {
+      type: 'program'
+      id: string
+      name: string
+      category?: string | null
+      address?: string | null
+      provider_name?: string | null
+      score: number
+    }
+  | {
+      type: 'provider'
+      id: string
+      name: string
+      description?: string | null
+      score: number
+    }
+
+// Ranked programs and providers; the last word of q matches as a prefix
+export const searchAPI = async (
+  q: string,
+  params: { limit?: number; type?: 'program' | 'provider' } = {},
+): Promise<SearchResult[]> => {
+  const response = await apiClient.get('/search', { params: { q, ...params } })
+  return response.data
+}
@@ -2,11 +2,16 @@ import { defineStore } from 'pinia'
 import { ref } from 'vue'
 import {
   listProgramsAPI,
+  programChangesAPI,
+  streamProgramsAPI,
   getProgramAPI,
   createProgramAPI,
   updateProgramAPI,
+  reviewProgramsAPI,
+  type ApprovalDecision,
   type ProgramCreatePayload,
   type ProgramUpdatePayload,
+  type ProgramListParams,
 } from '@/apis/programAPI'
 
 export interface Program {
@@ -26,15 +31,72 @@ export interface Program {
   provider_id?: string | null
   provider_name?: string | null
   is_approved?: boolean | null
+  version?: number | null
+  updated_at?: string | null
 }
 
 export const useProgramStore = defineStore('program', () => {
   const programs = ref<Program[]>([])
   const program = ref<Program>()
+  // Change cursor for the full, unfiltered list; null when programs holds anything else
+  const syncCursor = ref<number | null>(null)
 
-  async function listPrograms() {
-    const response = await listProgramsAPI()
+  async function listPrograms(params: ProgramListParams = {}) {
+    const response = await listProgramsAPI(params)
     programs.value = response
+    syncCursor.value = null
+  }
+
+  // Keep the full catalogue current: reload it once, then fetch only what changed
+  async function syncPrograms() {
+    let result = await programChangesAPI(syncCursor.value ?? undefined)
+    if (result.reset) {
+      // Take the cursor before reloading so nothing written meanwhile is missed
+      const cursor = result.cursor
+      programs.value = await listProgramsAPI()
+      syncCursor.value = cursor
+      result = await programChangesAPI(cursor)
+    }
+    if (result.changes.length) {
+      mergePrograms(result.changes)
+    }
+    syncCursor.value = result.cursor
+  }
+
+  // Replace or add changed programs, keeping whichever copy has the newer version;
+  // programs failing `keep` are dropped from the list
+  function mergePrograms(changed: Program[], keep: (p: Program) => boolean = () => true) {
+    const incoming = new Map(changed.map((p) => [p.program_id, p]))
+    const merged: Program[] = []
+    for (const p of programs.value) {
+      const update = incoming.get(p.program_id)
+      incoming.delete(p.program_id)
+      const next = update && (update.version ?? 0) >= (p.version ?? 0) ? update : p
+      if (keep(next)) merged.push(next)
+    }
+    programs.value = [...[...incoming.values()].filter(keep), ...merged]
+  }
+
+  // Apply program changes as the server pushes them; returns a function that stops listening.
+  // `keep` filters a partial list (e.g. unapproved only), `reload` refetches it after a reset.
+  function watchPrograms(
+    options: { keep?: (p: Program) => boolean; reload?: () => Promise<void> } = {},
+  ) {
+    const reload = options.reload ?? syncPrograms
+    return streamProgramsAPI(
+      {
+        onProgram: (p, cursor) => {
+          mergePrograms([p], options.keep)
+          // Only the full catalogue can resume delta sync from the stream's position
+          if (syncCursor.value !== null) syncCursor.value = cursor
+        },
+        onReset: () => {
+          syncCursor.value = null
+          reload()
+        },
+      },
+      syncCursor.value ?? undefined,
+    )
   }
 
   async function getProgram(program_id: string) {
@@ -63,12 +125,23 @@ export const useProgramStore = defineStore('program', () => {
     return updated
   }
 
+  async function reviewPrograms(decisions: ApprovalDecision[]) {
+    const result = await reviewProgramsAPI(decisions)
+    // Replace the reviewed programs in the list with their updated rows
+    const updated = new Map(result.updated.map((p) => [p.program_id, p]))
+    programs.value = programs.value.map((p) => updated.get(p.program_id) ?? p)
+    return result
+  }
+
   return {
     programs,
     program,
     listPrograms,
+    syncPrograms,
+    watchPrograms,
     getProgram,
     createProgram,
     updateProgram,
+    reviewPrograms,
   }
 })